@@ -17,6 +17,8 @@ import openai
 from werkzeug.exceptions import NotFound, InternalServerError, BadRequest
 import traceback
 
+from path_translator import PathTranslator, mappings_from_env
+
 # --- Basic Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
 log_file = 'webform.log'
@@ -460,34 +462,41 @@ def api_generation_status(generation_id):
     else: return jsonify({"error": "Generation not found"}), 404
 
 # --- Jinja Filter for Audio Paths ---
+_static_audio_translator = None
+
+def get_static_audio_translator():
+    """
+    PathTranslator (Win -> Linux) dựng một lần cho filter network_to_static_url:
+    mapping PATH_MAP_X của .env cộng thêm share Samba (//LINUX_SERVER_IP/SAMBA_SHARE_NAME) -> LOCAL_AUDIO_OUTPUT_PATH.
+    """
+    global _static_audio_translator
+    if _static_audio_translator is None:
+        audio_base_physical = os.path.abspath(os.getenv("LOCAL_AUDIO_OUTPUT_PATH", "/mnt/NewVolume/Audio"))
+        unc_base = f"//{os.getenv('LINUX_SERVER_IP', '0.0.0.0')}/{os.getenv('SAMBA_SHARE_NAME', 'AudioOutput')}"
+        win_to_linux, _ = mappings_from_env()
+        win_to_linux[unc_base] = audio_base_physical
+        # Luôn dịch về cây thư mục Linux (nơi static/audio_output trỏ tới), bất kể HĐH của web server
+        _static_audio_translator = PathTranslator(win_to_linux, system="Linux")
+        _static_audio_translator.audio_base_physical = audio_base_physical
+    return _static_audio_translator
+
 @app.template_filter('network_to_static_url')
 def network_path_to_static_url(network_or_local_path):
-    """Chuyển đổi đường dẫn UNC hoặc Local Linux thành URL static tương đối."""
+    """Chuyển đổi đường dẫn UNC, ổ mạng Windows hoặc Local Linux thành URL static tương đối."""
     if not network_or_local_path or not isinstance(network_or_local_path, str):
         return None
     try:
-        # Đường dẫn cơ sở vật lý trên Linux mà thư mục static/audio_output trỏ tới
-        audio_base_physical = os.path.abspath(os.getenv("LOCAL_AUDIO_OUTPUT_PATH", "/mnt/NewVolume/Audio"))
+        translator = get_static_audio_translator()
         # Đường dẫn tương đối trong thư mục static
         static_audio_rel_path = "audio_output"
 
-        # Chuẩn hóa path nhận được
-        normalized_path = os.path.normpath(network_or_local_path.replace('\\', '/')) # Ưu tiên dùng /
-
-        # Nếu là đường dẫn UNC, cố gắng chuyển đổi
-        unc_base = os.path.normpath(fr"\\{os.getenv('LINUX_SERVER_IP', '0.0.0.0')}\{os.getenv('SAMBA_SHARE_NAME', 'AudioOutput')}".replace('\\','/'))
-        if normalized_path.lower().startswith(unc_base.lower()):
-             relative_path = normalized_path[len(unc_base):].lstrip('/')
-             static_path = f"{static_audio_rel_path}/{relative_path}".replace("\\", "/")
-             logging.debug(f"Converted UNC '{network_or_local_path}' to Static '{static_path}'")
-             return static_path
-
-        # Nếu là đường dẫn cục bộ Linux, kiểm tra xem có nằm trong thư mục audio không
-        normalized_local_base = os.path.normpath(audio_base_physical)
-        if normalized_path.startswith(normalized_local_base):
-             relative_path = normalized_path[len(normalized_local_base):].lstrip('/')
+        # UNC / ổ mạng -> đường dẫn vật lý trên Linux (trie + cache, không dựng lại mapping mỗi lần gọi)
+        physical_path = os.path.normpath(translator.translate(network_or_local_path))
+        audio_base_physical = translator.audio_base_physical
+        if physical_path == audio_base_physical or physical_path.startswith(audio_base_physical.rstrip('/') + '/'):
+             relative_path = physical_path[len(audio_base_physical):].lstrip('/')
              static_path = f"{static_audio_rel_path}/{relative_path}".replace("\\", "/")
-             logging.debug(f"Converted Local '{network_or_local_path}' to Static '{static_path}'")
+             logging.debug(f"Converted '{network_or_local_path}' to Static '{static_path}'")
              return static_path
 
         # Nếu không khớp, có thể là đường dẫn lỗi hoặc cấu hình sai
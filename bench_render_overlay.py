@@ -0,0 +1,114 @@
+# bench_render_overlay.py
+"""
+Benchmark tốc độ render (fps) của filter graph final_make: graph đầy đủ (scale ảnh NV + ảnh chữ,
+3 overlay) vs ảnh NV / ảnh chữ đã scale sẵn bằng Pillow (3 overlay, không scale).
+
+Tự tạo input giả lập (video nền testsrc2, video overlay, ảnh NV/chữ RGBA) trong thư mục tạm,
+chạy cùng một graph qua final_make._compose_cpu_layers cho cả hai chế độ và đo fps.
+
+Ví dụ:
+    python bench_render_overlay.py --duration 30
+    python bench_render_overlay.py --resolution 1280x720 --encode   # đo cả encode libx264
+"""
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Dict
+
+import ffmpeg
+from PIL import Image, ImageDraw
+
+import final_make
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def _make_inputs(work_dir: str, width: int, height: int, fps: int, duration: float) -> Dict[str, str]:
+    """Tạo video nền, video overlay và 2 ảnh RGBA giả lập."""
+    inputs = {
+        "background": os.path.join(work_dir, "bg.mp4"),
+        "overlay_video": os.path.join(work_dir, "overlay.mp4"),
+        "overlay_image": os.path.join(work_dir, "character.png"),
+        "text_image": os.path.join(work_dir, "text.png"),
+    }
+    for source, path in (("testsrc2", inputs["background"]), ("rgbtestsrc", inputs["overlay_video"])):
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"{source}=size={width}x{height}:rate={fps}",
+             "-t", str(duration), "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", path],
+            check=True
+        )
+    # Ảnh NV: cao hơn khung hình để buộc phải scale (như ảnh thật)
+    character = Image.new("RGBA", (int(height * 0.9), int(height * 1.4)), (0, 0, 0, 0))
+    ImageDraw.Draw(character).ellipse((0, 0, character.width - 1, character.height - 1), fill=(200, 120, 80, 255))
+    character.save(inputs["overlay_image"])
+    text = Image.new("RGBA", (width * 2, height // 2), (0, 0, 0, 0))
+    ImageDraw.Draw(text).rectangle((20, 20, text.width - 20, text.height - 20), fill=(255, 255, 255, 220))
+    text.save(inputs["text_image"])
+    return inputs
+
+
+def _bench_config(width: int, height: int, fps: int) -> Dict:
+    return {
+        "target_width": width, "target_height": height, "resolution": f"{width}x{height}", "framerate": fps,
+        "overlay_char_width": int(width * 0.4), "overlay_text_width": int(width * 0.6),
+        "margin_left": 15, "margin_right": 15, "overlay_opacity": 0.25, "preset": "veryfast",
+    }
+
+
+def run_mode(name: str, inputs: Dict[str, str], config: Dict, duration: float, encode: bool,
+             static_layers: Dict[str, str] = None) -> float:
+    background = ffmpeg.input(inputs["background"]).trim(duration=duration).filter('setpts', 'PTS-STARTPTS')
+    overlay_video = ffmpeg.input(inputs["overlay_video"], stream_loop=-1).trim(duration=duration).filter('setpts', 'PTS-STARTPTS')
+    image_source = static_layers or inputs
+    final_video = final_make._compose_cpu_layers(
+        background, overlay_video, ffmpeg.input(image_source["overlay_image"]), ffmpeg.input(image_source["text_image"]),
+        config, prescaled=static_layers is not None
+    )
+    if encode:
+        stream = ffmpeg.output(final_video, "-", format="null", vcodec="libx264", preset=config["preset"], pix_fmt="yuv420p")
+    else:
+        stream = ffmpeg.output(final_video, "-", format="null")
+    cmd = ffmpeg.compile(stream.global_args("-v", "error"), cmd="ffmpeg")
+
+    start = time.perf_counter()
+    subprocess.run(cmd, check=True)
+    elapsed = time.perf_counter() - start
+    fps = duration * config["framerate"] / elapsed
+    logging.info(f"[{name}] {elapsed:.2f}s -> {fps:.1f} fps")
+    return fps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark final_make overlay graph: full graph vs pre-scaled static images.")
+    parser.add_argument("--duration", type=float, default=20.0, help="Thời lượng video thử (giây).")
+    parser.add_argument("--resolution", default="1920x1080", help="Độ phân giải đích (WxH).")
+    parser.add_argument("--fps", type=int, default=30, help="Framerate.")
+    parser.add_argument("--encode", action="store_true", help="Đo cả encode libx264 thay vì chỉ filter graph.")
+    parser.add_argument("--keep", action="store_true", help="Giữ lại thư mục input giả lập.")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.resolution.lower().split("x"))
+    config = _bench_config(width, height, args.fps)
+    work_dir = tempfile.mkdtemp(prefix="bench_render_overlay_")
+    logging.info(f"Generating synthetic inputs in {work_dir} ({args.resolution}, {args.duration}s @ {args.fps}fps)...")
+    try:
+        inputs = _make_inputs(work_dir, width, height, args.fps, args.duration)
+        before = run_mode("full graph (scale + 3 overlays)", inputs, config, args.duration, args.encode)
+
+        prepare_start = time.perf_counter()
+        static_layers = final_make.prepare_static_overlay_layers(inputs["overlay_image"], inputs["text_image"], work_dir, config)
+        logging.info(f"Static images pre-scaled in {(time.perf_counter() - prepare_start) * 1000:.0f}ms")
+        after = run_mode("pre-scaled static images (3 overlays)", inputs, config, args.duration, args.encode, static_layers)
+
+        logging.info(f"fps speedup: {after / before:.2f}x")
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# bench_tts_http.py
+"""
+Benchmark độ trễ mỗi request TTS kiểu Pollinations: requests.get trần vs Session dùng chung (keep-alive).
+
+Chạy một server giả lập cục bộ (trả về audio/mpeg giả, có độ trễ xử lý tùy chọn) rồi đo
+latency p50/p95 cho cả hai cách gọi với cùng số luồng.
+
+Ví dụ:
+    python bench_tts_http.py --requests 500 --threads 4
+    python bench_tts_http.py --tls-cert cert.pem --tls-key key.pem   # đo cả chi phí bắt tay TLS
+"""
+import argparse
+import concurrent.futures
+import logging
+import ssl
+import statistics
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+import requests
+import requests.adapters
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+FAKE_AUDIO_BYTES = b"\xff\xfb\x90\x64" + b"\x00" * (24 * 1024) # ~24KB, cỡ một sub-chunk 500 ký tự
+
+
+class _FakeTTSHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Cho phép keep-alive
+    server_delay_seconds = 0.0
+
+    def do_GET(self):
+        if self.server_delay_seconds:
+            time.sleep(self.server_delay_seconds)
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(len(FAKE_AUDIO_BYTES)))
+        self.end_headers()
+        self.wfile.write(FAKE_AUDIO_BYTES)
+
+    def log_message(self, format, *args):
+        pass # Tắt log mỗi request
+
+
+def start_fake_server(delay_seconds: float, tls_cert: str = None, tls_key: str = None):
+    """Khởi động server giả lập trên cổng ngẫu nhiên. Trả về (server, base_url)."""
+    handler = type("FakeTTSHandler", (_FakeTTSHandler,), {"server_delay_seconds": delay_seconds})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    scheme = "http"
+    if tls_cert:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(tls_cert, tls_key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://127.0.0.1:{server.server_address[1]}/"
+
+
+def _fetch(get: Callable[..., requests.Response], base_url: str, idx: int, verify) -> float:
+    text = urllib.parse.quote(f"Câu thử nghiệm số {idx} " * 20)
+    start = time.perf_counter()
+    with get(f"{base_url}{text}", params={"model": "openai-audio", "voice": "onyx"},
+             timeout=30, stream=True, verify=verify) as response:
+        response.raise_for_status()
+        for _ in response.iter_content(chunk_size=1024 * 10):
+            pass
+    return time.perf_counter() - start
+
+
+def run_mode(name: str, get: Callable[..., requests.Response], base_url: str, total: int, threads: int, verify) -> Dict[str, float]:
+    latencies: List[float] = []
+    wall_start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for latency in executor.map(lambda i: _fetch(get, base_url, i, verify), range(total)):
+            latencies.append(latency)
+    wall = time.perf_counter() - wall_start
+    latencies.sort()
+    result = {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "req_per_s": total / wall,
+    }
+    logging.info(f"[{name}] p50={result['p50_ms']:.2f}ms p95={result['p95_ms']:.2f}ms "
+                 f"mean={result['mean_ms']:.2f}ms throughput={result['req_per_s']:.1f} req/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-request latency: bare requests.get vs pooled Session.")
+    parser.add_argument("--requests", type=int, default=300, help="Số request cho mỗi chế độ.")
+    parser.add_argument("--threads", type=int, default=4, help="Số luồng gửi đồng thời.")
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="Độ trễ xử lý giả lập của server (ms).")
+    parser.add_argument("--pool-size", type=int, default=8, help="pool_maxsize của HTTPAdapter (như TTS_HTTP_POOL_SIZE).")
+    parser.add_argument("--tls-cert", help="File cert để chạy server HTTPS (đo cả bắt tay TLS).")
+    parser.add_argument("--tls-key", help="File key đi kèm --tls-cert.")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server(args.delay_ms / 1000.0, args.tls_cert, args.tls_key)
+    verify = False if args.tls_cert else True
+    if args.tls_cert:
+        requests.packages.urllib3.disable_warnings() # Cert tự ký
+    logging.info(f"Fake TTS server at {base_url} ({args.requests} requests x {args.threads} threads per mode)")
+
+    try:
+        before = run_mode("bare requests.get", requests.get, base_url, args.requests, args.threads, verify)
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=args.pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        after = run_mode("shared Session", session.get, base_url, args.requests, args.threads, verify)
+        session.close()
+
+        logging.info(f"p50 speedup: {before['p50_ms'] / after['p50_ms']:.2f}x, "
+                     f"throughput speedup: {after['req_per_s'] / before['req_per_s']:.2f}x")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Thư viện video nền đã chuẩn hóa (bg library).
+
+Mỗi clip trong VIDEO_FOLDER được transcode MỘT lần sang định dạng chuẩn (độ phân giải, fps,
+pix_fmt, GOP, codec giống nhau) và lưu trong BG_LIBRARY_DIR. Tên file chuẩn hóa là hash của
+(đường dẫn nguồn + mtime + thông số chuẩn) -> clip nguồn thay đổi hoặc đổi thông số sẽ tự tạo bản mới.
+
+Khi mọi clip nền cùng định dạng, concat demuxer nối chúng không cần chuyển đổi và giải mã rẻ hơn
+(không còn scale/đổi fps cho từng clip khi render).
+
+Chạy offline:
+    python bg_library.py                      # Chuẩn hóa toàn bộ VIDEO_FOLDER
+    python bg_library.py --workers 4 --prune  # Song song 4 tiến trình, xóa bản chuẩn hóa cũ
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import subprocess
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm")
+NORMALIZED_EXTENSION = ".mp4"
+DEFAULT_LIBRARY_SUBDIR = "_normalized"
+
+
+def get_library_spec(resolution=None, framerate=None, gop_seconds=None):
+    """Thông số chuẩn của thư viện (mặc định lấy từ .env giống final_make)."""
+    resolution = resolution or os.getenv("TARGET_RESOLUTION", "1920x1080")
+    framerate = int(framerate or os.getenv("VIDEO_FRAMERATE", 30))
+    gop_seconds = float(gop_seconds or os.getenv("RENDER_SEGMENT_GOP_SECONDS", 2))
+    return {
+        "resolution": resolution,
+        "framerate": framerate,
+        "gop": max(1, int(round(framerate * gop_seconds))),
+        "pix_fmt": "yuv420p",
+        "vcodec": "libx264",
+        "preset": os.getenv("BG_LIBRARY_PRESET", "medium"),
+        "crf": int(os.getenv("BG_LIBRARY_CRF", 20)),
+    }
+
+
+def get_library_dir(video_folder, library_dir=None):
+    """Thư mục thư viện: BG_LIBRARY_DIR hoặc <VIDEO_FOLDER>/_normalized."""
+    return os.path.abspath(library_dir or os.getenv("BG_LIBRARY_DIR") or os.path.join(video_folder, DEFAULT_LIBRARY_SUBDIR))
+
+
+def _spec_signature(spec):
+    return "|".join(f"{key}={spec[key]}" for key in sorted(spec))
+
+
+def normalized_path_for(source_path, library_dir, spec):
+    """Đường dẫn bản chuẩn hóa của một clip nguồn (key = path + mtime + thông số chuẩn)."""
+    abs_source = os.path.abspath(source_path)
+    key_material = f"{abs_source}|{os.path.getmtime(abs_source)}|{_spec_signature(spec)}"
+    key = hashlib.sha1(key_material.encode("utf-8")).hexdigest()
+    return os.path.join(library_dir, f"{key}{NORMALIZED_EXTENSION}")
+
+
+def list_source_clips(video_folder):
+    """Liệt kê clip nguồn (không đệ quy, bỏ qua thư mục thư viện)."""
+    return [
+        os.path.join(video_folder, f)
+        for f in sorted(os.listdir(video_folder))
+        if f.lower().endswith(VIDEO_EXTENSIONS) and os.path.isfile(os.path.join(video_folder, f))
+    ]
+
+
+def normalize_clip(source_path, output_path, spec):
+    """
+    Transcode một clip sang định dạng chuẩn (không audio, GOP cố định, keyframe đều).
+    Ghi ra file tạm rồi rename nguyên tử -> worker render không bao giờ thấy file dở dang.
+
+    Returns:
+        tuple: (thành công, stderr nếu lỗi).
+    """
+    width, height = spec["resolution"].lower().split("x")
+    temp_output = f"{output_path}.partial{NORMALIZED_EXTENSION}"
+    cmd = [
+        "ffmpeg", "-v", "error", "-y", "-i", source_path,
+        # Kéo giãn về đúng khung hình như khi render (-s), đổi fps và pix_fmt một lần duy nhất
+        "-vf", f"scale={width}:{height},fps={spec['framerate']},format={spec['pix_fmt']}",
+        "-an", "-c:v", spec["vcodec"], "-preset", spec["preset"], "-crf", str(spec["crf"]),
+        "-g", str(spec["gop"]), "-keyint_min", str(spec["gop"]), "-sc_threshold", "0",
+        "-movflags", "+faststart", temp_output,
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="replace", check=False)
+    if result.returncode != 0 or not os.path.exists(temp_output) or os.path.getsize(temp_output) <= 100:
+        if os.path.exists(temp_output):
+            os.remove(temp_output)
+        return False, result.stderr
+    os.replace(temp_output, output_path)
+    return True, None
+
+
+def resolve_normalized_clips(source_paths, library_dir, spec):
+    """
+    Map clip nguồn -> bản chuẩn hóa đã có trong thư viện.
+
+    Returns:
+        dict: {đường dẫn nguồn: đường dẫn chuẩn hóa} chỉ cho các clip đã được chuẩn hóa.
+    """
+    resolved = {}
+    if not os.path.isdir(library_dir):
+        return resolved
+    for source_path in source_paths:
+        try:
+            normalized = normalized_path_for(source_path, library_dir, spec)
+        except OSError:
+            continue
+        if os.path.exists(normalized):
+            resolved[source_path] = normalized
+    return resolved
+
+
+def normalize_library(video_folder, library_dir=None, spec=None, workers=2, prune=False):
+    """
+    Chuẩn hóa mọi clip chưa có trong thư viện.
+
+    Returns:
+        dict: Thống kê {"total", "skipped", "normalized", "failed", "pruned"}.
+    """
+    spec = spec or get_library_spec()
+    library_dir = get_library_dir(video_folder, library_dir)
+    os.makedirs(library_dir, exist_ok=True)
+    sources = list_source_clips(video_folder)
+    stats = {"total": len(sources), "skipped": 0, "normalized": 0, "failed": 0, "pruned": 0}
+    print(f"--- Chuẩn hóa thư viện video nền: {len(sources)} clip -> {library_dir} ---")
+    print(f"-> Thông số: {spec}")
+
+    pending = {}
+    for source_path in sources:
+        target = normalized_path_for(source_path, library_dir, spec)
+        if os.path.exists(target):
+            stats["skipped"] += 1
+        else:
+            pending[source_path] = target
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(normalize_clip, src, dst, spec): src for src, dst in pending.items()}
+        for future in concurrent.futures.as_completed(futures):
+            source_path = futures[future]
+            ok, stderr = future.result()
+            if ok:
+                stats["normalized"] += 1
+                print(f"-> [{stats['normalized'] + stats['failed']}/{len(pending)}] OK: {os.path.basename(source_path)}")
+            else:
+                stats["failed"] += 1
+                print(f"!!! Lỗi chuẩn hóa {os.path.basename(source_path)}:\n{stderr}")
+
+    if prune:
+        # Xóa bản chuẩn hóa không còn ứng với clip nguồn hiện tại (clip bị xóa/sửa hoặc đổi thông số)
+        expected = {os.path.basename(normalized_path_for(src, library_dir, spec)) for src in sources}
+        for name in os.listdir(library_dir):
+            if name.endswith(NORMALIZED_EXTENSION) and name not in expected:
+                try:
+                    os.remove(os.path.join(library_dir, name))
+                    stats["pruned"] += 1
+                except OSError as e:
+                    print(f"CB: Không xóa được {name}: {e}")
+
+    print(f"--- Xong trong {time.time() - start_time:.1f}s: {stats} ---")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Normalize background clips into a canonical-format library.")
+    parser.add_argument("--folder", default=os.getenv("VIDEO_FOLDER"), help="Thư mục clip nguồn (mặc định VIDEO_FOLDER).")
+    parser.add_argument("--library-dir", default=None, help="Thư mục thư viện (mặc định BG_LIBRARY_DIR hoặc <folder>/_normalized).")
+    parser.add_argument("--workers", type=int, default=2, help="Số tiến trình ffmpeg chạy song song.")
+    parser.add_argument("--prune", action="store_true", help="Xóa các bản chuẩn hóa cũ không còn dùng.")
+    args = parser.parse_args()
+    if not args.folder or not os.path.isdir(args.folder):
+        parser.error("Cần --folder hoặc VIDEO_FOLDER trỏ tới thư mục clip nguồn hợp lệ.")
+    stats = normalize_library(args.folder, args.library_dir, workers=args.workers, prune=args.prune)
+    raise SystemExit(1 if stats["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -394,8 +394,11 @@ def add_new_quote_or_story(topic, language, script_name, generation_id, chunk_si
 
 # --- Hàm Điều Phối Tạo Content Dài TỪ OUTLINE (cho task 'from_topic') ---
 def generate_long_text(flat_outline_items, topic_input, language, script_name, gen_id_obj,
-                       num_quotes, num_stories, min_chars, chunk_words, model):
-    """Tạo nội dung dài từ list phẳng, đảm bảo min_chars bằng cách đếm ký tự."""
+                       num_quotes, num_stories, min_chars, chunk_words, model, should_stop=None):
+    """
+    Tạo nội dung dài từ list phẳng, đảm bảo min_chars bằng cách đếm ký tự.
+    should_stop (callable, optional): kiểm tra giữa các mục (vd: lease đã mất); True -> dừng, trả về False.
+    """
     if not flat_outline_items:
         logging.error(f"Gen {gen_id_obj}: Flattened outline is empty. Cannot generate text.")
         return False
@@ -432,6 +435,10 @@ def generate_long_text(flat_outline_items, topic_input, language, script_name, g
                 for item_data in items_to_generate
             ]
             for future in concurrent.futures.as_completed(futures):
+                if should_stop is not None and should_stop():
+                    logging.warning(f"Gen {gen_id_obj}: stop requested. Cancelling remaining outline items.")
+                    for pending_future in futures: pending_future.cancel()
+                    generation_successful = False; break
                 try:
                     index, title, level, content, item_type = future.result()
                     if content and not content.startswith("Lỗi:"):
@@ -449,6 +456,9 @@ def generate_long_text(flat_outline_items, topic_input, language, script_name, g
 
         while iteration_count < max_iterations_add:
             iteration_count += 1
+            if should_stop is not None and should_stop():
+                logging.warning(f"Gen {gen_id_obj}: stop requested. Stopping length check.")
+                generation_successful = False; break
             # Kiểm tra status task
             current_status_doc = content_generations_coll.find_one({"_id": gen_id_obj}, {"status": 1})
             if not current_status_doc or current_status_doc.get('status') in ['content_failed', 'deleted', 'reset']:
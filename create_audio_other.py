@@ -6,7 +6,6 @@ import time
 import datetime
 from bson.objectid import ObjectId
 from pymongo import ReturnDocument
-import schedule
 import concurrent.futures # <<< Giữ lại đa luồng
 import os
 from dotenv import load_dotenv
@@ -22,8 +21,13 @@ try:
         get_voice_settings,
         create_audio_for_chunk,
         combine_audio_from_db,
+        get_provider_rate_limiter,
+        get_rate_limiter_metrics,
         VOICE_CONFIG # Lấy config đã load
     )
+    from tts_async import AUDIO_TTS_ENGINE, run_synthesize_chunks
+    from task_dispatcher import start_dispatcher, STAGE_AUDIO_OTHER
+    from task_lease import claim_with_lease, stealable_query, lease_filter, lease_lost, AUDIO_LOCKED_STATUSES
 except ImportError as e:
     logging.critical(f"CRITICAL: Failed to import required modules: {e}. Worker cannot start.")
     exit(1)
@@ -54,8 +58,11 @@ except Exception as e:
      exit(1)
 
 # --- Hàm xử lý một task Ngôn ngữ khác (Đa luồng tạo Chunk) ---
-def process_audio_task_multi_thread(generation_doc):
-    """Xử lý tạo audio ĐA LUỒNG cho một generation task."""
+def process_audio_task_multi_thread(generation_doc, lease=None):
+    """
+    Xử lý tạo audio ĐA LUỒNG cho một generation task.
+    lease (TaskLease, optional): mọi lần ghi status chỉ áp dụng khi còn giữ lease; lease mất -> dừng giữa các chunk.
+    """
     generation_id_obj = generation_doc["_id"]
     generation_id = str(generation_id_obj)
     script_name = generation_doc.get("script_name")
@@ -67,7 +74,7 @@ def process_audio_task_multi_thread(generation_doc):
         logger_other.error(err_msg)
         # Trả lại trạng thái cũ để task không bị kẹt lock
         content_generations_collection.update_one(
-             {"_id": generation_id_obj, "status": "audio_processing_lock"},
+             lease_filter(generation_id_obj, lease, {"status": "audio_processing_lock"}),
              {"$set": {"status": generation_doc.get("status_before_lock", "content_ready")}} # Giả sử có lưu status trước đó, nếu không trả về content_ready
         )
         return False
@@ -79,7 +86,7 @@ def process_audio_task_multi_thread(generation_doc):
 
     # Cập nhật trạng thái
     content_generations_collection.update_one(
-        {"_id": generation_id_obj},
+        lease_filter(generation_id_obj, lease),
         {"$set": {"status": "audio_generating", "updated_at": datetime.datetime.now(datetime.timezone.utc)}}
     )
 
@@ -91,7 +98,7 @@ def process_audio_task_multi_thread(generation_doc):
         }).sort("section_index", 1))
     except Exception as e:
          logger_other.error(f"Error finding chunks for gen {generation_id}: {e}")
-         content_generations_collection.update_one({"_id": generation_id_obj}, {"$set": {"status": "audio_failed", "error_details": {"stage":"find_chunks", "message":str(e)}}})
+         content_generations_collection.update_one(lease_filter(generation_id_obj, lease), {"$set": {"status": "audio_failed", "error_details": {"stage":"find_chunks", "message":str(e)}}})
          return False
 
 
@@ -99,29 +106,53 @@ def process_audio_task_multi_thread(generation_doc):
 
     # --- TẠO AUDIO ĐA LUỒNG (CHO CHUNKS) ---
     if pending_chunks:
-        # Số luồng tối đa để tạo chunk audio cùng lúc
-        max_chunk_workers = int(os.getenv("AUDIO_MAX_CONCURRENT_CHUNKS", 4))
+        # Số luồng tối đa để tạo chunk audio cùng lúc. Mặc định bằng trần đồng thời của limiter
+        # provider: limiter tự điều chỉnh số request thực gửi đi, luồng dư chỉ xếp hàng chờ
+        provider_limiter = get_provider_rate_limiter(voice_settings.get("provider", ""))
+        max_chunk_workers = int(os.getenv("AUDIO_MAX_CONCURRENT_CHUNKS", provider_limiter.max_concurrency))
         any_chunk_failed_this_run = False # Cờ theo dõi lỗi trong đợt chạy này
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_chunk_workers) as executor:
-            # Truyền voice_settings vào create_audio_for_chunk
-            futures = [executor.submit(create_audio_for_chunk, chunk["_id"], script_name, voice_settings)
-                       for chunk in pending_chunks]
-
-            processed_count = 0
-            for future in concurrent.futures.as_completed(futures):
-                processed_count += 1
-                try:
-                    chunk_id, success, _ = future.result()
+        if AUDIO_TTS_ENGINE == "async":
+            # Engine asyncio: mọi sub-chunk của task chạy trên một event loop, DB update gom theo lô
+            logger_other.info(f"Using async TTS engine for {len(pending_chunks)} chunks of {generation_id}.")
+            try:
+                for chunk_id, success, _ in run_synthesize_chunks(pending_chunks, voice_settings, script_name,
+                                                                  should_stop=lambda: lease_lost(lease)):
                     if not success:
+                        any_chunk_failed_this_run = True
+                        logger_other.error(f"Audio gen FAILED permanently for chunk {chunk_id}.")
+            except Exception as e:
+                any_chunk_failed_this_run = True
+                logger_other.error(f"Async TTS engine failed for {generation_id}: {e}", exc_info=True)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_chunk_workers) as executor:
+                # Truyền voice_settings vào create_audio_for_chunk
+                futures = [executor.submit(create_audio_for_chunk, chunk["_id"], script_name, voice_settings)
+                           for chunk in pending_chunks]
+
+                processed_count = 0
+                for future in concurrent.futures.as_completed(futures):
+                    if lease_lost(lease): # Worker khác đã lấy task -> hủy các chunk chưa chạy
+                        for pending_future in futures:
+                            pending_future.cancel()
+                        break
+                    processed_count += 1
+                    try:
+                        chunk_id, success, _ = future.result()
+                        if not success:
+                             any_chunk_failed_this_run = True
+                             logger_other.error(f"Audio gen FAILED permanently for chunk {chunk_id}.")
+                    except Exception as e:
+                         # Lỗi này là do tenacity raise sau khi hết retry
                          any_chunk_failed_this_run = True
-                         logger_other.error(f"Audio gen FAILED permanently for chunk {chunk_id}.")
-                except Exception as e:
-                     # Lỗi này là do tenacity raise sau khi hết retry
-                     any_chunk_failed_this_run = True
-                     logger_other.error(f"Future for audio chunk failed after retries: {e}") # Không cần exc_info vì tenacity đã log rồi
-            logger_other.info(f"Finished processing {processed_count} audio futures for {generation_id}.")
+                         logger_other.error(f"Future for audio chunk failed after retries: {e}") # Không cần exc_info vì tenacity đã log rồi
+                logger_other.info(f"Finished processing {processed_count} audio futures for {generation_id}.")
+        logger_other.info(f"TTS rate limiter metrics: {get_rate_limiter_metrics()}")
     else:
          any_chunk_failed_this_run = False # Không có chunk nào cần chạy
+    if lease_lost(lease):
+        # Worker khác đã lấy task: dừng, không ghép audio và không ghi đè status của chủ mới
+        logger_other.warning(f"Lease for {generation_id} was lost. Stopping without updating status.")
+        return False
 
 
     # --- Kiểm tra lại trạng thái chunks và cập nhật status ---
@@ -131,7 +162,7 @@ def process_audio_task_multi_thread(generation_doc):
         error_chunks_count = script_chunks_collection.count_documents({"generation_id": generation_id_obj, "audio_error": {"$ne": None}})
     except Exception as e:
          logger_other.error(f"Error counting chunks for gen {generation_id}: {e}")
-         content_generations_collection.update_one({"_id": generation_id_obj}, {"$set": {"status": "audio_failed", "error_details": {"stage":"count_chunks", "message":str(e)}}})
+         content_generations_collection.update_one(lease_filter(generation_id_obj, lease), {"$set": {"status": "audio_failed", "error_details": {"stage":"count_chunks", "message":str(e)}}})
          return False
 
     logger_other.info(f"Audio check for {generation_id}: Total={total_chunks}, Done={all_chunks_done}, Errors={error_chunks_count}")
@@ -162,7 +193,10 @@ def process_audio_task_multi_thread(generation_doc):
     elif final_status == 'completed': update_data["error_details"] = None
 
     try:
-        content_generations_collection.update_one({"_id": generation_id_obj}, {"$set": update_data})
+        result = content_generations_collection.update_one(lease_filter(generation_id_obj, lease), {"$set": update_data})
+        if result.matched_count == 0:
+            logger_other.warning(f"Final status for {generation_id} not written: lease no longer owned by this worker.")
+            return False
         logger_other.info(f"--- Processing Other Lang Audio Task Finished: {generation_id} with Status: {final_status} ---")
         return final_status not in ["audio_failed", "unknown"] # Thành công nếu không lỗi
     except Exception as e:
@@ -181,7 +215,8 @@ def job_other():
     try:
         tasks_to_process_cursor = content_generations_coll_job.find({
             "language": {"$ne": "Vietnamese"}, # <<< KHÔNG LẤY TIẾNG VIỆT
-            "$or": [{"status": "content_ready"}, {"status": "audio_failed"}]
+            "$or": [{"status": "content_ready"}, {"status": "audio_failed"},
+                    stealable_query({"status": {"$in": AUDIO_LOCKED_STATUSES}})] # Lease hết hạn -> lấy lại
         }).sort([("priority", -1), ("created_at", 1)]).limit(10) # Giới hạn số task/lần
 
         processed_count = 0
@@ -189,20 +224,24 @@ def job_other():
         for task_doc in tasks_to_process_cursor:
             gen_id = task_doc['_id']
             logger_other.info(f"Found other lang task {gen_id}, attempting to lock...")
-            # Lock task
-            result = content_generations_coll_job.find_one_and_update(
-                 {"_id": gen_id, "status": {"$in": ["content_ready", "audio_failed"]}},
-                 {"$set": {"status": "audio_processing_lock", "updated_at": datetime.datetime.now(datetime.timezone.utc)}},
-                 return_document=ReturnDocument.AFTER
+            # Lock task (kèm lease; task có lease hết hạn cũng được lấy lại)
+            claimed = claim_with_lease(
+                 content_generations_coll_job,
+                 ready_query={"_id": gen_id, "status": {"$in": ["content_ready", "audio_failed"]}},
+                 locked_query={"_id": gen_id, "status": {"$in": AUDIO_LOCKED_STATUSES}},
+                 lock_set={"status": "audio_processing_lock", "updated_at": datetime.datetime.now(datetime.timezone.utc)},
+                 stage=STAGE_AUDIO_OTHER
             )
-            if result:
-                try:
-                     process_audio_task_multi_thread(result) # Xử lý task đã lock
-                     processed_count += 1
-                except Exception as e:
-                     logger_other.exception(f"CRITICAL failure processing task {gen_id}: {e}")
-                     try: content_generations_coll_job.update_one({"_id": gen_id}, {"$set": {"status": "audio_failed", "error_details": {"message": f"Worker error: {e}"}}})
-                     except Exception as db_err: logger_other.error(f"Failed to set audio_failed status for {gen_id}: {db_err}")
+            if claimed:
+                result, lease = claimed
+                with lease: # Heartbeat gia hạn lease trong suốt quá trình tạo audio
+                    try:
+                         process_audio_task_multi_thread(result, lease) # Xử lý task đã lock
+                         processed_count += 1
+                    except Exception as e:
+                         logger_other.exception(f"CRITICAL failure processing task {gen_id}: {e}")
+                         try: content_generations_coll_job.update_one(lease_filter(gen_id, lease), {"$set": {"status": "audio_failed", "error_details": {"message": f"Worker error: {e}"}}})
+                         except Exception as db_err: logger_other.error(f"Failed to set audio_failed status for {gen_id}: {db_err}")
             else:
                  logger_other.info(f"Task {gen_id} lock failed or status changed. Skipping.")
 
@@ -216,9 +255,8 @@ if __name__ == "__main__":
     RUN_INTERVAL_MINUTES = int(os.getenv("OTHER_AUDIO_INTERVAL_MINUTES", 10)) # Lấy từ env, mặc định 10 phút
     logging.info(f"Starting Other Languages Audio Worker (Interval: {RUN_INTERVAL_MINUTES} minutes)...")
 
-    job_other() # Chạy ngay lần đầu
-
-    schedule.every(RUN_INTERVAL_MINUTES).minutes.do(job_other)
+    # Dispatcher đánh thức job ngay khi có task sẵn sàng; RUN_INTERVAL_MINUTES chỉ còn là chu kỳ quét dự phòng
+    dispatcher = start_dispatcher(content_generations_collection, stages=[STAGE_AUDIO_OTHER])
     while True:
-        schedule.run_pending()
-        time.sleep(1)
\ No newline at end of file
+        job_other()
+        dispatcher.wait(STAGE_AUDIO_OTHER, timeout=RUN_INTERVAL_MINUTES * 60)
\ No newline at end of file
@@ -6,8 +6,8 @@ import time
 import datetime
 from bson.objectid import ObjectId
 from pymongo import ReturnDocument
-import schedule
 import os
+import concurrent.futures
 from dotenv import load_dotenv
 
 # Import từ các module khác
@@ -23,8 +23,13 @@ try:
         get_voice_settings,
         create_audio_for_chunk,
         combine_audio_from_db,
+        get_provider_rate_limiter,
+        get_rate_limiter_metrics,
         VOICE_CONFIG # Lấy config giọng đọc đã load sẵn
     )
+    from tts_async import AUDIO_TTS_ENGINE, run_synthesize_chunks
+    from task_dispatcher import start_dispatcher, STAGE_AUDIO_VI
+    from task_lease import claim_with_lease, stealable_query, lease_filter, lease_lost, AUDIO_LOCKED_STATUSES
 except ImportError as e:
     logging.critical(f"CRITICAL: Failed to import required modules: {e}. Worker cannot start.")
     exit(1)
@@ -54,9 +59,54 @@ except Exception as e:
     logger_vi.critical(f"Unexpected error during DB initialization: {e}", exc_info=True)
     exit(1)
 
-# --- Hàm xử lý một task Tiếng Việt (Tuần tự) ---
-def process_audio_task_single_thread(generation_doc):
-    """Xử lý tạo audio TUẦN TỰ cho một generation task Tiếng Việt."""
+# --- Cấu hình đồng thời ---
+# Chế độ tạo chunk: "sequential" (từng chunk, như cũ), "threaded" (pool luồng) hoặc "async" (tts_async)
+VI_AUDIO_CONCURRENCY_MODES = ("sequential", "threaded", "async")
+VI_AUDIO_CONCURRENCY_MODE = os.getenv("VI_AUDIO_CONCURRENCY_MODE", "async" if AUDIO_TTS_ENGINE == "async" else "threaded").strip().lower()
+if VI_AUDIO_CONCURRENCY_MODE not in VI_AUDIO_CONCURRENCY_MODES:
+    logger_vi.critical(f"Invalid VI_AUDIO_CONCURRENCY_MODE '{VI_AUDIO_CONCURRENCY_MODE}' (expected one of: {', '.join(VI_AUDIO_CONCURRENCY_MODES)}).")
+    exit(1)
+# Số chunk chạy song song trong chế độ "threaded" (mặc định = trần đồng thời của limiter provider,
+# số request thực gửi tới provider do limiter quyết định, xem "__RATE_LIMITS__" trong voice_config.json)
+VI_AUDIO_MAX_CONCURRENT_CHUNKS = os.getenv("VI_AUDIO_MAX_CONCURRENT_CHUNKS")
+# Số generation Tiếng Việt xử lý cùng lúc trong một lần chạy job
+VI_AUDIO_MAX_CONCURRENT_TASKS = int(os.getenv("VI_AUDIO_MAX_CONCURRENT_TASKS", 2))
+
+
+def _create_chunks_threaded(pending_chunks, script_name, voice_settings, generation_id, lease=None):
+    """Tạo audio cho các chunk bằng pool luồng. Trả về True nếu có chunk lỗi. Lease mất -> hủy các chunk chưa chạy."""
+    provider_limiter = get_provider_rate_limiter(voice_settings.get("provider", ""))
+    max_chunk_workers = int(VI_AUDIO_MAX_CONCURRENT_CHUNKS or provider_limiter.max_concurrency)
+    logger_vi.info(f"Generating {len(pending_chunks)} chunks of {generation_id} with {max_chunk_workers} threads (Prov: {provider_limiter.name}).")
+    any_chunk_failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_chunk_workers), thread_name_prefix="vi_chunk") as executor:
+        future_to_chunk_id = {executor.submit(create_audio_for_chunk, chunk["_id"], script_name, voice_settings): chunk["_id"]
+                              for chunk in pending_chunks}
+        for future in concurrent.futures.as_completed(future_to_chunk_id):
+            if lease_lost(lease):
+                for pending_future in future_to_chunk_id:
+                    pending_future.cancel()
+                break
+            chunk_id = future_to_chunk_id[future]
+            try:
+                _cid, success, _fpath = future.result()
+                if not success:
+                    any_chunk_failed = True
+                    logger_vi.error(f"Audio generation FAILED for chunk {chunk_id}.")
+            except Exception as e:
+                # Lỗi này thường là tenacity đã raise sau khi hết retry
+                any_chunk_failed = True
+                logger_vi.error(f"Audio generation FAILED for chunk {chunk_id} after retries: {e}")
+    return any_chunk_failed
+
+
+# --- Hàm xử lý một task Tiếng Việt ---
+def process_audio_task_single_thread(generation_doc, lease=None):
+    """
+    Xử lý tạo audio cho một generation task Tiếng Việt.
+    Các chunk được tạo theo VI_AUDIO_CONCURRENCY_MODE (tên hàm giữ nguyên để tương thích).
+    lease (TaskLease, optional): mọi lần ghi status chỉ áp dụng khi còn giữ lease; lease mất -> dừng giữa các chunk.
+    """
     generation_id_obj = generation_doc["_id"]
     generation_id = str(generation_id_obj)
     script_name = generation_doc.get("script_name")
@@ -67,7 +117,7 @@ def process_audio_task_single_thread(generation_doc):
         logger_vi.error(f"Task {generation_id} is not Vietnamese, skipping in Vietnamese worker.")
         # Unlock task nếu bị lock nhầm
         content_generations_collection.update_one(
-            {"_id": generation_id_obj, "status": "audio_processing_lock"},
+            lease_filter(generation_id_obj, lease, {"status": "audio_processing_lock"}),
             {"$set": {"status": "content_ready"}} # Trả về content_ready để worker khác xử lý
         )
         return False
@@ -76,7 +126,7 @@ def process_audio_task_single_thread(generation_doc):
         err_msg = f"Missing script_name in generation doc {generation_id}"
         logger_vi.error(f"Cannot process audio: {err_msg}")
         content_generations_collection.update_one(
-             {"_id": generation_id_obj},
+             lease_filter(generation_id_obj, lease),
              {"$set": {"status": "audio_failed", "error_details": {"stage": "audio_setup", "message": err_msg}, "updated_at": datetime.datetime.now(datetime.timezone.utc)}}
          )
         return False
@@ -88,7 +138,7 @@ def process_audio_task_single_thread(generation_doc):
 
     # Cập nhật trạng thái bắt đầu
     content_generations_collection.update_one(
-        {"_id": generation_id_obj},
+        lease_filter(generation_id_obj, lease),
         {"$set": {"status": "audio_generating", "updated_at": datetime.datetime.now(datetime.timezone.utc)}}
     )
 
@@ -101,16 +151,36 @@ def process_audio_task_single_thread(generation_doc):
     except Exception as e:
         logger_vi.error(f"Error finding chunks for gen {generation_id}: {e}")
         content_generations_collection.update_one(
-            {"_id": generation_id_obj},
+            lease_filter(generation_id_obj, lease),
             {"$set": {"status": "audio_failed", "error_details": {"stage":"find_chunks", "message":str(e)}}}
         )
         return False
 
     logger_vi.info(f"Found {len(pending_chunks)} Vietnamese chunks needing audio for {generation_id}.")
 
-    # --- TẠO AUDIO TUẦN TỰ ---
     any_chunk_failed = False
+    if VI_AUDIO_CONCURRENCY_MODE == "async" and pending_chunks:
+        # --- TẠO AUDIO BẰNG ENGINE ASYNC ---
+        logger_vi.info(f"Using async TTS engine for {len(pending_chunks)} chunks of {generation_id}.")
+        try:
+            for chunk_id, success, _fpath in run_synthesize_chunks(pending_chunks, voice_settings, script_name,
+                                                                     should_stop=lambda: lease_lost(lease)):
+                if not success:
+                    any_chunk_failed = True
+                    logger_vi.error(f"Audio generation FAILED for chunk {chunk_id}.")
+        except Exception as e:
+            any_chunk_failed = True
+            logger_vi.error(f"Async TTS engine failed for {generation_id}: {e}", exc_info=True)
+        pending_chunks = [] # Đã xử lý xong, bỏ qua vòng lặp tuần tự bên dưới
+    elif VI_AUDIO_CONCURRENCY_MODE == "threaded" and pending_chunks:
+        # --- TẠO AUDIO ĐA LUỒNG ---
+        any_chunk_failed = _create_chunks_threaded(pending_chunks, script_name, voice_settings, generation_id, lease)
+        pending_chunks = []
+
+    # --- TẠO AUDIO TUẦN TỰ ---
     for chunk in pending_chunks:
+        if lease_lost(lease):
+            break
         chunk_id = chunk["_id"]
         logger_vi.info(f"Processing chunk {chunk_id} (Index: {chunk.get('section_index')})...")
         try:
@@ -130,6 +200,12 @@ def process_audio_task_single_thread(generation_doc):
 
         # KHÔNG CẦN sleep ở đây vì đang chạy tuần tự, hàm TTS đã block
 
+    logger_vi.info(f"TTS rate limiter metrics: {get_rate_limiter_metrics()}")
+    if lease_lost(lease):
+        # Worker khác đã lấy task: dừng, không ghép audio và không ghi đè status của chủ mới
+        logger_vi.warning(f"Lease for {generation_id} was lost. Stopping without updating status.")
+        return False
+
     # --- Kiểm tra lại trạng thái chunks và cập nhật status ---
     try:
         all_chunks_done = script_chunks_collection.count_documents({"generation_id": generation_id_obj, "audio_created": True, "audio_error": None})
@@ -138,7 +214,7 @@ def process_audio_task_single_thread(generation_doc):
     except Exception as e:
         logger_vi.error(f"Error counting chunks for gen {generation_id}: {e}")
         content_generations_collection.update_one(
-            {"_id": generation_id_obj},
+            lease_filter(generation_id_obj, lease),
             {"$set": {"status": "audio_failed", "error_details": {"stage":"count_chunks", "message":str(e)}}}
         )
         return False
@@ -180,7 +256,10 @@ def process_audio_task_single_thread(generation_doc):
     elif final_status == 'completed': update_data["error_details"] = None
 
     try:
-        content_generations_collection.update_one({"_id": generation_id_obj}, {"$set": update_data})
+        result = content_generations_collection.update_one(lease_filter(generation_id_obj, lease), {"$set": update_data})
+        if result.matched_count == 0:
+            logger_vi.warning(f"Final status for {generation_id} not written: lease no longer owned by this worker.")
+            return False
         logger_vi.info(f"--- Processing Vietnamese Audio Task Finished: {generation_id} with Status: {final_status} ---")
         return final_status not in ["audio_failed", "unknown"] # Trả về thành công nếu không lỗi
     except Exception as e:
@@ -189,6 +268,32 @@ def process_audio_task_single_thread(generation_doc):
 
 
 # --- Hàm Job chạy định kỳ ---
+def _lock_and_process_task(content_generations_coll_job, gen_id) -> bool:
+    """Lock một task Tiếng Việt rồi xử lý. Trả về True nếu task đã được lock và xử lý."""
+    logger_vi.info(f"Found Vietnamese task {gen_id}, attempting to lock...")
+    # Lock task ngay trước khi xử lý (không giữ lock cho task còn đang xếp hàng).
+    # Task đang xử lý mà lease đã hết hạn (worker chết) cũng được lấy lại ở đây.
+    claimed = claim_with_lease(
+         content_generations_coll_job,
+         ready_query={"_id": gen_id, "status": {"$in": ["content_ready", "audio_failed"]}},
+         locked_query={"_id": gen_id, "status": {"$in": AUDIO_LOCKED_STATUSES}},
+         lock_set={"status": "audio_processing_lock", "updated_at": datetime.datetime.now(datetime.timezone.utc)},
+         stage=STAGE_AUDIO_VI
+    )
+    if not claimed:
+        logger_vi.info(f"Vietnamese task {gen_id} lock failed or status changed. Skipping.")
+        return False
+    result, lease = claimed
+    with lease: # Heartbeat gia hạn lease trong suốt quá trình tạo audio
+        try:
+            process_audio_task_single_thread(result, lease) # Xử lý task đã lock
+        except Exception as e:
+            logger_vi.exception(f"CRITICAL failure processing task {gen_id}: {e}")
+            try: content_generations_coll_job.update_one(lease_filter(gen_id, lease), {"$set": {"status": "audio_failed", "error_details": {"message": f"Worker error: {e}"}}})
+            except Exception as db_err: logger_vi.error(f"Failed to set audio_failed status for {gen_id}: {db_err}")
+    return True
+
+
 def job_vietnamese():
     """Tìm và xử lý các task Tiếng Việt."""
     logger_vi.info("Starting Vietnamese audio creation job run...")
@@ -203,30 +308,19 @@ def job_vietnamese():
     try:
         tasks_to_process_cursor = content_generations_coll_job.find({
             "language": "Vietnamese", # <<< CHỈ LẤY TIẾNG VIỆT
-            "$or": [{"status": "content_ready"}, {"status": "audio_failed"}]
+            "$or": [{"status": "content_ready"}, {"status": "audio_failed"},
+                    stealable_query({"status": {"$in": AUDIO_LOCKED_STATUSES}})] # Lease hết hạn -> lấy lại
         }).sort([("priority", -1), ("created_at", 1)]).limit(10) # Giới hạn số task/lần
 
+        task_ids = [task_doc['_id'] for task_doc in tasks_to_process_cursor]
+        # Xử lý song song nhiều task; limiter của provider dùng chung nên tổng request vẫn bị giới hạn
+        max_task_workers = max(1, min(VI_AUDIO_MAX_CONCURRENT_TASKS, len(task_ids) or 1))
         processed_count = 0
-        # Xử lý tuần tự từng task
-        for task_doc in tasks_to_process_cursor:
-            gen_id = task_doc['_id']
-            logger_vi.info(f"Found Vietnamese task {gen_id}, attempting to lock...")
-            # Lock task
-            result = content_generations_coll_job.find_one_and_update(
-                 {"_id": gen_id, "status": {"$in": ["content_ready", "audio_failed"]}},
-                 {"$set": {"status": "audio_processing_lock", "updated_at": datetime.datetime.now(datetime.timezone.utc)}},
-                 return_document=ReturnDocument.AFTER
-            )
-            if result:
-                try:
-                     process_audio_task_single_thread(result) # Xử lý task đã lock
-                     processed_count += 1
-                except Exception as e:
-                     logger_vi.exception(f"CRITICAL failure processing task {gen_id}: {e}")
-                     try: content_generations_coll_job.update_one({"_id": gen_id}, {"$set": {"status": "audio_failed", "error_details": {"message": f"Worker error: {e}"}}})
-                     except Exception as db_err: logger_vi.error(f"Failed to set audio_failed status for {gen_id}: {db_err}")
-            else:
-                 logger_vi.info(f"Vietnamese task {gen_id} lock failed or status changed. Skipping.")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_task_workers, thread_name_prefix="vi_task") as executor:
+            futures = [executor.submit(_lock_and_process_task, content_generations_coll_job, gen_id) for gen_id in task_ids]
+            for future in concurrent.futures.as_completed(futures):
+                if future.result():
+                    processed_count += 1
 
         logger_vi.info(f"Vietnamese audio job finished run. Processed {processed_count} tasks.")
 
@@ -237,13 +331,10 @@ def job_vietnamese():
 # --- Main Execution ---
 if __name__ == "__main__":
     RUN_INTERVAL_MINUTES = int(os.getenv("VI_AUDIO_INTERVAL_MINUTES", 5)) # Lấy từ env, mặc định 5 phút
-    logging.info(f"Starting Vietnamese Audio Worker (Interval: {RUN_INTERVAL_MINUTES} minutes)...")
-
-    # Chạy ngay lần đầu
-    job_vietnamese()
+    logging.info(f"Starting Vietnamese Audio Worker (Interval: {RUN_INTERVAL_MINUTES} minutes, Mode: {VI_AUDIO_CONCURRENCY_MODE}, Tasks: {VI_AUDIO_MAX_CONCURRENT_TASKS})...")
 
-    # Lên lịch
-    schedule.every(RUN_INTERVAL_MINUTES).minutes.do(job_vietnamese)
+    # Dispatcher đánh thức job ngay khi có task Tiếng Việt sẵn sàng; RUN_INTERVAL_MINUTES chỉ còn là chu kỳ quét dự phòng
+    dispatcher = start_dispatcher(content_generations_collection, stages=[STAGE_AUDIO_VI])
     while True:
-        schedule.run_pending()
-        time.sleep(1)
\ No newline at end of file
+        job_vietnamese()
+        dispatcher.wait(STAGE_AUDIO_VI, timeout=RUN_INTERVAL_MINUTES * 60)
\ No newline at end of file
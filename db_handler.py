@@ -11,6 +11,9 @@ from pymongo.errors import ConnectionFailure, OperationFailure
 from bson import ObjectId
 from dotenv import load_dotenv
 
+from task_lease import claim_with_lease, LEASE_FIELDS
+from render_metrics import RENDER_METRICS_COLLECTION
+
 # Tải biến môi trường (có thể gọi lại nếu chạy độc lập)
 load_dotenv()
 
@@ -23,6 +26,8 @@ COLLECTION_NAME = os.getenv("MONGO_COLLECTION_NAME")
 _client = None
 _db = None
 _collection = None
+# Lease của các task video đang render (doc_id -> TaskLease); release trong update_task_status
+_active_leases = {}
 
 def connect_db(mongo_uri=MONGO_URI, db_name=DB_NAME, collection_name=COLLECTION_NAME):
     """
@@ -81,10 +86,16 @@ def connect_db(mongo_uri=MONGO_URI, db_name=DB_NAME, collection_name=COLLECTION_
         _client = _db = _collection = None
         raise
 
-def get_next_pending_task():
+def get_next_pending_task(retry_failed_after_seconds=None):
     """
     Tìm một task đang chờ xử lý ('generated'), cập nhật trạng thái thành
     'rendering' một cách nguyên tử và trả về document đó.
+    Task 'rendering' có lease hết hạn (worker render bị chết) cũng được lấy lại.
+    Lease được heartbeat trong lúc render và giải phóng khi gọi update_task_status.
+
+    Args:
+        retry_failed_after_seconds (float, optional): Nếu có, task 'failed' chỉ được lấy lại
+            khi đã kết thúc lần render trước ít nhất ngần ấy giây.
 
     Returns:
         dict or None: Document đã được cập nhật hoặc None nếu không có task/lỗi.
@@ -104,23 +115,34 @@ def get_next_pending_task():
                 {"video_render_status": {"$nin": ["rendering", "finish", "skipped"]}}
             ]
         }
-        update = {
-            "$set": {
-                "video_render_status": "rendering",
-                "video_render_start_time": datetime.datetime.utcnow(),
-                "render_error": None # Xóa lỗi cũ khi bắt đầu render lại
-            }
+        if retry_failed_after_seconds is not None:
+            retry_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=retry_failed_after_seconds)
+            query["$and"] = [{"$or": [
+                {"video_render_status": {"$ne": "failed"}},
+                {"video_render_end_time": {"$lt": retry_before}},
+            ]}]
+        lock_set = {
+            "video_render_status": "rendering",
+            "video_render_start_time": datetime.datetime.utcnow(),
+            "render_error": None # Xóa lỗi cũ khi bắt đầu render lại
         }
         # Sắp xếp để lấy task cũ hơn trước (tùy chọn)
         # sort_order = [('creation_timestamp', 1)] # Giả sử có trường timestamp
 
-        # Tìm và cập nhật, trả về document SAU KHI cập nhật
-        doc = collection.find_one_and_update(
-            query,
-            update,
+        # Tìm và khóa (kèm lease) một cách nguyên tử
+        claimed = claim_with_lease(
+            collection,
+            ready_query=query,
+            locked_query={"thumbnail_status": "generated", "video_render_status": "rendering"},
+            lock_set=lock_set,
+            stage="video",
+            legacy_time_field="video_render_start_time",
             # sort=sort_order, # Bỏ comment nếu dùng sort
-            return_document=ReturnDocument.AFTER
         )
+        doc = None
+        if claimed:
+            doc, lease = claimed
+            _active_leases[doc["_id"]] = lease.start_heartbeat()
 
         if doc:
              print(f"-> Đã khóa task cho document ID: {doc['_id']}")
@@ -142,7 +164,7 @@ def get_next_pending_task():
         traceback.print_exc()
         return None
 
-def update_task_status(doc_id, status, output_path=None, error_message=None):
+def update_task_status(doc_id, status, output_path=None, error_message=None, render_stats=None):
     """
     Cập nhật trạng thái và thông tin liên quan cho một task document.
 
@@ -151,6 +173,7 @@ def update_task_status(doc_id, status, output_path=None, error_message=None):
         status (str): Trạng thái mới ('finish', 'failed', 'skipped', etc.).
         output_path (str, optional): Đường dẫn file video cuối cùng nếu thành công.
         error_message (str, optional): Thông báo lỗi nếu thất bại.
+        render_stats (dict, optional): Thống kê lần render (wall time, fps, threads...), ghi vào 'render_stats'.
 
     Returns:
         bool: True nếu cập nhật thành công, False nếu lỗi.
@@ -180,6 +203,16 @@ def update_task_status(doc_id, status, output_path=None, error_message=None):
         elif status in ["failed", "skipped"]:
             update_fields["final_video_path"] = None # Xóa đường dẫn nếu lỗi
             if error_message: update_fields["render_error"] = str(error_message)[:1000] # Giới hạn lỗi
+        if render_stats:
+            update_fields["render_stats"] = render_stats
+
+        # Task đang giữ lease -> dừng heartbeat, chỉ ghi khi vẫn còn là chủ lease và xóa lease cùng lúc
+        query = {"_id": doc_id}
+        lease = _active_leases.pop(doc_id, None)
+        if lease is not None:
+            lease.stop_heartbeat()
+            query["lease_owner"] = lease.owner
+            unset_fields.update({field: "" for field in LEASE_FIELDS})
 
         # Xây dựng lệnh update cuối cùng
         update_command = {"$set": update_fields}
@@ -187,7 +220,7 @@ def update_task_status(doc_id, status, output_path=None, error_message=None):
              update_command["$unset"] = unset_fields
 
         print(f"-> Chuẩn bị cập nhật doc ID {doc_id} thành status: {status}...")
-        result = collection.update_one({"_id": doc_id}, update_command)
+        result = collection.update_one(query, update_command)
 
         if result.modified_count == 1:
             print(f"-> Cập nhật status thành công.")
@@ -195,6 +228,9 @@ def update_task_status(doc_id, status, output_path=None, error_message=None):
         elif result.matched_count == 1:
              print(f"-> Document {doc_id} được tìm thấy nhưng không cần cập nhật (có thể status đã đúng?).")
              return True # Vẫn coi là thành công về mặt thao tác DB
+        elif lease is not None:
+            print(f"!!! Cảnh báo: Lease của document ID {doc_id} đã hết hạn và bị worker khác lấy. Bỏ qua cập nhật.")
+            return False
         else:
             print(f"!!! Cảnh báo: Không tìm thấy document ID {doc_id} để cập nhật.")
             return False
@@ -210,6 +246,43 @@ def update_task_status(doc_id, status, output_path=None, error_message=None):
         traceback.print_exc()
         return False
 
+def update_render_progress(doc_id, progress):
+    """
+    Ghi tiến độ render (percent, fps, speed, eta_seconds...) vào trường 'render_progress'.
+    Chỉ ghi khi task vẫn đang 'rendering' (không ghi đè sau khi đã có status cuối) và worker này
+    vẫn là chủ lease (lease hết hạn, bị worker khác lấy -> không ghi đè tiến độ của chủ mới).
+
+    Returns:
+        bool: True nếu ghi được.
+    """
+    try:
+        collection = connect_db()
+        query = {"_id": doc_id, "video_render_status": "rendering"}
+        lease = _active_leases.get(doc_id)
+        if lease is not None:
+            query["lease_owner"] = lease.owner
+        result = collection.update_one(query, {"$set": {"render_progress": progress}})
+        return result.matched_count == 1
+    except (OperationFailure, ConnectionFailure) as e:
+        print(f"Lỗi MongoDB khi ghi tiến độ render cho {doc_id}: {e}")
+        return False
+
+def insert_render_metrics(metrics):
+    """
+    Ghi thống kê một lần render (thời gian từng stage, fps, dung lượng...) vào collection
+    RENDER_METRICS_COLLECTION để tổng hợp bằng render_metrics.py.
+
+    Returns:
+        bool: True nếu ghi được.
+    """
+    try:
+        connect_db()
+        _db[RENDER_METRICS_COLLECTION].insert_one(dict(metrics))
+        return True
+    except (OperationFailure, ConnectionFailure) as e:
+        print(f"Lỗi MongoDB khi ghi render metrics: {e}")
+        return False
+
 def close_db_connection():
     """Đóng kết nối MongoDB nếu đang mở."""
     global _client
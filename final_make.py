@@ -19,15 +19,21 @@ Script tự động tạo video từ MongoDB - Phiên bản tự động nhận
 """
 
 # Standard library imports
+import collections
 import concurrent.futures
 import datetime
+import glob
+import hashlib
 import json
 import math
 import os
 import platform  # Để nhận diện HĐH
+import queue
 import random
-import re  # Để xử lý path mapping
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
 import traceback
 
@@ -45,6 +51,11 @@ except ImportError:
     print("!!! Lỗi: Thư viện python-dotenv chưa được cài đặt.")
     print("Chạy lệnh: pip install python-dotenv")
     exit(1)
+try:
+    from PIL import Image  # Tùy chọn: dựng sẵn lớp ảnh tĩnh (nhân vật + chữ)
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
 try:
     from pymongo import MongoClient, ReturnDocument  # type: ignore
     from pymongo.errors import ConnectionFailure, OperationFailure  # type: ignore
@@ -56,6 +67,12 @@ except ImportError:
 # Local application/library specific imports
 try:
     import db_handler  # File db_handler.py phải nằm cùng thư mục
+    import bg_library
+    import waveform_numpy  # Tùy chọn numpy: WAVEFORM_MODE=numpy
+    from render_metrics import RenderTimer, timed_stage
+    from path_translator import PathTranslator, get_path_translator, mappings_from_env, missing_linux_targets
+    from video_metadata_store import get_metadata_store
+    from task_dispatcher import start_dispatcher, STAGE_VIDEO
 except ImportError:
     print("!!! Lỗi: Không tìm thấy file db_handler.py cùng thư mục.")
     exit(1)
@@ -73,6 +90,19 @@ else:
 # SECTION 1: CONFIG, PATH TRANSLATION & UTILITIES
 # ==============================================================================
 
+# Codec cho track waveform có alpha: tên -> (container, output args)
+WAVEFORM_TRACK_CODECS = {
+    "qtrle": ("mov", {"vcodec": "qtrle", "pix_fmt": "argb"}),
+    "png": ("mkv", {"vcodec": "png", "pix_fmt": "rgba"}),
+    "prores_4444": ("mov", {"vcodec": "prores_ks", "profile:v": "4444", "pix_fmt": "yuva444p10le"}),
+}
+# Tham số quyết định nội dung track waveform (key cache)
+WAVEFORM_TRACK_CONFIG_KEYS = (
+    "waveform_w", "waveform_h", "waveform_mode", "waveform_ascale", "waveform_fscale",
+    "waveform_win_size", "waveform_win_func", "waveform_color", "framerate", "waveform_track_codec",
+    "waveform_bar_count",
+)
+
 
 class ConfigError(Exception):
     """Lỗi tùy chỉnh cho các vấn đề về cấu hình ứng dụng."""
@@ -80,6 +110,11 @@ class ConfigError(Exception):
     pass
 
 
+def _stage(config, name):
+    """Đo thời gian một stage vào RenderTimer của lần render hiện tại (config['render_timer']) nếu có."""
+    return timed_stage((config or {}).get('render_timer'), name)
+
+
 def get_env_var(var_name, default=None, required=False, var_type=str):
     """
     Lấy biến môi trường một cách an toàn, chuyển đổi kiểu dữ liệu và
@@ -182,16 +217,60 @@ def load_app_config():
         config["hw_nvenc_qp"] = get_env_var("HW_NVENC_QP", "23")  # Đọc string
         config["hw_nvenc_bitrate"] = get_env_var("HW_NVENC_BITRATE", "8000k")
         config["cuda_device_id"] = get_env_var("CUDA_DEVICE_ID", 0, var_type=int)
+        # Thư viện video nền đã chuẩn hóa (bg_library.py): off | prefer | only
+        config["bg_library_mode"] = get_env_var("BG_LIBRARY_MODE", "prefer").lower()
+        if config["bg_library_mode"] not in ("off", "prefer", "only"):
+            raise ConfigError(f"BG_LIBRARY_MODE ('{config['bg_library_mode']}') phải là off, prefer hoặc only.")
+        config["bg_library_dir"] = get_env_var("BG_LIBRARY_DIR", None)
+        # Scale sẵn ảnh nhân vật + ảnh chữ thành 2 PNG RGBA đúng kích thước đích (cần Pillow)
+        config["precompose_static_layer"] = get_env_var("PRECOMPOSE_STATIC_LAYER", True, var_type=bool)
+        # Render theo đoạn song song (1 = tắt, 0 = tự động theo số core)
+        config["render_segments"] = get_env_var("RENDER_SEGMENTS", 1, var_type=int)
+        config["render_segment_workers"] = get_env_var("RENDER_SEGMENT_WORKERS", 0, var_type=int)
+        config["render_segment_gop_seconds"] = get_env_var("RENDER_SEGMENT_GOP_SECONDS", 2, var_type=float)
+        config["render_segment_min_seconds"] = get_env_var("RENDER_SEGMENT_MIN_SECONDS", 60, var_type=float)
+        # Render service: số job ffmpeg chạy đồng thời (0 = tự động: số core / RENDER_JOB_CORES)
+        config["render_concurrent_jobs"] = get_env_var("RENDER_CONCURRENT_JOBS", 0, var_type=int)
+        config["render_job_cores"] = get_env_var("RENDER_JOB_CORES", 8, var_type=int)
+        config["bg_index_poll_seconds"] = get_env_var("BG_INDEX_POLL_SECONDS", 60, var_type=float)
+        # Chia core cho từng job (sched_setaffinity, chỉ Linux) + điều kiện nhận job mới
+        config["render_pin_affinity"] = get_env_var("RENDER_PIN_AFFINITY", False, var_type=bool)
+        config["render_max_load_per_core"] = get_env_var("RENDER_MAX_LOAD_PER_CORE", 1.0, var_type=float)
+        config["render_min_free_gb"] = get_env_var("RENDER_MIN_FREE_GB", 5.0, var_type=float)
+        config["render_admission_retry_seconds"] = get_env_var("RENDER_ADMISSION_RETRY_SECONDS", 30, var_type=float)
+        # Task render 'failed' chỉ được claim lại sau khoảng này (tránh render lại liên tục task lỗi)
+        config["render_retry_failed_after_seconds"] = get_env_var("RENDER_RETRY_FAILED_AFTER_SECONDS", 300, var_type=float)
+        # Tiến độ render (-progress) ghi vào task tối đa 1 lần / khoảng này; số dòng stderr giữ lại khi lỗi
+        config["render_progress_interval_seconds"] = get_env_var("RENDER_PROGRESS_INTERVAL_SECONDS", 10, var_type=float)
+        config["ffmpeg_stderr_tail_lines"] = get_env_var("FFMPEG_STDERR_TAIL_LINES", 200, var_type=int)
+        # Cache render theo fingerprint (hash input + seed + config): render lại y hệt -> dùng lại file cũ
+        config["render_cache_enabled"] = get_env_var("RENDER_CACHE_ENABLED", True, var_type=bool)
+        config["render_cache_dir"] = get_env_var("RENDER_CACHE_DIR", None)
+        # Giới hạn dung lượng cache (GB, 0 = không giới hạn): vượt -> xóa bản ít dùng nhất (LRU theo mtime)
+        config["render_cache_max_gb"] = get_env_var("RENDER_CACHE_MAX_GB", 200, var_type=float)
+        # Codec trung gian khi phải nối 2 bước qua pipe (lossless, không tốn CPU encode)
+        config["pipe_intermediate_vcodec"] = get_env_var("PIPE_INTERMEDIATE_VCODEC", "rawvideo")
         print(f"-> Encoder được chọn: {config['encoder_choice']}")
 
         # --- Đọc Tham số Waveform ---
         print("-> Đọc tham số waveform...")
+        # Renderer CPU (generate_cpu_video) chỉ vẽ waveform khi bật
+        config["waveform_enabled"] = get_env_var("WAVEFORM_ENABLED", False, var_type=bool)
+        # Waveform render một lần/file audio thành track có alpha, cache theo hash audio + tham số waveform
+        config["waveform_track_codec"] = get_env_var("WAVEFORM_TRACK_CODEC", "qtrle").lower()
+        if config["waveform_track_codec"] not in WAVEFORM_TRACK_CODECS:
+            raise ConfigError(f"WAVEFORM_TRACK_CODEC ('{config['waveform_track_codec']}') phải là một trong {sorted(WAVEFORM_TRACK_CODECS)}.")
+        config["waveform_cache_dir"] = get_env_var("WAVEFORM_CACHE_DIR", None)
+        config["waveform_cache_max_gb"] = get_env_var("WAVEFORM_CACHE_MAX_GB", 50, var_type=float)
         config["waveform_h"] = get_env_var("WAVEFORM_HEIGHT", 120, var_type=int)
         config["waveform_color"] = get_env_var("WAVEFORM_COLOR", "white")
         config["waveform_margin_bottom"] = get_env_var(
             "WAVEFORM_BOTTOM_MARGIN", 50, var_type=int
         )
+        # bar/line/dot: mode của showfreqs; numpy: engine waveform_numpy.py (cột, cần numpy)
         config["waveform_mode"] = get_env_var("WAVEFORM_MODE", "bar")
+        config["waveform_bar_count"] = get_env_var("WAVEFORM_BAR_COUNT", waveform_numpy.DEFAULT_BAR_COUNT, var_type=int)
+        config["waveform_numpy_workers"] = get_env_var("WAVEFORM_NUMPY_WORKERS", 0, var_type=int)
         config["waveform_ascale"] = get_env_var("WAVEFORM_ASCALE", "log")
         config["waveform_fscale"] = get_env_var("WAVEFORM_FSCALE", "log")
         config["waveform_win_size"] = get_env_var(
@@ -201,54 +280,13 @@ def load_app_config():
 
         # --- Xử lý Path Mappings ---
         print("-> Đọc Path Mappings từ .env...")
-        config["win_to_linux_mappings"] = {}
-        config["linux_to_win_mappings"] = {}
-        linux_prefixes_temp = {}
-        win_targets_temp = {}
-        win_map_count = 0
-        linux_map_count = 0
-
-        # Duyệt qua biến môi trường để tìm mapping
-        for key, value in os.environ.items():
-            value_clean = value.strip().strip("'\"")
-            if not value_clean:
-                continue
-
-            # Win -> Linux (PATH_MAP_X=...)
-            if key.startswith("PATH_MAP_"):
-                drive_key = key.replace("PATH_MAP_", "").upper()
-                if drive_key and len(drive_key) == 1 and drive_key.isalpha():
-                    win_prefix = drive_key + ":"
-                    linux_target = value_clean.replace("\\", "/").rstrip("/")
-                    if linux_target:
-                        config["win_to_linux_mappings"][win_prefix] = linux_target
-                        win_map_count += 1
-                        print(f"DEBUG: Đã thêm mapping Win->Linux: {win_prefix} -> {linux_target}") # Thêm dòng này
-
-            # Linux -> Win (MAP_LINUX_PREFIX_n + MAP_LINUX_TARGET_n)
-            elif key.startswith("MAP_LINUX_PREFIX_"):
-                index = key.replace("MAP_LINUX_PREFIX_", "")
-                linux_prefixes_temp[index] = value_clean.replace("\\", "/").rstrip("/")
-            elif key.startswith("MAP_LINUX_TARGET_"):
-                index = key.replace("MAP_LINUX_TARGET_", "")
-                win_targets_temp[index] = value_clean
-
-        # Ghép cặp mapping Linux -> Win
-        for index, linux_prefix in linux_prefixes_temp.items():
-            if index in win_targets_temp:
-                win_target = win_targets_temp[index]
-                if len(win_target) == 1 and win_target.isalpha():
-                    win_target += ":"
-                elif not win_target.startswith("\\\\"):
-                    win_target = win_target.rstrip("\\/")
-                if linux_prefix and win_target:
-                    config["linux_to_win_mappings"][linux_prefix] = win_target
-                    linux_map_count += 1
-            elif linux_prefix:
-                print(
-                    f"Cảnh báo: Thiếu MAP_LINUX_TARGET_{index} cho prefix '{linux_prefix}'"
-                )
-
+        config["win_to_linux_mappings"], config["linux_to_win_mappings"] = mappings_from_env()
+        for index, linux_prefix in missing_linux_targets().items():
+            print(f"Cảnh báo: Thiếu MAP_LINUX_TARGET_{index} cho prefix '{linux_prefix}'")
+        # Biên dịch mapping một lần (trie + LRU), dùng chung cho mọi lần gọi translate_path
+        config["path_translator"] = PathTranslator(
+            config["win_to_linux_mappings"], config["linux_to_win_mappings"]
+        )
         print(f"-> Win->Linux Mappings: {len(config['win_to_linux_mappings'])} rules")
         print(f"-> Linux->Win Mappings: {len(config['linux_to_win_mappings'])} rules")
         print("DEBUG: Nội dung config['win_to_linux_mappings']:", config.get('win_to_linux_mappings'))
@@ -282,9 +320,15 @@ def load_app_config():
         config["cache_file"] = get_env_var(
             "CACHE_FILE_PATH", os.path.join(base_dir, "video_metadata_cache.json")
         )
+        config["metadata_db_path"] = get_env_var(
+            "METADATA_DB_PATH", os.path.join(base_dir, "video_metadata.sqlite3")
+        )
+        # Bỏ qua stat từng file khi mtime thư mục video nền không đổi
+        config["metadata_dir_shortcut"] = get_env_var("METADATA_DIR_SHORTCUT", True, var_type=bool)
         config["concat_dir"] = config["temp_dir"]  # Đặt concat_dir vào temp_dir
         print(f"  - Thư mục tạm/concat: {config['temp_dir']}")
-        print(f"  - File cache: {config['cache_file']}")
+        print(f"  - File cache (JSON cũ, chỉ để chuyển đổi): {config['cache_file']}")
+        print(f"  - Kho metadata SQLite: {config['metadata_db_path']}")
 
         # --- Hoàn thành ---
         print("-> Đã đọc xong toàn bộ cấu hình.")
@@ -302,6 +346,7 @@ def load_app_config():
 def translate_path(path_str, config):
     """
     Tự động dịch đường dẫn cho phù hợp với HĐH đang chạy dựa vào config.
+    Dùng PathTranslator đã biên dịch sẵn trong config (path_translator.py).
 
     Args:
         path_str (str): Đường dẫn gốc (từ DB hoặc config).
@@ -310,72 +355,7 @@ def translate_path(path_str, config):
     Returns:
         str: Đường dẫn đã được dịch (hoặc gốc nếu không cần/không có mapping).
     """
-    if not path_str or not isinstance(path_str, str):
-        return path_str
-
-    current_os = platform.system()
-    path_norm = path_str.replace("\\", "/")  # Luôn chuẩn hóa slash trước
-
-    translated_path = path_norm  # Mặc định là path đã chuẩn hóa
-
-    try:
-        # Nếu chạy trên Linux, thử dịch path Windows
-        if current_os == "Linux":
-            mappings = config.get("win_to_linux_mappings", {})
-            if mappings:
-                sorted_win_prefixes = sorted(mappings.keys(), key=len, reverse=True)
-                for win_prefix in sorted_win_prefixes:
-                    if re.match(f"^{re.escape(win_prefix)}/", path_norm, re.IGNORECASE):
-                        linux_prefix = mappings[win_prefix]
-                        rest_of_path = path_norm[len(win_prefix) :].lstrip("/")
-                        translated_path = os.path.join(linux_prefix, rest_of_path)
-                        # print(f"DEBUG Translate Win->Linux: '{path_str}' -> '{translated_path}'")
-                        break  # Dừng sau khi tìm thấy mapping đầu tiên (dài nhất)
-
-        # Nếu chạy trên Windows, thử dịch path Linux
-        elif current_os == "Windows":
-            mappings = config.get("linux_to_win_mappings", {})
-            if mappings:
-                # Kiểm tra xem có phải là đường dẫn Windows hợp lệ rồi không
-                if (
-                    re.match(r"^[a-zA-Z]:[/\\]", path_norm)
-                    or path_norm.startswith("//")
-                    or path_norm.startswith("\\\\")
-                ):
-                    translated_path = os.path.normpath(
-                        path_str
-                    )  # Chuẩn hóa lại nếu cần
-                else:  # Nếu không phải path Win, thử dịch từ Linux
-                    sorted_linux_prefixes = sorted(
-                        mappings.keys(), key=len, reverse=True
-                    )
-                    for linux_prefix in sorted_linux_prefixes:
-                        if path_norm.startswith(linux_prefix):
-                            win_prefix = mappings[
-                                linux_prefix
-                            ]  # Z: hoặc \\server\share
-                            rest_of_path = path_norm[len(linux_prefix) :].lstrip("/")
-                            # Ghép lại cho Windows dùng os.path.join
-                            if len(win_prefix) == 2 and win_prefix.endswith(":"):
-                                win_prefix_for_join = win_prefix + "\\"
-                            else:
-                                win_prefix_for_join = win_prefix
-                            translated_path = os.path.join(
-                                win_prefix_for_join, rest_of_path
-                            )
-                            # print(f"DEBUG Translate Linux->Win: '{path_str}' -> '{translated_path}'")
-                            break  # Dừng sau khi tìm thấy mapping
-
-        # Cảnh báo nếu không có thay đổi và path không tuyệt đối theo HĐH hiện tại
-        # (Hơi phức tạp, tạm thời bỏ qua để tránh log thừa)
-        # if translated_path == path_norm and not os.path.isabs(translated_path):
-        #      print(f"CB: Path '{path_str}' không được dịch và không tuyệt đối.")
-
-    except Exception as e:
-        print(f"Cảnh báo: Lỗi khi dịch đường dẫn '{path_str}': {e}")
-        return path_norm  # Trả về path gốc nếu có lỗi dịch
-
-    return translated_path
+    return get_path_translator(config).translate(path_str)
 
 
 def validate_paths(paths_to_check):
@@ -421,31 +401,7 @@ def validate_paths(paths_to_check):
         raise e  # Ném lại lỗi
 
 
-# --- Các hàm xử lý cache và metadata ---
-# (Copy đầy đủ các hàm load_cache, save_cache, get_duration, probe_file_metadata,
-#  get_video_metadata_batch từ phiên bản trước, đảm bảo đã sửa lỗi Pylance)
-
-
-def load_cache(cache_path):
-    """Tải dữ liệu cache từ file JSON, bỏ qua lỗi."""
-    if os.path.exists(cache_path):
-        try:
-            with open(cache_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return {}
-    return {}
-
-
-def save_cache(cache_path, data):
-    """Lưu dữ liệu cache vào file JSON, bỏ qua lỗi."""
-    try:
-        cache_dir = os.path.dirname(cache_path)
-        os.makedirs(cache_dir, exist_ok=True)
-        with open(cache_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        print(f"CB: Lỗi ghi cache {cache_path}: {e}")
+# --- Các hàm xử lý metadata (kho SQLite: video_metadata_store.py) ---
 
 
 def get_duration(filename):
@@ -516,116 +472,149 @@ def get_duration(filename):
 
 
 def probe_file_metadata(filepath):
-    """Worker function để lấy duration và mtime cho một file."""
+    """
+    Worker function: probe một file video (một lần ffmpeg.probe) lấy duration, độ phân giải, codec, fps.
+    Trả về (filepath, dict) hoặc (filepath, None) nếu lỗi.
+    """
     try:
         if not os.path.exists(filepath):
             return filepath, None
-        duration = get_duration(filepath)
-        mtime = os.path.getmtime(filepath)
-        return filepath, {"duration": duration, "mtime": mtime}
+        stat = os.stat(filepath)
+        data = {"size": stat.st_size, "mtime": stat.st_mtime, "duration": None,
+                "width": None, "height": None, "codec": None, "fps": None}
+        try:
+            probe = ffmpeg.probe(filepath, timeout=20)
+            video_stream = next((s for s in probe.get('streams', []) if s.get('codec_type') == 'video'), None)
+            if video_stream:
+                data["width"], data["height"] = video_stream.get("width"), video_stream.get("height")
+                data["codec"] = video_stream.get("codec_name")
+                rate = video_stream.get("avg_frame_rate") or video_stream.get("r_frame_rate") or ""
+                num, _, den = rate.partition("/")
+                if num and den and float(den) > 0: data["fps"] = round(float(num) / float(den), 3)
+            format_duration = probe.get('format', {}).get('duration')
+            if format_duration and str(format_duration).upper() != 'N/A':
+                data["duration"] = float(format_duration)
+        except Exception:
+            pass # Để get_duration thử lại bằng ffprobe
+        if not data["duration"] or data["duration"] <= 0:
+            data["duration"] = get_duration(filepath)
+        return filepath, data
     except Exception as e:
         return filepath, None  # Không in lỗi
 
 
-def get_video_metadata_batch(file_paths, cache_path, max_workers):
-    """Lấy metadata cho danh sách video, dùng cache và đa luồng."""
-    cache = load_cache(cache_path)
+def get_video_metadata_batch(file_paths, cache_path, max_workers, metadata_db_path=None, dir_shortcut=True):
+    """
+    Lấy duration cho danh sách video, dùng kho metadata SQLite và đa luồng.
+
+    - Thư mục có mtime không đổi so với lần quét trước -> dùng thẳng dữ liệu trong kho, không stat từng file.
+    - File có (size, mtime) không đổi -> dùng kho; file mới/đổi -> probe rồi upsert riêng dòng đó.
+    - cache_path (JSON cũ) chỉ còn dùng để chuyển dữ liệu sang kho SQLite một lần.
+    """
+    store = get_metadata_store(metadata_db_path or os.path.splitext(cache_path)[0] + ".sqlite3")
+    migrated_count = store.migrate_from_json(cache_path)
+    if migrated_count:
+        print(f"-> Đã chuyển {migrated_count} bản ghi từ {os.path.basename(cache_path)} sang {store.db_path}.")
+
+    abs_paths = {}
+    for filepath in file_paths:
+        abs_paths.setdefault(os.path.abspath(filepath), filepath)
+    known = store.get_many(abs_paths)
     results = {}
     files_to_probe = []
-    cache_needs_saving = False
-    processed_files = set()
+    stale_paths = []
+    size_updates = {}
+    scanned_dirs = {}
     start_check_time = time.time()
-    print(f"--- Kiểm tra cache video nền ({len(file_paths)} files) ---")
-    for filepath in file_paths:
+    print(f"--- Kiểm tra kho metadata video nền ({len(abs_paths)} files) ---")
+
+    paths_by_dir = {}
+    for abs_filepath in abs_paths:
+        paths_by_dir.setdefault(os.path.dirname(abs_filepath), []).append(abs_filepath)
+
+    for directory, dir_paths in paths_by_dir.items():
         try:
-            abs_filepath = os.path.abspath(filepath)
-            if abs_filepath in processed_files:
+            dir_mtime = os.stat(directory).st_mtime
+        except OSError:
+            dir_mtime = None
+        if (dir_shortcut and dir_mtime is not None and store.get_directory_mtime(directory) == dir_mtime
+                and all(path in known for path in dir_paths)):
+            # Thư mục không đổi kể từ lần quét trước -> bỏ qua stat từng file
+            for abs_filepath in dir_paths:
+                results[abs_filepath] = known[abs_filepath].get("duration") or 0.0
+            continue
+        scanned_dirs[directory] = dir_mtime
+        for abs_filepath in dir_paths:
+            try:
+                stat = os.stat(abs_filepath)
+            except FileNotFoundError:
+                if abs_filepath in known: stale_paths.append(abs_filepath)
                 continue
-            processed_files.add(abs_filepath)
-            if not os.path.exists(filepath):
-                if abs_filepath in cache:
-                    del cache[abs_filepath]
-                    cache_needs_saving = True
-                    continue
-            current_mtime = os.path.getmtime(filepath)
-            if abs_filepath in cache:
-                cached_data = cache[abs_filepath]
-                if (
-                    cached_data.get("mtime") == current_mtime
-                    and isinstance(cached_data.get("duration"), (int, float))
-                    and cached_data.get("duration") > 0
-                ):
-                    results[filepath] = cached_data["duration"]
-                else:
-                    files_to_probe.append(filepath)
+            except OSError as e:
+                print(f"CB: Lỗi check metadata {os.path.basename(abs_filepath)}: {e}")
+                files_to_probe.append(abs_filepath)
+                continue
+            row = known.get(abs_filepath)
+            if row and row.get("mtime") == stat.st_mtime and row.get("size") in (None, stat.st_size):
+                results[abs_filepath] = row.get("duration") or 0.0 # File probe lỗi trước đó & không đổi -> bỏ qua
+                if row.get("size") is None: # Bản ghi chuyển từ JSON chưa có size
+                    size_updates[abs_filepath] = dict(row, size=stat.st_size)
             else:
-                files_to_probe.append(filepath)
-        except Exception as e:
-            print(f"CB: Lỗi check cache {os.path.basename(filepath)}: {e}")
-            files_to_probe.append(filepath) if filepath not in files_to_probe else None
+                files_to_probe.append(abs_filepath)
     end_check_time = time.time()
     print(
-        f"-> Check cache xong ({end_check_time - start_check_time:.2f}s). Cần probe {len(files_to_probe)} file(s)."
+        f"-> Check metadata xong ({end_check_time - start_check_time:.2f}s, quét {len(scanned_dirs)}/{len(paths_by_dir)} thư mục). "
+        f"Cần probe {len(files_to_probe)} file(s)."
     )
+
+    failed_dirs = set()
     if files_to_probe:
         print(f"-> Bắt đầu probe đa luồng (max_workers={max_workers})...")
         start_probe_time = time.time()
         successful_probes, failed_probes = 0, 0
+        probed_records = {}
         with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
             future_to_file = {
                 executor.submit(probe_file_metadata, fp): fp for fp in files_to_probe
             }
             for future in concurrent.futures.as_completed(future_to_file):
-                original_filepath, abs_filepath = future_to_file[
-                    future
-                ], os.path.abspath(future_to_file[future])
+                abs_filepath = future_to_file[future]
                 try:
                     _, data = future.result()
-                    current_mtime = os.path.getmtime(original_filepath)
-                    if (
-                        data
-                        and isinstance(data.get("duration"), (int, float))
-                        and data["duration"] > 0
-                    ):
-                        results[original_filepath] = data["duration"]
-                        cache[abs_filepath] = {
-                            "duration": data["duration"],
-                            "mtime": current_mtime,
-                        }
-                        cache_needs_saving = True
-                        successful_probes += 1  # Đã sửa lỗi Pylance 1
-                    else:
-                        failed_probes += 1
-                        results[original_filepath] = 0.0
-                        cache[abs_filepath] = {"duration": None, "mtime": current_mtime}
-                        cache_needs_saving = True
-                except FileNotFoundError:
-                    failed_probes += 1
-                    if abs_filepath in cache:
-                        del cache[abs_filepath]
-                        cache_needs_saving = True
                 except Exception as exc:
-                    failed_probes += 1
-                    print(f"-> Lỗi probe {os.path.basename(original_filepath)}: {exc}")
-                    results[original_filepath] = 0.0
-                    try:
-                        current_mtime = os.path.getmtime(original_filepath)
-                        cache[abs_filepath] = {"duration": None, "mtime": current_mtime}
-                        cache_needs_saving = True
-                    except Exception:
-                        pass
+                    print(f"-> Lỗi probe {os.path.basename(abs_filepath)}: {exc}")
+                    data = None
+                if data and isinstance(data.get("duration"), (int, float)) and data["duration"] > 0:
+                    results[abs_filepath] = data["duration"]
+                    probed_records[abs_filepath] = data
+                    successful_probes += 1
+                    continue
+                failed_probes += 1
+                results[abs_filepath] = 0.0
+                try:
+                    stat = os.stat(abs_filepath)
+                    # Ghi nhận file lỗi (duration None) -> không probe lại cho tới khi file thay đổi
+                    probed_records[abs_filepath] = {"size": stat.st_size, "mtime": stat.st_mtime, "duration": None}
+                except FileNotFoundError:
+                    if abs_filepath in known: stale_paths.append(abs_filepath)
+                except OSError:
+                    failed_dirs.add(os.path.dirname(abs_filepath))
+        store.upsert_many(probed_records)
         end_probe_time = time.time()
         print(
             f"-> Probe xong: {successful_probes} OK, {failed_probes} lỗi ({end_probe_time - start_probe_time:.2f}s)."
         )
-    if cache_needs_saving:
-        save_cache(cache_path, cache)
+    store.upsert_many(size_updates)
+    store.delete_many(stale_paths)
+    for directory, dir_mtime in scanned_dirs.items():
+        if dir_mtime is not None and directory not in failed_dirs:
+            store.set_directory_mtime(directory, dir_mtime)
+
     final_results = {
-        fp: results.get(fp)
-        for fp in file_paths
-        if os.path.exists(fp)
-        and isinstance(results.get(fp), (int, float))
-        and results.get(fp) > 0
+        original: results.get(abs_filepath)
+        for abs_filepath, original in abs_paths.items()
+        if isinstance(results.get(abs_filepath), (int, float))
+        and results.get(abs_filepath) > 0
     }
     return final_results
 
@@ -633,11 +622,19 @@ def get_video_metadata_batch(file_paths, cache_path, max_workers):
 # ==============================================================================
 # SECTION 4: LOGIC CHUẨN BỊ VIDEO NỀN
 # ==============================================================================
-def prepare_background_videos(
-    video_folder_path, target_duration, cache_file_path, max_workers
+def load_background_metadata(
+    video_folder_path, cache_file_path, max_workers,
+    library_mode="off", library_dir=None, config=None
 ):
-    """Lấy metadata, chọn ngẫu nhiên video nền đủ thời lượng yêu cầu."""
-    print(f"\n--- Chuẩn bị video nền từ: '{os.path.basename(video_folder_path)}' ---")
+    """
+    Liệt kê video nền và lấy metadata (duration) qua kho SQLite.
+
+    library_mode: 'off' dùng clip gốc; 'prefer' thay clip gốc bằng bản chuẩn hóa (bg_library) nếu có;
+    'only' chỉ dùng clip đã chuẩn hóa.
+
+    Returns:
+        dict: {đường dẫn: duration (s)} của các video nền hợp lệ.
+    """
     available_videos = []
     try:
         print("-> Liệt kê file video...")
@@ -653,42 +650,126 @@ def prepare_background_videos(
         print(f"!!! Lỗi: Không tìm thấy video nào trong '{video_folder_path}'")
         raise FileNotFoundError()
 
-    video_metadata = get_video_metadata_batch(
-        available_videos, cache_file_path, max_workers
-    )
+    if library_mode != "off":
+        spec = bg_library.get_library_spec(
+            (config or {}).get("resolution"), (config or {}).get("framerate"),
+            (config or {}).get("render_segment_gop_seconds"),
+        )
+        resolved_library_dir = bg_library.get_library_dir(video_folder_path, library_dir)
+        normalized = bg_library.resolve_normalized_clips(available_videos, resolved_library_dir, spec)
+        print(f"-> Thư viện chuẩn hóa: {len(normalized)}/{len(available_videos)} clip đã chuẩn hóa ({resolved_library_dir}).")
+        if library_mode == "only":
+            if not normalized:
+                raise FileNotFoundError(f"BG_LIBRARY_MODE=only nhưng chưa có clip chuẩn hóa nào. Chạy: python bg_library.py")
+            available_videos = list(normalized.values())
+        else:
+            if len(normalized) < len(available_videos):
+                print("CB: Còn clip chưa chuẩn hóa (chạy python bg_library.py để render nhanh hơn).")
+            available_videos = [normalized.get(path, path) for path in available_videos]
+
+    with _stage(config, "metadata_probe"):
+        video_metadata = get_video_metadata_batch(
+            available_videos, cache_file_path, max_workers,
+            metadata_db_path=(config or {}).get("metadata_db_path"),
+            dir_shortcut=(config or {}).get("metadata_dir_shortcut", True),
+        )
     if not video_metadata:
         print("!!! Lỗi: Không có video nền hợp lệ.")
         raise ValueError("No valid background videos.")
 
-    valid_video_paths = list(video_metadata.keys())
-    print(f"-> Tìm thấy {len(valid_video_paths)} video hợp lệ.")
-    print(f"--- Chọn video nền (cần {target_duration:.2f}s) ---")
-    selected_video_files, current_duration, attempts, max_attempts = (
-        [],
-        0.0,
-        0,
-        len(valid_video_paths) * 30 + 10,
-    )
+    print(f"-> Tìm thấy {len(video_metadata)} video hợp lệ.")
+    return video_metadata
 
-    while current_duration < target_duration and attempts < max_attempts:
-        # Đã sửa lỗi Pylance 2 & 3
-        video_to_add = random.choice(valid_video_paths)
-        video_duration = video_metadata.get(video_to_add, 0)
-        if video_duration > 0:
-            selected_video_files.append(video_to_add)
-            current_duration += video_duration
-        attempts += 1
 
-    print(
-        f"-> Đã chọn {len(selected_video_files)} video (lặp) tổng ~{current_duration:.2f}s."
-    )
-    if not selected_video_files:
-        raise ValueError("Không chọn được video nền nào.")
-    if current_duration < target_duration:
-        print(
-            f"CB: Tổng duration nền ({current_duration:.2f}s) ngắn hơn yêu cầu ({target_duration:.2f}s)."
+def prepare_background_videos(
+    video_folder_path, target_duration, cache_file_path, max_workers,
+    library_mode="off", library_dir=None, config=None, seed=None, video_metadata=None
+):
+    """
+    Lấy metadata, chọn video nền (round-robin xáo trộn) lấp đúng thời lượng yêu cầu.
+    Trả về list (đường dẫn, inpoint, outpoint) cho _write_concat_file.
+
+    video_metadata: metadata đã có sẵn (vd: từ BackgroundClipIndex của RenderService)
+    -> bỏ qua bước liệt kê thư mục và kiểm tra kho metadata.
+    """
+    print(f"\n--- Chuẩn bị video nền từ: '{os.path.basename(video_folder_path)}' ---")
+    if video_metadata is None:
+        video_metadata = load_background_metadata(
+            video_folder_path, cache_file_path, max_workers,
+            library_mode=library_mode, library_dir=library_dir, config=config,
         )
-    return selected_video_files
+    if not video_metadata:
+        raise ValueError("No valid background videos.")
+    print(f"--- Chọn video nền (cần {target_duration:.2f}s) ---")
+    with _stage(config, "background_selection"):
+        selected_clips = select_background_clips(video_metadata, target_duration, rng=random.Random(seed))
+    if not selected_clips:
+        raise ValueError("Không chọn được video nền nào.")
+    distinct_count = len({clip[0] for clip in selected_clips})
+    print(f"-> Đã chọn {len(selected_clips)} đoạn từ {distinct_count} video, cắt đúng {target_duration:.2f}s.")
+    return selected_clips
+
+
+def select_background_clips(video_metadata, target_duration, rng=None):
+    """
+    Chọn clip nền lấp đầy target_duration theo kiểu round-robin xáo trộn:
+    mỗi lượt dùng mọi clip đúng một lần (thứ tự ngẫu nhiên) trước khi lặp lại -> số lần lặp
+    của mỗi clip chênh nhau tối đa 1. Clip cuối được cắt bằng outpoint nên không dư thời lượng.
+
+    Args:
+        video_metadata (dict): {đường dẫn: duration (s)}.
+        target_duration (float): Thời lượng cần lấp (s).
+        rng (random.Random, optional): Nguồn ngẫu nhiên (truyền seed để chọn lặp lại được).
+
+    Returns:
+        list: [(đường dẫn, inpoint, outpoint | None)]; outpoint None = dùng hết clip.
+    """
+    rng = rng or random.Random()
+    clips = sorted(path for path, duration in video_metadata.items() if duration and duration > 0)
+    if not clips or target_duration <= 0:
+        return []
+
+    selected = []
+    remaining = target_duration
+    order = []
+    while remaining > 1e-3:
+        if not order:
+            order = clips[:]
+            rng.shuffle(order)
+            # Không lặp cùng một clip liền nhau ở ranh giới giữa hai lượt
+            if selected and len(order) > 1 and order[0] == selected[-1][0]:
+                order[0], order[-1] = order[-1], order[0]
+        path = order.pop(0)
+        duration = video_metadata[path]
+        if duration >= remaining:
+            selected.append((path, 0.0, round(remaining, 3)))
+            remaining = 0.0
+        else:
+            selected.append((path, 0.0, None))
+            remaining -= duration
+    return selected
+
+
+def _write_concat_file(concat_file_path, bg_video_list):
+    """
+    Ghi file cho concat demuxer. Mục có thể là đường dẫn (str) hoặc (đường dẫn, inpoint, outpoint)
+    từ select_background_clips -> demuxer dừng đúng outpoint, không giải mã phần thừa.
+    """
+    written = 0
+    with open(concat_file_path, 'w', encoding='utf-8') as f:
+        for i, entry in enumerate(bg_video_list):
+            video_file, inpoint, outpoint = (entry, None, None) if isinstance(entry, str) else entry
+            if not isinstance(video_file, str):
+                print(f"Cảnh báo: Bỏ qua mục không hợp lệ trong bg_video_list ở index {i}")
+                continue
+            safe_path = video_file.replace('\\', '/').replace("'", "'\\''") # Escape dấu nháy đơn theo cú pháp concat
+            f.write(f"file '{safe_path}'\n")
+            if inpoint: f.write(f"inpoint {inpoint:.3f}\n")
+            if outpoint is not None: f.write(f"outpoint {outpoint:.3f}\n")
+            written += 1
+    if not written:
+        raise ValueError("bg_video_list không có mục hợp lệ!")
+    return written
 
 
 # ==============================================================================
@@ -696,30 +777,259 @@ def prepare_background_videos(
 # ==============================================================================
 
 
+def _build_final_encode_args(config, target_duration):
+    """
+    Chọn encoder cho file cuối (CPU/NVENC/VAAPI) theo config và HĐH.
+
+    Returns:
+        tuple: (tên encoder, dict output args cho ffmpeg-python, list global args).
+    """
+    encoder_choice = config.get('encoder_choice', 'libx264').lower()
+    current_os = platform.system()
+    use_nvenc = (encoder_choice in ['h264_nvenc', 'hevc_nvenc'] and current_os == "Windows")
+    use_vaapi = (encoder_choice in ['h264_vaapi', 'hevc_vaapi'] and current_os == "Linux")
+
+    # Args chung cho file cuối
+    final_output_args = {
+        'acodec': 'aac',
+        'audio_bitrate': config.get('audio_bitrate', '192k'),
+        's': config.get('resolution', '1920x1080'),
+        'r': config.get('framerate', 30),
+        't': target_duration,
+        'movflags': '+faststart',
+        'strict': 'experimental', # Có thể cần cho một số muxer/codec
+    }
+    global_args_list = []
+
+    # --- Cấu hình cho NVENC ---
+    if use_nvenc:
+        encoder_name = config.get('hw_encoder', 'h264_nvenc')
+        final_output_args['vcodec'] = encoder_name
+        final_output_args['preset'] = config.get('hw_nvenc_preset', 'p5')
+        nvenc_rc = config.get('hw_nvenc_rc', 'constqp')
+        nvenc_qp = config.get('hw_nvenc_qp') # Giữ là string hoặc None
+        nvenc_bitrate = config.get('hw_nvenc_bitrate', '8000k')
+        final_output_args['rc'] = nvenc_rc
+        if nvenc_rc == 'constqp':
+            final_output_args['qp'] = nvenc_qp if nvenc_qp is not None else '23' # Truyền string qp
+        elif nvenc_rc in ['vbr', 'cbr']:
+            final_output_args['b:v'] = nvenc_bitrate
+        print(f"-> NVENC Options: { {k:v for k,v in final_output_args.items() if k in ['preset','rc','qp','b:v']} }")
+
+    # --- Cấu hình cho VAAPI ---
+    elif use_vaapi:
+        encoder_name = 'h264_vaapi' # Mặc định H.264 cho VAAPI
+        final_output_args['vcodec'] = encoder_name
+        final_output_args['b:v'] = config.get('hw_bitrate', '8000k')
+        # Thêm tùy chọn VAAPI khác nếu có
+        if config.get('hw_vaapi_rc'): final_output_args['rc_mode'] = config['hw_vaapi_rc']
+        if config.get('hw_vaapi_qp'): final_output_args['qp'] = config['hw_vaapi_qp'] # Truyền string qp
+        print(f"-> VAAPI Options: { {k:v for k,v in final_output_args.items() if k in ['b:v','rc_mode','qp']} }")
+        vaapi_device = config.get('vaapi_device_path')
+        if not vaapi_device: raise ConfigError("Thiếu VAAPI_DEVICE")
+        global_args_list = ['-vaapi_device', vaapi_device]
+
+    # --- Cấu hình cho CPU (Fallback) ---
+    else:
+        encoder_name = 'libx264'
+        final_output_args['vcodec'] = encoder_name
+        final_output_args['preset'] = config.get('cpu_preset', 'veryfast')
+        final_output_args['pix_fmt'] = 'yuv420p'
+        # Dùng CRF/Bitrate CPU
+        cpu_crf_val = config.get('cpu_crf')
+        cpu_bitrate_val = config.get('cpu_bitrate')
+        if cpu_crf_val is not None:
+             try: final_output_args['crf'] = int(cpu_crf_val)
+             except Exception: final_output_args['b:v'] = cpu_bitrate_val if cpu_bitrate_val else '6000k'
+        else: final_output_args['b:v'] = cpu_bitrate_val if cpu_bitrate_val else '6000k'
+        print(f"-> CPU Options: { {k:v for k,v in final_output_args.items() if k in ['preset','crf','b:v']} }")
+
+    if config.get('ffmpeg_threads'):
+        final_output_args['threads'] = config['ffmpeg_threads']
+    return encoder_name, final_output_args, global_args_list
+
+
+def _compile_ffmpeg_cmd(stream, global_args_list=None):
+    """Compile stream ffmpeg-python thành list lệnh, chèn global args ngay sau 'ffmpeg'."""
+    compiled_cmd_list = ffmpeg.compile(stream, cmd='ffmpeg')
+    if not compiled_cmd_list: raise ValueError("compile() rỗng.")
+    return compiled_cmd_list[:1] + list(global_args_list or []) + compiled_cmd_list[1:]
+
+
+class RenderProgress:
+    """
+    Tiến độ render của một task, gộp từ một hoặc nhiều tiến trình ffmpeg (render theo đoạn).
+    Ghi vào task (render_progress: percent, fps, speed, ETA) tối đa 1 lần mỗi interval_seconds.
+    """
+
+    def __init__(self, doc_id, total_seconds, interval_seconds=10, writer=None):
+        self.doc_id = doc_id
+        self.total_seconds = max(total_seconds, 1e-6)
+        self.interval_seconds = interval_seconds
+        self.writer = writer or db_handler.update_render_progress
+        self.start_time = time.time()
+        self._parts = {}  # part -> (out_time giây, fps)
+        self._last_write_time = 0.0
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            done_seconds = min(self.total_seconds, sum(out_time for out_time, _ in self._parts.values()))
+            fps = sum(part_fps or 0.0 for _, part_fps in self._parts.values())
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        speed = done_seconds / elapsed
+        return {
+            "percent": round(done_seconds / self.total_seconds * 100, 1),
+            "out_time_seconds": round(done_seconds, 2),
+            "fps": round(fps, 1),
+            "speed": round(speed, 3),
+            "eta_seconds": round((self.total_seconds - done_seconds) / speed) if speed > 0 else None,
+            "updated_at": datetime.datetime.utcnow(),
+        }
+
+    def update(self, part, out_time_seconds, fps=None):
+        with self._lock:
+            self._parts[part] = (max(0.0, out_time_seconds), fps)
+            now = time.time()
+            if now - self._last_write_time < self.interval_seconds:
+                return
+            self._last_write_time = now
+        try:
+            self.writer(self.doc_id, self.snapshot())
+        except Exception as e:
+            print(f"CB: Không ghi được tiến độ render cho {self.doc_id}: {e}")
+
+
+def _drain_stream_lines(stream, sink):
+    """Đọc stream theo dòng (luồng riêng) vào sink (deque giới hạn) -> ffmpeg không bị nghẽn pipe."""
+    for raw_line in iter(stream.readline, b''):
+        sink.append(raw_line.decode('utf-8', errors='replace').rstrip())
+    stream.close()
+
+
+def _start_stderr_tail(process, max_lines):
+    """Trả về (deque chứa max_lines dòng stderr cuối, luồng đọc)."""
+    tail = collections.deque(maxlen=max(1, max_lines))
+    thread = threading.Thread(target=_drain_stream_lines, args=(process.stderr, tail), daemon=True)
+    thread.start()
+    return tail, thread
+
+
+def _parse_progress_stream(stream, progress, part):
+    """Đọc output của '-progress pipe:1' (key=value, mỗi khối kết thúc bằng 'progress=...')."""
+    block = {}
+    for raw_line in iter(stream.readline, b''):
+        key, _, value = raw_line.decode('utf-8', errors='replace').strip().partition('=')
+        if not key:
+            continue
+        block[key] = value
+        if key != 'progress':
+            continue
+        if progress is not None:
+            out_time_us = block.get('out_time_us') or block.get('out_time_ms') # out_time_ms thực ra cũng là micro giây
+            try: out_time_seconds = int(out_time_us) / 1_000_000
+            except (TypeError, ValueError): out_time_seconds = None
+            try: fps = float(block.get('fps'))
+            except (TypeError, ValueError): fps = None
+            if out_time_seconds is not None:
+                progress.update(part, out_time_seconds, fps)
+        block = {}
+    stream.close()
+
+
+def _with_progress_args(cmd):
+    """Chèn '-progress pipe:1 -nostats' ngay sau 'ffmpeg'."""
+    return cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+
+
+def _run_ffmpeg_with_progress(cmd, progress=None, part=0, stderr_tail_lines=200):
+    """
+    Chạy ffmpeg với '-progress pipe:1': tiến độ đọc từ stdout, stderr đọc bởi luồng riêng và chỉ giữ
+    stderr_tail_lines dòng cuối (không buffer toàn bộ stderr của cả tiếng render trong bộ nhớ).
+
+    Returns:
+        tuple: (exit code, stderr cuối cùng dạng string).
+    """
+    process = subprocess.Popen(_with_progress_args(cmd), stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_tail, stderr_thread = _start_stderr_tail(process, stderr_tail_lines)
+    try:
+        _parse_progress_stream(process.stdout, progress, part)
+        returncode = process.wait()
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        stderr_thread.join(timeout=5)
+    return returncode, "\n".join(stderr_tail)
+
+
+def _run_ffmpeg_pipe(producer_cmd, consumer_cmd, progress=None, stderr_tail_lines=200, timer=None):
+    """
+    Chạy 2 tiến trình ffmpeg nối nhau qua pipe (stdout của producer -> stdin của consumer).
+    Tiến độ lấy từ consumer ('-progress pipe:1'); stderr của cả hai được đọc bởi luồng riêng
+    (giữ stderr_tail_lines dòng cuối) để tránh deadlock khi buffer pipe đầy.
+    timer (RenderTimer, optional): ghi thời gian wall của cả pipe vào MỘT stage 'encode_pipe'
+    (2 bước chạy đồng thời nên không tách được thời gian riêng từng bước).
+
+    Returns:
+        tuple: (exit code producer, exit code consumer, stderr producer, stderr consumer).
+    """
+    producer_cmd = producer_cmd[:1] + ['-nostats'] + producer_cmd[1:] # Không ghi dòng thống kê '\r' vô tận ra stderr
+    pipe_start_time = time.perf_counter()
+    producer = subprocess.Popen(producer_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    producer_tail, producer_thread = _start_stderr_tail(producer, stderr_tail_lines)
+    try:
+        consumer = subprocess.Popen(_with_progress_args(consumer_cmd), stdin=producer.stdout,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except Exception:
+        producer.kill()
+        producer.wait()
+        raise
+    producer.stdout.close() # Để producer nhận SIGPIPE nếu consumer thoát sớm
+    consumer_tail, consumer_thread = _start_stderr_tail(consumer, stderr_tail_lines)
+    try:
+        _parse_progress_stream(consumer.stdout, progress, 0)
+        consumer_rc = consumer.wait()
+        producer_rc = producer.wait()
+        if timer is not None:
+            timer.add('encode_pipe', time.perf_counter() - pipe_start_time)
+    except BaseException:
+        for process in (consumer, producer):
+            process.kill()
+            process.wait()
+        raise
+    finally:
+        producer_thread.join(timeout=5)
+        consumer_thread.join(timeout=5)
+    return producer_rc, consumer_rc, "\n".join(producer_tail), "\n".join(consumer_tail)
+
+
 # def generate_video(video_inputs, bg_video_list, output_path, config):
-def generate_single_video_2step(video_inputs, bg_video_list, output_path, config):
+def generate_single_video_2step(video_inputs, bg_video_list, output_path, config, progress=None):
     """
-    Tạo video theo quy trình 2 bước:
-    1. CPU Filter + CPU Encode (chất lượng cao) -> Intermediate File.
-    2. Transcode Intermediate -> Final Output dùng Encoder đã chọn (CPU/NVENC/VAAPI).
+    Tạo video với encoder đã chọn (CPU/NVENC/VAAPI), không ghi file trung gian ra đĩa:
+    - Encoder cuối là libx264 (trùng bước 1): filter + encode MỘT lượt thẳng ra output.
+    - Encoder khác (NVENC/VAAPI): Bước 1 (CPU filter) xuất NUT lossless (mặc định rawvideo + PCM)
+      ra stdout, Bước 2 đọc từ stdin và encode bằng encoder đã chọn.
 
     Args:
         video_inputs (dict): Chứa đường dẫn input chính đã validate.
         bg_video_list (list): Danh sách video nền đã chọn.
         output_path (str): Đường dẫn file output cuối cùng.
         config (dict): Dictionary cấu hình chung đã load và tính toán.
+        progress (RenderProgress, optional): Nhận tiến độ từ '-progress' của ffmpeg.
 
     Returns:
-        bool: True nếu cả 2 bước thành công, False nếu có lỗi.
+        bool: True nếu tạo video thành công, False nếu có lỗi.
     """
     func_start_time = time.time()
     base_output_name = os.path.basename(output_path)
-    print(f"\n--- Bắt đầu tạo video 2 BƯỚC: {base_output_name} ---")
+    print(f"\n--- Bắt đầu tạo video (CPU filter -> encoder đã chọn): {base_output_name} ---")
 
     concat_file_path = None
-    intermediate_file_path = None
-    success_step1 = False
-    success_step2 = False
+    success = False
     compiled_cmd_list_step1 = None
     compiled_cmd_list_step2 = None
 
@@ -733,24 +1043,15 @@ def generate_single_video_2step(video_inputs, bg_video_list, output_path, config
 
         concat_filename = f"concat_{base_output_name}_{timestamp}.txt"
         concat_file_path = os.path.join(temp_dir, concat_filename)
-        intermediate_filename = f"intermediate_{base_output_name}_{timestamp}.mkv"
-        intermediate_file_path = os.path.join(temp_dir, intermediate_filename)
-
         print(f"-> File concat tạm: {concat_file_path}")
-        print(f"-> File trung gian sẽ tạo: {intermediate_file_path}")
 
         if not isinstance(bg_video_list, list) or not bg_video_list:
             raise ValueError("bg_video_list rỗng hoặc không hợp lệ!")
 
         # Ghi file concat
-        with open(concat_file_path, 'w', encoding='utf-8') as f:
-            print("-> Đang ghi file concat...")
-            for video_file in bg_video_list:
-                if not isinstance(video_file, str): continue
-                if "'" in video_file: print(f"!!! CB: Tên file chứa dấu nháy đơn: {video_file}")
-                safe_path = video_file.replace('\\', '/')
-                line_to_write = f"file '{safe_path}'\n"
-                f.write(line_to_write)
+        print("-> Đang ghi file concat...")
+        with _stage(config, "concat_write"):
+            _write_concat_file(concat_file_path, bg_video_list)
         print(f"-> Đã ghi xong file concat.")
 
         # Lấy thời lượng
@@ -759,14 +1060,16 @@ def generate_single_video_2step(video_inputs, bg_video_list, output_path, config
         if target_duration <= 0: raise ValueError("Duration audio chính <= 0")
         print(f"-> Thời lượng đích: {target_duration:.2f}s")
 
-        # ==================== BƯỚC 1: TẠO FILE TRUNG GIAN (CPU) ====================
-        print("\n--- Bước 1: Tạo file trung gian (CPU Encode) ---")
-        step1_process_start_time = time.time()
-        try:
-            # --- Xây dựng Filter Graph (Bước 1 - CPU) ---
-            print("-> Chuẩn bị filter graph (Bước 1)...")
-            # Inputs
-            input_videos = ffmpeg.input(concat_file_path, format='concat', safe=0, itsoffset=0)
+        # --- Xây dựng Filter Graph (CPU) ---
+        print("-> Chuẩn bị filter graph...")
+        # Inputs
+        input_videos = ffmpeg.input(concat_file_path, format='concat', safe=0, itsoffset=0)
+        premixed_audio_path = video_inputs.get('mixed_audio')
+        if premixed_audio_path:
+            # Audio đã mix sẵn (prepare_task_audio): waveform đọc PCM đã giải mã, audio chỉ mux -c:a copy
+            waveform_audio_input = ffmpeg.input(video_inputs.get('narration_pcm') or video_inputs['main_audio'])
+            mixed_audio = ffmpeg.input(premixed_audio_path)['a']
+        else:
             input_main_audio = ffmpeg.input(video_inputs['main_audio'])
             try:
                 split_audio = input_main_audio.asplit()
@@ -774,252 +1077,656 @@ def generate_single_video_2step(video_inputs, bg_video_list, output_path, config
             except Exception:
                 main_audio_stream = waveform_audio_input = input_main_audio
             input_bg_music = ffmpeg.input(video_inputs['bg_music'], stream_loop=-1)
-            input_overlay_vid = ffmpeg.input(video_inputs['overlay_video'], stream_loop=-1)
-            input_overlay_img_raw = ffmpeg.input(video_inputs['overlay_image'])
-            input_text_img_raw = ffmpeg.input(video_inputs['text_image'])
-
-            # CPU Filters
-            input_overlay_img = input_overlay_img_raw.filter('scale', h=config['target_height'], w=-1) # Full Height
-            input_text_img = input_text_img_raw.filter('scale', w=config['overlay_text_width'], h=-1)
-            waveform_video = waveform_audio_input.filter(
-                'showfreqs', s=f"{config['waveform_w']}x{config['waveform_h']}",
-                mode=config.get('waveform_mode', 'bar'), ascale=config.get('waveform_ascale', 'log'),
-                fscale=config.get('waveform_fscale', 'log'), win_size=config.get('waveform_win_size', 2048),
-                win_func=config.get('waveform_win_func', 'hann'), colors=config.get('waveform_color', 'white'),
-                rate=config.get('framerate', 30)
-            ).filter('format', pix_fmts='yuva420p')
-            processed_video = input_videos.trim(duration=target_duration).filter('setpts', 'PTS-STARTPTS')
-            processed_overlay_vid = input_overlay_vid.trim(duration=target_duration).filter('setpts', 'PTS-STARTPTS')
-            overlay_vid_with_opacity = processed_overlay_vid.filter('format', pix_fmts='yuva420p') \
-                                                          .filter('colorchannelmixer', aa=config.get('overlay_opacity', 0.25))
             processed_bg_music_trimmed = input_bg_music.filter('atrim', duration=target_duration).filter('asetpts', 'PTS-STARTPTS')
             processed_bg_music = processed_bg_music_trimmed.filter('volume', volume=config.get('bg_music_volume', 0.3))
             mixed_audio = ffmpeg.filter([main_audio_stream, processed_bg_music], 'amix', inputs=2, duration='first')
+        input_overlay_vid = ffmpeg.input(video_inputs['overlay_video'], stream_loop=-1)
+        input_overlay_img_raw = ffmpeg.input(video_inputs['overlay_image'])
+        input_text_img_raw = ffmpeg.input(video_inputs['text_image'])
 
-            # Ghép các lớp video (BG -> CharImg -> OverlayVid -> TextImg -> Waveform)
-            print("-> Applying overlays...")
-            char_img_x = f"main_w-overlay_w-{config.get('margin_right', 15)}"; char_img_y = '0'
-            merged_layer1 = ffmpeg.overlay(processed_video, input_overlay_img, x=char_img_x, y=char_img_y, shortest=False)
-            merged_layer2 = ffmpeg.overlay(merged_layer1, overlay_vid_with_opacity, x=0, y=0, shortest=False)
-            text_img_x = f"{config.get('margin_left', 15)}"; text_img_y = '(main_h-overlay_h)/2'
-            merged_layer3 = ffmpeg.overlay(merged_layer2, input_text_img, x=text_img_x, y=text_img_y, shortest=False)
-            waveform_x = '(main_w-overlay_w)/2'; waveform_y = f"main_h-overlay_h-{config.get('waveform_margin_bottom', 50)}"
-            final_video = ffmpeg.overlay(merged_layer3, waveform_video, x=waveform_x, y=waveform_y, shortest=False)
-
-            # --- Output Args (Bước 1 - CPU Intermediate) ---
-            # Sử dụng cài đặt CPU từ config cho file trung gian
-            intermediate_output_args = {
-                'vcodec': 'libx264',
-                'acodec': 'aac', # Dùng AAC để bước sau copy được
-                'audio_bitrate': config.get('audio_bitrate', '192k'),
-                's': config.get('resolution', '1920x1080'),
-                'pix_fmt': 'yuv420p',
-                'r': config.get('framerate', 30),
-                't': target_duration,
-                'preset': config.get('cpu_preset', 'veryfast'),
-                'strict': 'experimental',
-            }
-            # Ưu tiên CRF cho chất lượng trung gian
-            cpu_crf_val_str = config.get('cpu_crf') # Lấy giá trị CRF từ config
-            if cpu_crf_val_str is not None:
-                try: intermediate_output_args['crf'] = int(cpu_crf_val_str)
-                except Exception: intermediate_output_args['b:v'] = config.get('cpu_bitrate', '6000k')
-            else: intermediate_output_args['b:v'] = config.get('cpu_bitrate', '6000k')
-            # Xóa key không dùng
-            if 'crf' in intermediate_output_args: intermediate_output_args.pop('b:v', None)
-            else: intermediate_output_args.pop('crf', None)
-
-
-            print(f"-> Chuẩn bị tạo file trung gian: {intermediate_file_path}")
-            print(f"-> CPU Encode Options (Intermediate): { {k:v for k,v in intermediate_output_args.items() if k in ['preset','crf','b:v']} }")
+        # CPU Filters
+        input_overlay_img = input_overlay_img_raw.filter('scale', h=config['target_height'], w=-1) # Full Height
+        input_text_img = input_text_img_raw.filter('scale', w=config['overlay_text_width'], h=-1)
+        waveform_video = _waveform_layer(video_inputs, config, waveform_audio_input)
+        processed_video = input_videos.trim(duration=target_duration).filter('setpts', 'PTS-STARTPTS')
+        processed_overlay_vid = input_overlay_vid.trim(duration=target_duration).filter('setpts', 'PTS-STARTPTS')
+        overlay_vid_with_opacity = processed_overlay_vid.filter('format', pix_fmts='yuva420p') \
+                                                      .filter('colorchannelmixer', aa=config.get('overlay_opacity', 0.25))
 
-            # --- Thực thi FFmpeg (Bước 1) ---
+        # Ghép các lớp video (BG -> CharImg -> OverlayVid -> TextImg -> Waveform)
+        print("-> Applying overlays...")
+        char_img_x = f"main_w-overlay_w-{config.get('margin_right', 15)}"; char_img_y = '0'
+        merged_layer1 = ffmpeg.overlay(processed_video, input_overlay_img, x=char_img_x, y=char_img_y, shortest=False)
+        merged_layer2 = ffmpeg.overlay(merged_layer1, overlay_vid_with_opacity, x=0, y=0, shortest=False)
+        text_img_x = f"{config.get('margin_left', 15)}"; text_img_y = '(main_h-overlay_h)/2'
+        merged_layer3 = ffmpeg.overlay(merged_layer2, input_text_img, x=text_img_x, y=text_img_y, shortest=False)
+        final_video = _overlay_waveform(merged_layer3, waveform_video, config)
+
+        # --- Xác định encoder cuối ---
+        encoder_name_step2, final_output_args, global_args_list_step2 = _build_final_encode_args(config, target_duration)
+        if premixed_audio_path:
+            final_output_args.pop('audio_bitrate', None)
+            final_output_args['acodec'] = 'copy'
+        encode_start_time = time.time()
+
+        if encoder_name_step2 == 'libx264':
+            # ==================== MỘT LƯỢT: FILTER + ENCODE libx264 ====================
+            # Bước 2 trùng encoder với bước 1 -> encode 2 lần chỉ tốn thời gian và giảm chất lượng
+            print(f"\n--- Encoder cuối trùng bước 1 ({encoder_name_step2}): render một lượt ---")
+            single_stream = ffmpeg.output(final_video, mixed_audio, output_path, **final_output_args).overwrite_output()
+            compiled_cmd_list_step1 = _compile_ffmpeg_cmd(single_stream, global_args_list_step2)
+            print(f"-> Lệnh FFmpeg (một lượt - {encoder_name_step2}):")
+            print(subprocess.list2cmdline(compiled_cmd_list_step1))
+            with _stage(config, "encode"):
+                single_rc, stderr_single = _run_ffmpeg_with_progress(
+                    compiled_cmd_list_step1, progress, stderr_tail_lines=config.get('ffmpeg_stderr_tail_lines', 200)
+                )
+            print(f"-> Hoàn thành encode. Exit code: {single_rc}")
+            if single_rc != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) <= 100:
+                print(f"!!! LỖI RENDER (Exit Code: {single_rc}) !!!")
+                print(f"--- FFmpeg stderr (các dòng cuối) ---\n{stderr_single or '(Không có stderr)'}\n--- End stderr ---")
+                raise RuntimeError(f"Render {encoder_name_step2} thất bại.")
+        else:
+            # ==================== HAI BƯỚC NỐI QUA PIPE (không ghi file trung gian) ====================
+            pipe_vcodec = config.get('pipe_intermediate_vcodec', 'rawvideo')
+            print(f"\n--- Bước 1 (CPU filter, {pipe_vcodec}/NUT) | Bước 2 ({encoder_name_step2}) qua pipe ---")
+            step1_streams = [final_video] if premixed_audio_path else [final_video, mixed_audio]
+            step1_audio_args = {} if premixed_audio_path else {'acodec': 'pcm_s16le'}
             step1_stream = ffmpeg.output(
-                final_video, mixed_audio, intermediate_file_path, **intermediate_output_args
+                *step1_streams, 'pipe:', format='nut',
+                vcodec=pipe_vcodec, pix_fmt='yuv420p', **step1_audio_args,
+                s=config.get('resolution', '1920x1080'), r=config.get('framerate', 30), t=target_duration,
             )
-            step1_stream = step1_stream.overwrite_output()
-            compiled_cmd_list_step1 = ffmpeg.compile(step1_stream, cmd='ffmpeg')
-            print("-> Lệnh FFmpeg (Bước 1 - CPU Intermediate):")
+            compiled_cmd_list_step1 = _compile_ffmpeg_cmd(step1_stream)
+            input_pipe = ffmpeg.input('pipe:', format='nut')
+            # Audio đã mix sẵn -> Bước 2 lấy thẳng từ file (copy), không qua pipe
+            step2_audio = ffmpeg.input(premixed_audio_path)['a'] if premixed_audio_path else input_pipe['a']
+            step2_stream = ffmpeg.output(
+                input_pipe['v'], step2_audio, # Chọn luồng video/audio
+                output_path, **final_output_args
+            ).overwrite_output()
+            compiled_cmd_list_step2 = _compile_ffmpeg_cmd(step2_stream, global_args_list_step2)
+            print("-> Lệnh FFmpeg (Bước 1 - CPU filter -> stdout):")
             print(subprocess.list2cmdline(compiled_cmd_list_step1))
+            print(f"-> Lệnh FFmpeg (Bước 2 - stdin -> {encoder_name_step2}):")
+            print(subprocess.list2cmdline(compiled_cmd_list_step2))
+
+            with _stage(config, "encode"):
+                step1_rc, step2_rc, stderr_step1, stderr_step2 = _run_ffmpeg_pipe(
+                    compiled_cmd_list_step1, compiled_cmd_list_step2, progress,
+                    stderr_tail_lines=config.get('ffmpeg_stderr_tail_lines', 200),
+                    timer=config.get('render_timer'),
+                )
+            print(f"-> Hoàn thành encode. Exit code: Bước 1={step1_rc}, Bước 2={step2_rc}")
+            if step1_rc != 0 or step2_rc != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) <= 100:
+                print(f"!!! LỖI RENDER QUA PIPE (Exit Code: {step1_rc}/{step2_rc}) !!!")
+                print(f"--- FFmpeg stderr (Bước 1) ---\n{stderr_step1 or '(Không có stderr)'}\n--- End stderr ---")
+                print(f"--- FFmpeg stderr (Bước 2) ---\n{stderr_step2 or '(Không có stderr)'}\n--- End stderr ---")
+                raise RuntimeError(f"Transcode {encoder_name_step2} thất bại.")
 
-            print("\n-> Bắt đầu encode Bước 1 (CPU)...")
-            step1_sp_result = subprocess.run(
-                compiled_cmd_list_step1, capture_output=True, text=True,
-                encoding='utf-8', errors='replace', check=False
-            )
-            print(f"-> Hoàn thành encode Bước 1. Exit code: {step1_sp_result.returncode}")
-
-            # Kiểm tra lỗi Bước 1
-            if step1_sp_result.returncode != 0 or not os.path.exists(intermediate_file_path) or os.path.getsize(intermediate_file_path) <= 100:
-                print(f"!!! LỖI TẠO FILE TRUNG GIAN (Exit Code: {step1_sp_result.returncode}) !!!")
-                stderr_step1 = step1_sp_result.stderr if step1_sp_result.stderr else "(Không có stderr)"
-                print(f"--- FFmpeg stderr (Bước 1) ---\n{stderr_step1}\n--- End stderr ---")
-                raise RuntimeError("Tạo file trung gian thất bại.")
-            else:
-                 print(f"-> Đã tạo file trung gian thành công: {intermediate_file_path}")
-                 success_step1 = True
-
-        except Exception as e_step1:
-            print(f"!!! Lỗi trong Bước 1: {e_step1}")
-            if compiled_cmd_list_step1:
-                try: print("-> Lệnh FFmpeg lỗi (Bước 1):\n", subprocess.list2cmdline(compiled_cmd_list_step1))
-                except Exception: pass
-            if not isinstance(e_step1, RuntimeError): traceback.print_exc()
-            raise # Ném lại lỗi
-
-        step1_end_time = time.time()
-        print(f"--- Hoàn thành Bước 1 trong {step1_end_time - step1_process_start_time:.2f} giây ---")
-
-
-        # ==================== BƯỚC 2: CHUYỂN MÃ SANG FILE CUỐI (GPU/CPU) ====================
-        if success_step1:
-            step2_start_time = time.time()
-            compiled_cmd_list_step2 = None
-            encoder_name_step2 = 'libx264' # Mặc định
-            global_args_list_step2 = []
-            final_output_args = {}
-
-            try:
-                # --- Xác định Encoder và chuẩn bị Args cho Bước 2 ---
-                encoder_choice = config.get('encoder_choice', 'libx264').lower()
-                current_os = platform.system()
-                use_nvenc = (encoder_choice in ['h264_nvenc', 'hevc_nvenc'] and current_os == "Windows")
-                use_vaapi = (encoder_choice in ['h264_vaapi', 'hevc_vaapi'] and current_os == "Linux")
-
-                input_intermediate = ffmpeg.input(intermediate_file_path)
-
-                # Args chung cho Bước 2
-                final_output_args = {
-                    'acodec': 'copy', # Copy audio từ file trung gian
-                    's': config.get('resolution', '1920x1080'),
-                    'r': config.get('framerate', 30),
-                    't': target_duration,
-                    'movflags': '+faststart',
-                    'strict': 'experimental', # Có thể cần cho một số muxer/codec
-                }
-
-                # --- Cấu hình cho NVENC ---
-                if use_nvenc:
-                    encoder_name_step2 = config.get('hw_encoder', 'h264_nvenc')
-                    print(f"\n--- Bước 2: Chuyển mã sang file cuối cùng (NVENC Transcode) ---")
-                    final_output_args['vcodec'] = encoder_name_step2
-                    final_output_args['preset'] = config.get('hw_nvenc_preset', 'p5')
-                    nvenc_rc = config.get('hw_nvenc_rc', 'constqp')
-                    nvenc_qp = config.get('hw_nvenc_qp') # Giữ là string hoặc None
-                    nvenc_bitrate = config.get('hw_nvenc_bitrate', '8000k')
-                    final_output_args['rc'] = nvenc_rc
-                    if nvenc_rc == 'constqp':
-                        final_output_args['qp'] = nvenc_qp if nvenc_qp is not None else '23' # Truyền string qp
-                    elif nvenc_rc in ['vbr', 'cbr']:
-                        final_output_args['b:v'] = nvenc_bitrate
-                    print(f"-> NVENC Options: { {k:v for k,v in final_output_args.items() if k in ['preset','rc','qp','b:v']} }")
-                    # Thử không dùng global args cho NVENC transcode đơn giản
-                    global_args_list_step2 = []
-                    print(f"-> Using Global Args (Step 2 - NVENC): {global_args_list_step2}")
-
-                # --- Cấu hình cho VAAPI ---
-                elif use_vaapi:
-                    encoder_name_step2 = 'h264_vaapi' # Mặc định H.264 cho VAAPI
-                    print(f"\n--- Bước 2: Chuyển mã sang file cuối cùng (VAAPI Transcode) ---")
-                    final_output_args['vcodec'] = encoder_name_step2
-                    final_output_args['b:v'] = config.get('hw_bitrate', '8000k')
-                    # Thêm tùy chọn VAAPI khác nếu có
-                    if config.get('hw_vaapi_rc'): final_output_args['rc_mode'] = config['hw_vaapi_rc']
-                    if config.get('hw_vaapi_qp'): final_output_args['qp'] = config['hw_vaapi_qp'] # Truyền string qp
-                    print(f"-> VAAPI Options: { {k:v for k,v in final_output_args.items() if k in ['b:v','rc_mode','qp']} }")
-                    # Global Args cho VAAPI
-                    vaapi_device = config.get('vaapi_device_path')
-                    if not vaapi_device: raise ConfigError("Thiếu VAAPI_DEVICE")
-                    global_args_list_step2 = ['-vaapi_device', vaapi_device]
-                    print(f"-> Using Global Args (Step 2 - VAAPI): {global_args_list_step2}")
-
-                # --- Cấu hình cho CPU (Fallback) ---
-                else:
-                    encoder_name_step2 = 'libx264'
-                    print(f"\n--- Bước 2: Chuyển mã sang file cuối cùng (CPU Transcode) ---")
-                    final_output_args['vcodec'] = encoder_name_step2
-                    final_output_args['preset'] = config.get('cpu_preset', 'veryfast')
-                    final_output_args['pix_fmt'] = 'yuv420p'
-                    # Dùng CRF/Bitrate CPU
-                    cpu_crf_val = config.get('cpu_crf')
-                    cpu_bitrate_val = config.get('cpu_bitrate')
-                    if cpu_crf_val is not None:
-                         try: final_output_args['crf'] = int(cpu_crf_val)
-                         except Exception: final_output_args['b:v'] = cpu_bitrate_val if cpu_bitrate_val else '6000k'
-                    else: final_output_args['b:v'] = cpu_bitrate_val if cpu_bitrate_val else '6000k'
-                    print(f"-> CPU Options: { {k:v for k,v in final_output_args.items() if k in ['preset','crf','b:v']} }")
-                    global_args_list_step2 = []
-
-                # --- Thực thi FFmpeg (Bước 2) ---
-                step2_stream = ffmpeg.output(
-                    input_intermediate['v'], input_intermediate['a'], # Chọn luồng video/audio
-                    output_path, **final_output_args
-                ).overwrite_output()
-
-                compiled_cmd_list_step2 = ffmpeg.compile(step2_stream)
-                if not compiled_cmd_list_step2: raise ValueError("compile() Bước 2 rỗng.")
-                if compiled_cmd_list_step2[0].lower().endswith('ffmpeg'):
-                    step2_full_cmd = ( compiled_cmd_list_step2[:1] + global_args_list_step2 + compiled_cmd_list_step2[1:] )
-                else: step2_full_cmd = ['ffmpeg'] + global_args_list_step2 + compiled_cmd_list_step2
-
-                print(f"-> Lệnh FFmpeg (Bước 2 - {encoder_name_step2}):")
-                print(subprocess.list2cmdline(step2_full_cmd))
-                print(f"\n-> Bắt đầu encode Bước 2 ({encoder_name_step2})...")
-                step2_sp_result = subprocess.run(step2_full_cmd, capture_output=True, text=True, encoding='utf-8', errors='replace', check=False)
-                print(f"-> Hoàn thành encode Bước 2. Exit code: {step2_sp_result.returncode}")
-
-                # Kiểm tra lỗi Bước 2
-                if step2_sp_result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) <= 100:
-                    print(f"!!! LỖI TRANSCODE BƯỚC 2 (Exit Code: {step2_sp_result.returncode}) !!!")
-                    stderr_step2 = step2_sp_result.stderr if step2_sp_result.stderr else "(Không có stderr)"
-                    print(f"--- FFmpeg stderr (Bước 2) ---\n{stderr_step2}\n--- End stderr ---")
-                    raise RuntimeError(f"Transcode {encoder_name_step2} thất bại.")
-                else:
-                    print(f"-> Video cuối cùng đã tạo thành công: {output_path}")
-                    success_step2 = True
-
-            except Exception as e_step2:
-                print(f"!!! Lỗi trong Bước 2 ({encoder_name_step2}): {e_step2}")
-                if compiled_cmd_list_step2:
-                     try: print("-> Lệnh FFmpeg lỗi (Bước 2):\n", subprocess.list2cmdline(compiled_cmd_list_step2))
-                     except Exception: pass
-                # Không ném lại lỗi ở đây để cleanup file trung gian
-                success_step2 = False # Đánh dấu bước 2 thất bại
-
-            step2_end_time = time.time()
-            print(f"--- Hoàn thành Bước 2 trong {step2_end_time - step2_start_time:.2f} giây ---")
-
-        # Thành công cuối cùng nếu cả 2 bước OK
-        success = success_step1 and success_step2
+        print(f"-> Video cuối cùng đã tạo thành công: {output_path}")
+        print(f"--- Hoàn thành encode trong {time.time() - encode_start_time:.2f} giây ---")
+        success = True
 
     # Xử lý lỗi chung của toàn bộ hàm
     except Exception as e_main:
-        print(f"\n!!! Lỗi trong quá trình tạo video '{os.path.basename(output_path)}' (2-Step) !!!")
+        print(f"\n!!! Lỗi trong quá trình tạo video '{os.path.basename(output_path)}' !!!")
         print(f"Lỗi: {e_main}")
         if not isinstance(e_main, (FileNotFoundError, NotADirectoryError, OSError, ValueError, ConfigError, RuntimeError)):
              traceback.print_exc()
 
     finally:
         # --- Dọn dẹp file tạm ---
-        print("-> Bắt đầu dọn dẹp file tạm...")
         if concat_file_path and os.path.exists(concat_file_path):
             try: os.remove(concat_file_path)
             except OSError as e: print(f"CB: Lỗi xóa {concat_file_path}: {e}")
-        if intermediate_file_path and os.path.exists(intermediate_file_path):
-            try: os.remove(intermediate_file_path); print(f"-> Đã xóa file trung gian: {intermediate_file_path}")
-            except OSError as e: print(f"CB: Lỗi xóa {intermediate_file_path}: {e}")
 
         end_time = time.time()
         total_duration_func = end_time - func_start_time
         print(f"--- Kết thúc tạo video {os.path.basename(output_path)} (Thời gian hàm: {total_duration_func:.2f} giây) ---")
-        return success
+    return success
 
 
 
 # ==============================================================================
 # SECTION 6: HÀM MAIN ĐIỀU PHỐI
 # ==============================================================================
-def generate_cpu_video(video_inputs, bg_video_list, output_path, config):
+def prepare_static_overlay_layers(overlay_image_path, text_image_path, work_dir, config):
+    """
+    Scale sẵn (bằng Pillow) ảnh nhân vật và ảnh chữ thành 2 PNG RGBA đúng kích thước như filter graph cũ
+    -> bỏ được 2 filter scale mỗi frame, vẫn giữ nguyên thứ tự lớp (ảnh NV nằm DƯỚI video mờ, chữ ở TRÊN).
+
+    Returns:
+        dict: {'overlay_image': path PNG ảnh NV, 'text_image': path PNG ảnh chữ} hoặc None nếu thiếu Pillow.
+    """
+    if not PIL_AVAILABLE:
+        return None
+    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+    target_h, text_w = config['target_height'], config['overlay_text_width']
+    layers = {}
+    for key, image_path, size_fn in (
+        # Ảnh NV: cao bằng khung hình (scale h=target_height, w=-1)
+        ('overlay_image', overlay_image_path, lambda w, h: (round(w * target_h / h), target_h)),
+        # Ảnh chữ: rộng overlay_text_width (scale w=overlay_text_width, h=-1)
+        ('text_image', text_image_path, lambda w, h: (text_w, round(h * text_w / w))),
+    ):
+        output_png_path = os.path.join(work_dir, f"static_{key}_{timestamp}.png")
+        with Image.open(image_path) as img:
+            img = img.convert("RGBA")
+            new_w, new_h = size_fn(img.width, img.height)
+            img.resize((max(1, new_w), max(1, new_h)), Image.LANCZOS).save(output_png_path, format="PNG")
+        layers[key] = output_png_path
+    return layers
+
+
+def _prepare_static_layers_for_render(video_inputs, work_dir, config):
+    """Scale sẵn ảnh NV + ảnh chữ cho một lần render nếu được bật. Trả về dict path PNG hoặc None (dùng graph cũ)."""
+    if not config.get('precompose_static_layer', True):
+        return None
+    if not PIL_AVAILABLE:
+        print("CB: Chưa cài Pillow -> không scale sẵn ảnh tĩnh (pip install Pillow).")
+        return None
+    try:
+        with _stage(config, "static_layer"):
+            static_layers = prepare_static_overlay_layers(
+                video_inputs['overlay_image'], video_inputs['text_image'], work_dir, config
+            )
+        if static_layers:
+            print(f"-> Đã scale sẵn ảnh tĩnh: {static_layers['overlay_image']}, {static_layers['text_image']}")
+            return static_layers
+    except Exception as e:
+        print(f"CB: Không scale sẵn được ảnh tĩnh ({e}). Dùng filter graph đầy đủ.")
+    return None
+
+
+def _remove_static_layers(static_layers):
+    """Xóa các PNG tạm do _prepare_static_layers_for_render tạo ra."""
+    for layer_path in (static_layers or {}).values():
+        if layer_path and os.path.exists(layer_path):
+            try: os.remove(layer_path)
+            except OSError as e: print(f"Cảnh báo: Lỗi xóa file tạm {layer_path}: {e}")
+
+
+def _static_image_inputs(video_inputs, static_layers):
+    """Input ffmpeg cho ảnh NV / ảnh chữ: PNG đã scale sẵn nếu có, ngược lại ảnh gốc."""
+    source = static_layers or video_inputs
+    return ffmpeg.input(source['overlay_image']), ffmpeg.input(source['text_image'])
+
+
+def _compose_cpu_layers(background_video, overlay_video, overlay_img_input, text_img_input, config,
+                        prescaled=False):
+    """
+    Ghép các lớp video theo thứ tự Z (từ dưới lên): BG -> Ảnh NV -> Video Mờ -> Ảnh Chữ.
+
+    Args:
+        background_video: Stream video nền đã trim/setpts.
+        overlay_video: Stream video lớp phủ (lặp) đã trim/setpts.
+        overlay_img_input / text_img_input: Input ảnh nhân vật / ảnh chữ.
+        config (dict): Cấu hình chung.
+        prescaled (bool): True nếu 2 ảnh đã được scale sẵn (prepare_static_overlay_layers) -> bỏ filter scale.
+
+    Returns:
+        Stream video đã ghép.
+    """
+    if prescaled:
+        print("-> Ảnh nhân vật / ảnh chữ đã scale sẵn, bỏ qua filter scale.")
+        input_overlay_img, input_text_img = overlay_img_input, text_img_input
+    else:
+        # Scale Ảnh Lớp phủ
+        print(f"-> Scaling ảnh nhân vật to width: {config['overlay_char_width']}px (~40%)")
+        input_overlay_img = overlay_img_input.filter('scale', h=config['target_height'], w=-1) # <-- Sửa lại h
+
+        print(f"-> Scaling ảnh chữ to width: {config['overlay_text_width']}px (~60%)")
+        input_text_img = text_img_input.filter('scale', w=config['overlay_text_width'], h=-1)
+
+    overlay_vid_with_opacity = overlay_video.filter('format', pix_fmts='yuva420p') \
+                                            .filter('colorchannelmixer', aa=config.get('overlay_opacity', 0.25))
+
+    print("-> Applying overlays (Order: BG->CharImg->OverlayVid->TextImg->Waveform)...")
+
+    # Lớp 1: Video nền (background_video) + Ảnh Nhân Vật (input_overlay_img)
+    # Ảnh NV ở bên phải, giữa dọc (hoặc full height tùy bạn chọn ở bước scale)
+    char_img_x = f"main_w-overlay_w-{config.get('margin_right', 15)}"
+    char_img_y = '(main_h-overlay_h)/2'
+    merged_layer1 = ffmpeg.overlay(
+        background_video,    # Input chính (nền)
+        input_overlay_img,   # Lớp phủ 1 (Ảnh NV đã scale)
+        x=char_img_x,
+        y=char_img_y,
+        shortest=False
+    )
+    print("DEBUG: Applied CharImg")
+
+    # Lớp 2: Lớp 1 (BG+Char) + Video Lớp Phủ Mờ (overlay_vid_with_opacity)
+    # Video này phủ toàn khung hình
+    merged_layer2 = ffmpeg.overlay(
+        merged_layer1,            # Input chính (BG + Char)
+        overlay_vid_with_opacity, # Lớp phủ 2 (Video mờ)
+        x=0,
+        y=0,
+        shortest=False
+    )
+    print("DEBUG: Applied OverlayVid")
+
+    # Lớp 3: Lớp 2 (BG+Char+Vid) + Ảnh Chữ (input_text_img)
+    # Ảnh chữ ở bên trái, giữa dọc
+    text_img_x = f"{config.get('margin_left', 15)}"
+    text_img_y = '(main_h-overlay_h)/2'
+    final_video = ffmpeg.overlay(
+        merged_layer2,       # Input chính (BG + Char + Vid)
+        input_text_img,      # Lớp phủ 3 (Ảnh chữ đã scale)
+        x=text_img_x,
+        y=text_img_y,
+        shortest=False
+     )
+    print("DEBUG: Applied TextImg")
+    return final_video
+
+
+def _build_waveform_video(audio_stream, config, pix_fmt='yuva420p'):
+    """Lớp waveform (showfreqs, có alpha) từ một luồng audio."""
+    showfreqs_mode = config.get('waveform_mode', 'bar')
+    if showfreqs_mode == 'numpy': # Engine numpy không dùng được trong filter graph -> showfreqs dạng cột
+        showfreqs_mode = 'bar'
+    return audio_stream.filter(
+        'showfreqs', s=f"{config['waveform_w']}x{config['waveform_h']}",
+        mode=showfreqs_mode, ascale=config.get('waveform_ascale', 'log'),
+        fscale=config.get('waveform_fscale', 'log'), win_size=config.get('waveform_win_size', 2048),
+        win_func=config.get('waveform_win_func', 'hann'), colors=config.get('waveform_color', 'white'),
+        rate=config.get('framerate', 30)
+    ).filter('format', pix_fmts=pix_fmt)
+
+
+def _waveform_track_config(config, showfreqs=False):
+    """
+    Config dùng để tính key cache của track: WAVEFORM_MODE=numpy nhưng render bằng showfreqs (chưa cài numpy
+    hoặc engine numpy lỗi) -> lưu dưới key của mode 'bar', không làm bẩn key của engine numpy.
+    """
+    if config.get('waveform_mode') == 'numpy' and (showfreqs or not waveform_numpy.NUMPY_AVAILABLE):
+        return dict(config, waveform_mode='bar')
+    return config
+
+
+def waveform_track_path(audio_path, config):
+    """Đường dẫn track waveform trong cache: key = hash nội dung audio + tham số waveform."""
+    container, _ = WAVEFORM_TRACK_CODECS[config.get('waveform_track_codec', 'qtrle')]
+    material = {"audio": hash_file(audio_path), "config": {key: config.get(key) for key in WAVEFORM_TRACK_CONFIG_KEYS}}
+    key = hashlib.sha256(json.dumps(material, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(config['waveform_cache_dir'], f"{key}.{container}")
+
+
+def prepare_waveform_track(audio_path, config, source_audio_path=None):
+    """
+    Render waveform (showfreqs) MỘT lần cho một file audio ra track có alpha (qtrle/png/prores 4444)
+    và lưu cache. Các lần render lại / retry chỉ overlay track này, không chạy lại FFT.
+
+    Args:
+        audio_path (str): File audio gốc (dùng để tính key cache).
+        source_audio_path (str, optional): File để giải mã thực tế (vd: PCM đã giải mã sẵn).
+
+    Returns:
+        str: Đường dẫn track, hoặc None nếu render thất bại.
+    """
+    config = _waveform_track_config(config)
+    track_path = waveform_track_path(audio_path, config)
+    if os.path.exists(track_path) and os.path.getsize(track_path) > 100:
+        print(f"-> Dùng lại track waveform đã cache: {os.path.basename(track_path)}")
+        _touch_cache_entry(track_path)
+        return track_path
+    os.makedirs(os.path.dirname(track_path), exist_ok=True)
+    _, codec_args = WAVEFORM_TRACK_CODECS[config.get('waveform_track_codec', 'qtrle')]
+    temp_path = f"{os.path.splitext(track_path)[0]}.partial{os.path.splitext(track_path)[1]}"
+    start_time = time.time()
+    if config.get('waveform_mode') == 'numpy':
+        if _render_waveform_track_numpy(source_audio_path, temp_path, codec_args, config):
+            os.replace(temp_path, track_path)
+            print(f"-> Đã render track waveform bằng numpy ({time.time() - start_time:.2f}s): {os.path.basename(track_path)}")
+            prune_waveform_cache(config)
+            return track_path
+        # Engine numpy lỗi -> track showfreqs lưu dưới key của mode 'bar'
+        config = _waveform_track_config(config, showfreqs=True)
+        track_path = waveform_track_path(audio_path, config)
+        if os.path.exists(track_path) and os.path.getsize(track_path) > 100:
+            print(f"-> Dùng lại track waveform (showfreqs) đã cache: {os.path.basename(track_path)}")
+            _touch_cache_entry(track_path)
+            return track_path
+        temp_path = f"{os.path.splitext(track_path)[0]}.partial{os.path.splitext(track_path)[1]}"
+    waveform_video = _build_waveform_video(ffmpeg.input(source_audio_path or audio_path), config,
+                                           pix_fmt=codec_args['pix_fmt'])
+    stream = ffmpeg.output(waveform_video, temp_path, **codec_args).overwrite_output()
+    returncode, stderr = _run_ffmpeg_with_progress(
+        _compile_ffmpeg_cmd(stream), stderr_tail_lines=config.get('ffmpeg_stderr_tail_lines', 200)
+    )
+    if returncode != 0 or not os.path.exists(temp_path) or os.path.getsize(temp_path) <= 100:
+        print(f"!!! Lỗi render track waveform (Exit Code: {returncode}) !!!\n--- FFmpeg stderr ---\n{stderr}\n--- End stderr ---")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    os.replace(temp_path, track_path)
+    print(f"-> Đã render track waveform ({time.time() - start_time:.2f}s): {os.path.basename(track_path)}")
+    prune_waveform_cache(config)
+    return track_path
+
+
+def _render_waveform_track_numpy(pcm_path, output_path, codec_args, config):
+    """WAVEFORM_MODE=numpy: vẽ track bằng waveform_numpy (cần numpy + PCM WAV). False -> dùng showfreqs."""
+    if not waveform_numpy.NUMPY_AVAILABLE:
+        print("CB: WAVEFORM_MODE=numpy nhưng chưa cài numpy (pip install numpy). Dùng showfreqs.")
+        return False
+    if not pcm_path or not pcm_path.lower().endswith('.wav'):
+        print("CB: Engine numpy cần audio PCM (WAV) đã giải mã. Dùng showfreqs.")
+        return False
+    output_args = []
+    for key, value in codec_args.items():
+        output_args += ['-c:v' if key == 'vcodec' else f"-{key}", str(value)]
+    try:
+        return waveform_numpy.render_waveform_track(
+            pcm_path, output_path, waveform_numpy.params_from_config(config), output_args,
+            # Mặc định không vượt số core của job (K job song song không tranh core của nhau)
+            workers=config.get('waveform_numpy_workers') or min(4, _job_core_budget(config)),
+        )
+    except Exception as e:
+        print(f"CB: Engine numpy lỗi ({e}). Dùng showfreqs.")
+        return False
+
+
+def _waveform_layer(video_inputs, config, audio_fallback=None, start=None, duration=None):
+    """
+    Lớp waveform cho filter graph: ưu tiên track đã cache (seek tới start nếu render theo đoạn),
+    nếu không có thì chạy showfreqs trên audio_fallback.
+    """
+    track_path = video_inputs.get('waveform_track')
+    if track_path:
+        waveform_video = ffmpeg.input(track_path, ss=start) if start else ffmpeg.input(track_path)
+        if duration is not None:
+            waveform_video = waveform_video.trim(duration=duration).filter('setpts', 'PTS-STARTPTS')
+        return waveform_video
+    if audio_fallback is None:
+        return None
+    return _build_waveform_video(audio_fallback, config)
+
+
+def _overlay_waveform(video, waveform_video, config):
+    """Phủ waveform lên trên cùng (giữa ngang, cách đáy WAVEFORM_BOTTOM_MARGIN)."""
+    waveform_x = '(main_w-overlay_w)/2'
+    waveform_y = f"main_h-overlay_h-{config.get('waveform_margin_bottom', 50)}"
+    return ffmpeg.overlay(video, waveform_video, x=waveform_x, y=waveform_y, shortest=False)
+
+
+def _cpu_video_output_args(config, duration):
+    """Output args libx264 (chỉ phần video) dùng chung cho render một lượt và render theo đoạn."""
+    output_args = {
+        'vcodec': 'libx264',
+        'preset': config.get('preset', 'medium'),
+        's': config.get('resolution', '1920x1080'),
+        'pix_fmt': 'yuv420p',
+        'r': config.get('framerate', 30), # Lấy framerate từ config
+        't': duration,
+    }
+    # Xử lý bitrate vs CRF
+    crf_val = config.get('crf')
+    if crf_val is not None:
+        try: output_args['crf'] = int(crf_val); print(f"-> Using CRF: {output_args['crf']}")
+        except (ValueError, TypeError):
+            print(f"CB: CRF ('{crf_val}') không hợp lệ, dùng Bitrate.")
+            output_args['video_bitrate'] = config.get('video_bitrate', '6000k')
+            print(f"-> Using Video Bitrate: {output_args['video_bitrate']}")
+    else:
+        output_args['video_bitrate'] = config.get('video_bitrate', '6000k')
+        print(f"-> Using Video Bitrate: {output_args['video_bitrate']}")
+    if config.get('ffmpeg_threads'):
+        output_args['threads'] = config['ffmpeg_threads'] # Số thread cố định của job (RenderService)
+    return output_args
+
+
+def _job_core_budget(config):
+    """Số core dành cho job render hiện tại (RenderService đặt ffmpeg_threads), mặc định toàn máy."""
+    return config.get('ffmpeg_threads') or os.cpu_count() or 4
+
+
+def prepare_mixed_audio(video_inputs, target_duration, output_path, config):
+    """
+    Mix audio chính + nhạc nền (lặp, giảm âm lượng) MỘT lần ra file AAC.
+    Dùng cho render theo đoạn: audio được mux nguyên khối ở bước cuối -> không có vết nối.
+
+    Returns:
+        bool: True nếu tạo file thành công.
+    """
+    input_main_audio = ffmpeg.input(video_inputs['main_audio'])
+    input_bg_music = ffmpeg.input(video_inputs['bg_music'], stream_loop=-1)
+    processed_bg_music = input_bg_music.filter('atrim', duration=target_duration).filter('asetpts', 'PTS-STARTPTS') \
+                                       .filter('volume', volume=config.get('bg_music_volume', 0.20))
+    mixed_audio = ffmpeg.filter([input_main_audio, processed_bg_music], 'amix', inputs=2, duration='first')
+    audio_stream = ffmpeg.output(
+        mixed_audio, output_path, acodec='aac', audio_bitrate=config.get('audio_bitrate', '192k'), t=target_duration
+    ).overwrite_output()
+    result = subprocess.run(_compile_ffmpeg_cmd(audio_stream), capture_output=True, text=True,
+                            encoding='utf-8', errors='replace', check=False)
+    if result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) <= 100:
+        print(f"!!! Lỗi mix audio (Exit Code: {result.returncode}) !!!\n--- FFmpeg stderr ---\n{result.stderr}\n--- End stderr ---")
+        return False
+    return True
+
+
+def decode_audio_pcm(input_path, output_path):
+    """
+    Giải mã audio MỘT lần ra WAV PCM (RF64 nếu > 4GB). Bước mix và filter waveform cùng đọc file này
+    thay vì mỗi bên tự giải mã MP3/AAC.
+
+    Returns:
+        bool: True nếu tạo file thành công.
+    """
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-i', input_path, '-vn', '-c:a', 'pcm_s16le', '-rf64', 'auto', output_path]
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace', check=False)
+    if result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) <= 100:
+        print(f"!!! Lỗi giải mã audio {os.path.basename(input_path)} (Exit Code: {result.returncode}) !!!\n{result.stderr}")
+        return False
+    return True
+
+
+def _timed_waveform_track(audio_path, config, source_audio_path=None):
+    with _stage(config, "waveform_track"):
+        return prepare_waveform_track(audio_path, config, source_audio_path)
+
+
+def prepare_task_audio(video_inputs, target_duration, work_dir, config):
+    """
+    Bước chuẩn bị audio, tách khỏi bước render video (chạy song song với bước chọn video nền):
+    mix audio chính + nhạc nền MỘT lần ra AAC, bước video chỉ mux với -c:a copy.
+    Khi bật waveform: dùng track waveform đã cache nếu có; nếu chưa, audio chính được giải mã ra PCM
+    một lần, rồi mix và render track waveform chạy song song trên cùng file PCM đó.
+
+    Returns:
+        dict: {"mixed_audio": đường dẫn AAC, "narration_pcm": WAV hoặc None, "waveform_track": track hoặc None}.
+
+    Raises:
+        RuntimeError: Nếu giải mã/mix audio thất bại.
+    """
+    print(f"-> Chuẩn bị audio (mix sẵn) trong {work_dir}...")
+    start_time = time.time()
+    narration_pcm = None
+    waveform_track = None
+    mix_inputs = video_inputs
+    need_waveform_track = False
+    if config.get('waveform_enabled', False):
+        cached_track = waveform_track_path(video_inputs['main_audio'], _waveform_track_config(config))
+        if os.path.exists(cached_track) and os.path.getsize(cached_track) > 100:
+            waveform_track = cached_track
+        else:
+            need_waveform_track = True
+            narration_pcm = os.path.join(work_dir, "narration.wav")
+            with _stage(config, "audio_decode"):
+                pcm_ok = decode_audio_pcm(video_inputs['main_audio'], narration_pcm)
+            if not pcm_ok:
+                raise RuntimeError("Giải mã audio chính thất bại.")
+            mix_inputs = dict(video_inputs, main_audio=narration_pcm)
+    mixed_audio_path = os.path.join(work_dir, "mixed_audio.m4a")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="audio_stage") as executor:
+        track_future = executor.submit(_timed_waveform_track, video_inputs['main_audio'], config, narration_pcm) \
+            if need_waveform_track else None
+        with _stage(config, "audio_mix"):
+            mix_ok = prepare_mixed_audio(mix_inputs, target_duration, mixed_audio_path, config)
+        if track_future is not None:
+            waveform_track = track_future.result() # None -> renderer tự chạy showfreqs trên PCM
+    if not mix_ok:
+        raise RuntimeError("Mix audio thất bại.")
+    print(f"-> Audio đã mix sẵn ({time.time() - start_time:.2f}s).")
+    return {"mixed_audio": mixed_audio_path, "narration_pcm": narration_pcm, "waveform_track": waveform_track}
+
+
+def _plan_render_segments(target_duration, config):
+    """
+    Chia thời lượng đích thành các đoạn (start, duration) có ranh giới trùng ranh giới GOP,
+    để các đoạn được encode độc lập rồi nối bằng stream copy.
+    """
+    framerate = config.get('framerate', 30)
+    gop_frames = max(1, int(round(framerate * config.get('render_segment_gop_seconds', 2))))
+    total_frames = int(math.ceil(target_duration * framerate))
+    total_gops = max(1, int(math.ceil(total_frames / gop_frames)))
+
+    segment_count = config.get('render_segments', 1)
+    if segment_count <= 0: # Tự động: mỗi đoạn dùng khoảng 4 core
+        segment_count = max(1, _job_core_budget(config) // 4)
+    min_gops = max(1, int(math.ceil(config.get('render_segment_min_seconds', 60) * framerate / gop_frames)))
+    gops_per_segment = max(min_gops, int(math.ceil(total_gops / segment_count)))
+
+    segments = []
+    start_frame = 0
+    while start_frame < total_frames:
+        end_frame = min(total_frames, start_frame + gops_per_segment * gop_frames)
+        start = start_frame / framerate
+        segments.append((start, min(end_frame / framerate, target_duration) - start))
+        start_frame = end_frame
+    return segments, gop_frames
+
+
+def _render_video_segment(index, start, duration, concat_file_path, video_inputs, overlay_video_duration,
+                          gop_frames, threads, segment_path, config, static_layers=None, progress=None):
+    """Render một đoạn video (không audio). Trả về (index, exit code, stderr)."""
+    # Seek từng input tới offset của đoạn: concat nền theo thời gian tuyệt đối, video overlay lặp theo chu kỳ
+    input_videos = ffmpeg.input(concat_file_path, format='concat', safe=0, ss=start)
+    overlay_offset = start % overlay_video_duration if overlay_video_duration > 0 else 0
+    input_overlay_vid = ffmpeg.input(video_inputs['overlay_video'], stream_loop=-1, ss=overlay_offset)
+    input_overlay_img_raw, input_text_img_raw = _static_image_inputs(video_inputs, static_layers)
+
+    processed_video = input_videos.trim(duration=duration).filter('setpts', 'PTS-STARTPTS')
+    processed_overlay_vid = input_overlay_vid.trim(duration=duration).filter('setpts', 'PTS-STARTPTS')
+    final_video = _compose_cpu_layers(processed_video, processed_overlay_vid, input_overlay_img_raw, input_text_img_raw,
+                                      config, prescaled=static_layers is not None)
+    if config.get('waveform_enabled', False):
+        # Track waveform đã render sẵn (bắt buộc khi render theo đoạn) -> seek theo offset đoạn như video nền
+        final_video = _overlay_waveform(
+            final_video, _waveform_layer(video_inputs, config, start=start, duration=duration), config
+        )
+
+    output_args = _cpu_video_output_args(config, duration)
+    output_args.update({'g': gop_frames, 'threads': threads})
+    segment_stream = ffmpeg.output(final_video, segment_path, **output_args).overwrite_output()
+    returncode, stderr = _run_ffmpeg_with_progress(
+        _compile_ffmpeg_cmd(segment_stream), progress, part=index,
+        stderr_tail_lines=config.get('ffmpeg_stderr_tail_lines', 200)
+    )
+    if returncode == 0 and (not os.path.exists(segment_path) or os.path.getsize(segment_path) <= 100):
+        return index, -1, stderr
+    return index, returncode, stderr
+
+
+def generate_cpu_video_segmented(video_inputs, bg_video_list, output_path, config, progress=None):
+    """
+    Render theo đoạn song song: chia video thành N đoạn (ranh giới theo GOP), mỗi đoạn một
+    tiến trình ffmpeg với filter graph riêng, sau đó nối bằng stream copy và mux audio đã mix sẵn.
+
+    Args/Returns: Giống generate_cpu_video.
+    """
+    print(f"\n--- Bắt đầu tạo video THEO ĐOẠN: {os.path.basename(output_path)} ---")
+    start_time = time.time()
+    work_dir = None
+    success = False
+
+    try:
+        if not isinstance(bg_video_list, list) or not bg_video_list:
+             raise ValueError("bg_video_list không phải là danh sách hợp lệ hoặc rỗng!")
+        if config.get('waveform_enabled', False) and not video_inputs.get('waveform_track'):
+             raise ValueError("WAVEFORM_ENABLED nhưng không có track waveform dựng sẵn cho render theo đoạn!")
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+        work_dir = os.path.join(os.path.abspath(config.get('temp_dir', '.')), f"segments_{os.path.basename(output_path)}_{timestamp}")
+        os.makedirs(work_dir, exist_ok=True)
+
+        # --- 1. File concat nền + thời lượng ---
+        concat_file_path = os.path.join(work_dir, "background_concat.txt")
+        with _stage(config, "concat_write"):
+            _write_concat_file(concat_file_path, bg_video_list)
+        target_duration = get_duration(video_inputs['main_audio'])
+        overlay_video_duration = get_duration(video_inputs['overlay_video'])
+        segments, gop_frames = _plan_render_segments(target_duration, config)
+        workers = max(1, min(len(segments), config.get('render_segment_workers') or len(segments)))
+        threads = max(1, _job_core_budget(config) // workers)
+        print(f"-> Thời lượng đích: {target_duration:.2f}s | {len(segments)} đoạn | GOP {gop_frames} frames | {workers} tiến trình x {threads} threads")
+
+        static_layers = _prepare_static_layers_for_render(video_inputs, work_dir, config) # Dùng chung cho mọi đoạn
+
+        # --- 2. Mix audio một lần (chạy song song với các đoạn video), trừ khi đã mix sẵn ---
+        premixed_audio_path = video_inputs.get('mixed_audio')
+        mixed_audio_path = premixed_audio_path or os.path.join(work_dir, "mixed_audio.m4a")
+        segment_paths = [os.path.join(work_dir, f"segment_{i:04d}.mp4") for i in range(len(segments))]
+        segments_start_time = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix="render_segment") as executor:
+            audio_future = None if premixed_audio_path else \
+                executor.submit(prepare_mixed_audio, video_inputs, target_duration, mixed_audio_path, config)
+            # --- 3. Render từng đoạn (mỗi đoạn là một tiến trình ffmpeg riêng) ---
+            futures = [
+                executor.submit(_render_video_segment, i, seg_start, seg_duration, concat_file_path, video_inputs,
+                                overlay_video_duration, gop_frames, threads, segment_paths[i], config, static_layers,
+                                progress)
+                for i, (seg_start, seg_duration) in enumerate(segments)
+            ]
+            failed_segments = []
+            for future in concurrent.futures.as_completed(futures):
+                index, returncode, stderr = future.result()
+                if returncode != 0:
+                    failed_segments.append(index)
+                    print(f"!!! Lỗi render đoạn {index} (Exit Code: {returncode}) !!!\n--- FFmpeg stderr ---\n{stderr}\n--- End stderr ---")
+                else:
+                    print(f"-> Xong đoạn {index + 1}/{len(segments)}.")
+            audio_ok = audio_future.result() if audio_future else True
+        if config.get('render_timer') is not None:
+            config['render_timer'].add("encode", time.perf_counter() - segments_start_time)
+        if failed_segments: raise RuntimeError(f"Render thất bại ở các đoạn: {sorted(failed_segments)}")
+        if not audio_ok: raise RuntimeError("Mix audio thất bại.")
+
+        # --- 4. Nối các đoạn (stream copy) + mux audio ---
+        segment_list_path = os.path.join(work_dir, "segments.txt")
+        with open(segment_list_path, 'w', encoding='utf-8') as f:
+            for segment_path in segment_paths:
+                f.write(f"file '{segment_path.replace(chr(92), '/')}'\n")
+        input_segments = ffmpeg.input(segment_list_path, format='concat', safe=0)
+        input_audio = ffmpeg.input(mixed_audio_path)
+        mux_stream = ffmpeg.output(
+            input_segments['v'], input_audio['a'], output_path,
+            c='copy', t=target_duration, movflags='+faststart'
+        ).overwrite_output()
+        with _stage(config, "mux"):
+            mux_result = subprocess.run(_compile_ffmpeg_cmd(mux_stream), capture_output=True, text=True,
+                                        encoding='utf-8', errors='replace', check=False)
+        if mux_result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) <= 100:
+            print(f"!!! Lỗi nối đoạn/mux (Exit Code: {mux_result.returncode}) !!!\n--- FFmpeg stderr ---\n{mux_result.stderr}\n--- End stderr ---")
+            raise RuntimeError("Nối đoạn thất bại.")
+        print(f"-> Video đã được tạo thành công tại: {output_path}")
+        success = True
+
+    except Exception as e:
+        print(f"\n!!! Lỗi trong quá trình tạo video theo đoạn '{os.path.basename(output_path)}' !!!")
+        print(f"Lỗi: {e}")
+        if not isinstance(e, (IOError, OSError, ValueError, RuntimeError)):
+             traceback.print_exc()
+    finally:
+        if work_dir and os.path.isdir(work_dir):
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"--- Kết thúc tạo video {os.path.basename(output_path)} (Thời gian hàm: {time.time() - start_time:.2f} giây) ---")
+    return success
+
+
+def generate_cpu_video(video_inputs, bg_video_list, output_path, config, progress=None):
     """
     Tạo một video duy nhất dựa trên các input và config được cung cấp.
 
@@ -1034,13 +1741,22 @@ def generate_cpu_video(video_inputs, bg_video_list, output_path, config):
         output_path (str): Đường dẫn tuyệt đối để lưu video kết quả.
         config (dict): Dictionary chứa các cấu hình chung (margins, volume,
                        ffmpeg params, waveform settings...).
+        progress (RenderProgress, optional): Nhận tiến độ từ '-progress' của ffmpeg.
 
     Returns:
         bool: True nếu tạo video thành công, False nếu thất bại.
     """
+    if config.get('render_segments', 1) != 1:
+        # Render theo đoạn chỉ vẽ được waveform từ track dựng sẵn -> thiếu track thì render một lượt (showfreqs)
+        if config.get('waveform_enabled', False) and not video_inputs.get('waveform_track'):
+            print("CB: Không có track waveform dựng sẵn -> bỏ render theo đoạn, render một lượt với showfreqs.")
+        else:
+            return generate_cpu_video_segmented(video_inputs, bg_video_list, output_path, config, progress=progress)
+
     print(f"\n--- Bắt đầu tạo video: {os.path.basename(output_path)} ---")
     start_time = time.time()
     concat_file_path = None # Khởi tạo để dùng trong finally
+    static_layers = None
     success = False
     process = None # Khởi tạo để dùng trong except ffmpeg.Error
 
@@ -1060,17 +1776,9 @@ def generate_cpu_video(video_inputs, bg_video_list, output_path, config):
         if not isinstance(bg_video_list, list) or not bg_video_list:
              raise ValueError("bg_video_list không phải là danh sách hợp lệ hoặc rỗng!")
 
-        # Mở và ghi file concat
-        with open(concat_file_path, 'w', encoding='utf-8') as f:
-            for i, video_file in enumerate(bg_video_list):
-                 if not isinstance(video_file, str):
-                      print(f"Cảnh báo: Bỏ qua mục không phải string trong bg_video_list ở index {i}")
-                      continue
-                 if "'" in video_file: # Kiểm tra dấu nháy đơn
-                      print(f"!!! CẢNH BÁO: Tên file chứa dấu nháy đơn: {video_file}")
-                 safe_path = video_file.replace('\\', '/')
-                 line_to_write = f"file '{safe_path}'\n"
-                 f.write(line_to_write)
+        # Ghi file concat (kèm inpoint/outpoint nếu có)
+        with _stage(config, "concat_write"):
+            _write_concat_file(concat_file_path, bg_video_list)
         print(f"-> Đã ghi xong file concat.")
 
         # --- 2. Lấy thời lượng audio chính ---
@@ -1087,130 +1795,59 @@ def generate_cpu_video(video_inputs, bg_video_list, output_path, config):
 
         # Inputs FFmpeg
         input_videos = ffmpeg.input(concat_file_path, format='concat', safe=0, itsoffset=0)
-        input_main_audio = ffmpeg.input(video_inputs['main_audio'])
-        try: # Tách luồng audio
-             split_audio = input_main_audio.asplit()
-             main_audio_stream = split_audio[0]
-             waveform_audio_input = split_audio[1]
-        except Exception as e:
-             print(f"Cảnh báo: Không tách được luồng audio: {e}. Dùng luồng gốc.")
-             main_audio_stream = waveform_audio_input = input_main_audio
-        input_bg_music = ffmpeg.input(video_inputs['bg_music'], stream_loop=-1)
         input_overlay_vid = ffmpeg.input(video_inputs['overlay_video'], stream_loop=-1)
         input_overlay_img_raw = ffmpeg.input(video_inputs['overlay_image'])
         input_text_img_raw = ffmpeg.input(video_inputs['text_image'])
+        waveform_enabled = config.get('waveform_enabled', False)
+
+        if video_inputs.get('mixed_audio'):
+            # Audio đã mix sẵn ở bước chuẩn bị audio (prepare_task_audio) -> chỉ mux, không filter audio
+            print("-> Dùng audio đã mix sẵn (-c:a copy).")
+            mixed_audio = ffmpeg.input(video_inputs['mixed_audio'])['a']
+            waveform_audio_input = ffmpeg.input(video_inputs.get('narration_pcm') or video_inputs['main_audio']) \
+                if waveform_enabled else None
+        else:
+            input_main_audio = ffmpeg.input(video_inputs['main_audio'])
+            try: # Tách luồng audio
+                 split_audio = input_main_audio.asplit()
+                 main_audio_stream = split_audio[0]
+                 waveform_audio_input = split_audio[1]
+            except Exception as e:
+                 print(f"Cảnh báo: Không tách được luồng audio: {e}. Dùng luồng gốc.")
+                 main_audio_stream = waveform_audio_input = input_main_audio
+            input_bg_music = ffmpeg.input(video_inputs['bg_music'], stream_loop=-1)
 
-        # Scale Ảnh Lớp phủ
-        print(f"-> Scaling ảnh nhân vật to width: {config['overlay_char_width']}px (~40%)")
-        input_overlay_img = input_overlay_img_raw.filter('scale', h=config['target_height'], w=-1) # <-- Sửa lại h
-
-        print(f"-> Scaling ảnh chữ to width: {config['overlay_text_width']}px (~60%)")
-        input_text_img = input_text_img_raw.filter('scale', w=config['overlay_text_width'], h=-1)
-
-        # Generate Waveform Video using showfreqs
-        print(f"-> Generating frequency bars (showfreqs - WxH: {config['waveform_w']}x{config['waveform_h']}, Mode: {config.get('waveform_mode','bar')})")
-        waveform_video = waveform_audio_input.filter(
-            'showfreqs',
-            s=f"{config['waveform_w']}x{config['waveform_h']}",
-            mode=config.get('waveform_mode', 'bar'),
-            ascale=config.get('waveform_ascale', 'log'),
-            fscale=config.get('waveform_fscale', 'log'),
-            win_size=config.get('waveform_win_size', 2048),
-            win_func=config.get('waveform_win_func', 'hann'),
-            colors=config.get('waveform_color', 'lime'),
-            rate=config.get('framerate', 30)
-        ).filter('format', pix_fmts='yuva420p') # Đảm bảo alpha cho overlay
+            # Processing Audio Streams
+            processed_bg_music_trimmed = input_bg_music.filter('atrim', duration=target_duration).filter('asetpts', 'PTS-STARTPTS')
+            bg_vol = config.get('bg_music_volume', 0.20)
+            print(f"-> Reducing background music volume to {bg_vol*100:.0f}%.")
+            processed_bg_music = processed_bg_music_trimmed.filter('volume', volume=bg_vol)
+            mixed_audio = ffmpeg.filter([main_audio_stream, processed_bg_music], 'amix', inputs=2, duration='first')
 
         # Processing Video Streams
         processed_video = input_videos.trim(duration=target_duration).filter('setpts', 'PTS-STARTPTS')
         processed_overlay_vid = input_overlay_vid.trim(duration=target_duration).filter('setpts', 'PTS-STARTPTS')
-        overlay_vid_with_opacity = processed_overlay_vid.filter('format', pix_fmts='yuva420p') \
-                                                      .filter('colorchannelmixer', aa=config.get('overlay_opacity', 0.25))
 
-        # Processing Audio Streams
-        processed_bg_music_trimmed = input_bg_music.filter('atrim', duration=target_duration).filter('asetpts', 'PTS-STARTPTS')
-        bg_vol = config.get('bg_music_volume', 0.20)
-        print(f"-> Reducing background music volume to {bg_vol*100:.0f}%.")
-        processed_bg_music = processed_bg_music_trimmed.filter('volume', volume=bg_vol)
-        mixed_audio = ffmpeg.filter([main_audio_stream, processed_bg_music], 'amix', inputs=2, duration='first')
-
-                # Thứ tự Z (từ dưới lên): BG -> Ảnh NV -> Video Mờ -> Ảnh Chữ -> Waveform
-        print("-> Applying overlays (Order: BG->CharImg->OverlayVid->TextImg->Waveform)...")
-
-        # Lớp 1: Video nền (processed_video) + Ảnh Nhân Vật (input_overlay_img)
-        # Ảnh NV ở bên phải, giữa dọc (hoặc full height tùy bạn chọn ở bước scale)
-        char_img_x = f"main_w-overlay_w-{config.get('margin_right', 15)}"
-        char_img_y = '(main_h-overlay_h)/2'
-        merged_layer1 = ffmpeg.overlay(
-            processed_video,     # Input chính (nền)
-            input_overlay_img,   # Lớp phủ 1 (Ảnh NV đã scale)
-            x=char_img_x,
-            y=char_img_y,
-            shortest=False
-        )
-        print("DEBUG: Applied CharImg")
-
-        # Lớp 2: Lớp 1 (BG+Char) + Video Lớp Phủ Mờ (overlay_vid_with_opacity)
-        # Video này phủ toàn khung hình
-        merged_layer2 = ffmpeg.overlay(
-            merged_layer1,            # Input chính (BG + Char)
-            overlay_vid_with_opacity, # Lớp phủ 2 (Video mờ)
-            x=0,
-            y=0,
-            shortest=False
-        )
-        print("DEBUG: Applied OverlayVid")
-
-        # Lớp 3: Lớp 2 (BG+Char+Vid) + Ảnh Chữ (input_text_img)
-        # Ảnh chữ ở bên trái, giữa dọc
-        text_img_x = f"{config.get('margin_left', 15)}"
-        text_img_y = '(main_h-overlay_h)/2'
-        final_video = ffmpeg.overlay(
-            merged_layer2,       # Input chính (BG + Char + Vid)
-            input_text_img,      # Lớp phủ 3 (Ảnh chữ đã scale)
-            x=text_img_x,
-            y=text_img_y,
-            shortest=False
-         )
-        print("DEBUG: Applied TextImg")
-
-        # Lớp 4 (Cuối cùng): Lớp 3 (Mọi thứ trước đó) + Waveform (waveform_video)
-        # Vị trí waveform vẫn giữ nguyên (giữa ngang, gần đáy)
-        # waveform_x = '(main_w-overlay_w)/2'
-        # waveform_y = f"main_h-overlay_h-{config.get('waveform_margin_bottom', 50)}"
-        # final_video = ffmpeg.overlay(
-        #     merged_layer3,    # Input chính (Mọi thứ đã ghép)
-        #     waveform_video,   # Lớp phủ trên cùng (Waveform)
-        #     x=waveform_x,
-        #     y=waveform_y,
-        #     shortest=False
-        # )
-        # print("DEBUG: Applied Waveform (Topmost)")
+        # Thứ tự Z (từ dưới lên): BG -> Ảnh NV -> Video Mờ -> Ảnh Chữ -> Waveform
+        static_layers = _prepare_static_layers_for_render(video_inputs, concat_dir, config)
+        if static_layers:
+            input_overlay_img_raw, input_text_img_raw = _static_image_inputs(video_inputs, static_layers)
+        final_video = _compose_cpu_layers(processed_video, processed_overlay_vid, input_overlay_img_raw, input_text_img_raw,
+                                          config, prescaled=static_layers is not None)
+
+        # Lớp 4 (Cuối cùng, WAVEFORM_ENABLED): Waveform (giữa ngang, gần đáy) - track cache hoặc showfreqs
+        if waveform_enabled:
+            print(f"-> Waveform (WxH: {config['waveform_w']}x{config['waveform_h']}, track cache: {bool(video_inputs.get('waveform_track'))})")
+            final_video = _overlay_waveform(final_video, _waveform_layer(video_inputs, config, waveform_audio_input), config)
 
         # --- 4. Output Arguments ---
         print(f"-> Chuẩn bị tạo video output tại: {output_path}")
-        output_args = {
-            'vcodec': 'libx264', 'acodec': 'aac',
-            'audio_bitrate': config.get('audio_bitrate', '192k'),
-            'preset': config.get('preset', 'medium'),
-            's': config.get('resolution', '1920x1080'),
-            'pix_fmt': 'yuv420p',
-            'r': config.get('framerate', 30), # Lấy framerate từ config
-            't': target_duration,
-            'strict': 'experimental',
-            'movflags': '+faststart'
-        }
-        # Xử lý bitrate vs CRF
-        crf_val = config.get('crf')
-        if crf_val is not None:
-            try: output_args['crf'] = int(crf_val); print(f"-> Using CRF: {output_args['crf']}")
-            except (ValueError, TypeError):
-                print(f"CB: CRF ('{crf_val}') không hợp lệ, dùng Bitrate.")
-                output_args['video_bitrate'] = config.get('video_bitrate', '6000k')
-                print(f"-> Using Video Bitrate: {output_args['video_bitrate']}")
+        output_args = _cpu_video_output_args(config, target_duration)
+        output_args.update({'strict': 'experimental', 'movflags': '+faststart'})
+        if video_inputs.get('mixed_audio'):
+            output_args['acodec'] = 'copy'
         else:
-            output_args['video_bitrate'] = config.get('video_bitrate', '6000k')
-            print(f"-> Using Video Bitrate: {output_args['video_bitrate']}")
+            output_args.update({'acodec': 'aac', 'audio_bitrate': config.get('audio_bitrate', '192k')})
 
         # --- 5. Thực thi FFmpeg ---
         process = ffmpeg.output(final_video, mixed_audio, output_path, **output_args).overwrite_output()
@@ -1221,25 +1858,25 @@ def generate_cpu_video(video_inputs, bg_video_list, output_path, config):
 
         print("\n-> Bắt đầu encode...")
         start_encode_time = time.time()
-        stdout, stderr = process.run(capture_stdout=True, capture_stderr=True)
+        with _stage(config, "encode"):
+            returncode, stderr = _run_ffmpeg_with_progress(
+                process.compile(), progress, stderr_tail_lines=config.get('ffmpeg_stderr_tail_lines', 200)
+            )
         end_encode_time = time.time()
-        print(f"-> Hoàn thành encode ({end_encode_time - start_encode_time:.2f}s).")
+        print(f"-> Hoàn thành encode ({end_encode_time - start_encode_time:.2f}s). Exit code: {returncode}")
 
         # Kiểm tra kết quả
-        if os.path.exists(output_path) and os.path.getsize(output_path) > 100:
+        if returncode != 0:
+            print('\n!!! LỖI FFmpeg !!!')
+            print('--- FFmpeg stderr (các dòng cuối) ---\n', stderr, '\n--- End stderr ---')
+            try: print("-> Lệnh FFmpeg lỗi:\n", ' '.join(process.compile()))
+            except Exception: pass
+        elif os.path.exists(output_path) and os.path.getsize(output_path) > 100:
              print(f"-> Video đã được tạo thành công tại: {output_path}")
              success = True
         else:
              print(f"!!! Cảnh báo: File output không được tạo hoặc bị trống.")
-             print("--- FFmpeg stderr (có thể chứa lỗi) ---\n", stderr.decode('utf-8', errors='ignore'), "\n--- End stderr ---")
-
-    # Xử lý lỗi cụ thể của FFmpeg
-    except ffmpeg.Error as e:
-        print('\n!!! LỖI FFmpeg !!!')
-        print('--- FFmpeg stderr ---\n', e.stderr.decode('utf-8', errors='ignore'), '\n--- End stderr ---')
-        if process:
-            try: print("-> Lệnh FFmpeg lỗi:\n", ' '.join(process.compile()))
-            except Exception: pass
+             print("--- FFmpeg stderr (có thể chứa lỗi) ---\n", stderr, "\n--- End stderr ---")
     # Xử lý các lỗi khác
     except (ValueError, IOError, OSError, Exception) as e:
         print(f"\n!!! Lỗi trong quá trình tạo video '{os.path.basename(output_path)}' !!!")
@@ -1256,11 +1893,443 @@ def generate_cpu_video(video_inputs, bg_video_list, output_path, config):
                 print(f"-> Đã xóa file tạm: {concat_file_path}")
             except OSError as e:
                 print(f"Cảnh báo: Lỗi xóa file tạm {concat_file_path}: {e}")
+        _remove_static_layers(static_layers)
         end_time = time.time()
         print(f"--- Kết thúc tạo video {os.path.basename(output_path)} (Thời gian hàm: {end_time - start_time:.2f} giây) ---")
         return success
 
 
+def load_render_config():
+    """
+    Tải cấu hình chung từ .env, dịch và kiểm tra các đường dẫn chung.
+
+    Raises:
+        ConfigError: Nếu cấu hình/đường dẫn không hợp lệ.
+
+    Returns:
+        dict: Cấu hình đã được cập nhật đường dẫn tuyệt đối.
+    """
+    # 1. Tải cấu hình chung từ .env
+    config = load_app_config()
+
+    # 2. Kiểm tra các đường dẫn chung từ config
+    common_paths_to_check = {
+        "Nhạc nền": (config["bg_music_file"], "file"),
+        "Video Overlay": (config["overlay_video_file"], "file"),
+        "Thư mục video nền": (config["video_folder"], "dir"),
+        "Thư mục output": (config["output_dir"], "dir_create"),
+        "Thư mục tạm": (config["temp_dir"], "dir_create"),
+    }
+    # Dịch path chung nếu cần
+    common_paths_translated = {
+        name: (translate_path(path, config), type)
+        for name, (path, type) in common_paths_to_check.items()
+    }
+    validated_common_paths = validate_paths(common_paths_translated)
+    # Cập nhật config với đường dẫn tuyệt đối đã check và dịch
+    config.update(
+        {
+            "bg_music_file": validated_common_paths["Nhạc nền"],
+            "overlay_video_file": validated_common_paths["Video Overlay"],
+            "video_folder": validated_common_paths["Thư mục video nền"],
+            "output_dir": validated_common_paths["Thư mục output"],
+            "temp_dir": validated_common_paths["Thư mục tạm"],
+            "concat_dir": validated_common_paths[
+                "Thư mục tạm"
+            ],  # Cập nhật concat_dir
+        }
+    )
+    if config.get("bg_library_dir"):
+        config["bg_library_dir"] = translate_path(config["bg_library_dir"], config)
+    config["render_cache_dir"] = (
+        translate_path(config["render_cache_dir"], config) if config.get("render_cache_dir")
+        else os.path.join(config["output_dir"], RENDER_CACHE_SUBDIR)
+    )
+    config["waveform_cache_dir"] = (
+        translate_path(config["waveform_cache_dir"], config) if config.get("waveform_cache_dir")
+        else os.path.join(config["render_cache_dir"], "waveform")
+    )
+    return config
+
+
+# ==============================================================================
+# SECTION 6B: FINGERPRINT & CACHE RENDER
+# ==============================================================================
+
+RENDER_CACHE_SUBDIR = ".render_cache"
+# Các khóa config ảnh hưởng tới nội dung video (đổi giá trị -> fingerprint khác)
+RENDER_FINGERPRINT_CONFIG_KEYS = (
+    "resolution", "framerate", "encoder_choice", "cpu_preset", "cpu_crf", "cpu_bitrate", "preset", "crf",
+    "video_bitrate", "hw_nvenc_preset", "hw_nvenc_rc", "hw_nvenc_qp", "hw_nvenc_bitrate", "audio_bitrate",
+    "overlay_opacity", "margin_left", "margin_right", "bg_music_volume", "overlay_char_width", "overlay_text_width",
+    "waveform_w", "waveform_h", "waveform_color", "waveform_margin_bottom", "waveform_mode", "waveform_ascale",
+    "waveform_enabled", "waveform_fscale", "waveform_win_size", "waveform_win_func", "render_segment_gop_seconds",
+    "waveform_bar_count",
+)
+_FILE_HASH_CHUNK = 1024 * 1024
+_file_hash_cache = {}  # (path, size, mtime) -> sha256
+_file_hash_lock = threading.Lock()
+
+
+def hash_file(path):
+    """sha256 nội dung file, nhớ theo (path, size, mtime) -> file không đổi chỉ hash một lần."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    with _file_hash_lock:
+        cached = _file_hash_cache.get(key)
+    if cached:
+        return cached
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_FILE_HASH_CHUNK), b""):
+            digest.update(chunk)
+    with _file_hash_lock:
+        _file_hash_cache[key] = digest.hexdigest()
+    return _file_hash_cache[key]
+
+
+def render_seed_for_task(task_doc):
+    """Seed chọn video nền cố định theo task (ghi đè bằng trường render_seed nếu cần đổi nền)."""
+    seed_source = str(task_doc.get("render_seed") or task_doc["_id"])
+    return int(hashlib.sha1(seed_source.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def compute_render_fingerprint(video_inputs, bg_video_list, seed, config):
+    """
+    Fingerprint của một lần render: hash các file input, seed + danh sách video nền đã chọn
+    (tên, mtime, inpoint/outpoint) và các tham số config ảnh hưởng tới output.
+    """
+    material = {
+        "inputs": {name: hash_file(path) for name, path in sorted(video_inputs.items())},
+        "seed": seed,
+        "background": [
+            [os.path.basename(path), os.path.getmtime(path), inpoint, outpoint]
+            for path, inpoint, outpoint in (
+                (entry, None, None) if isinstance(entry, str) else entry for entry in bg_video_list
+            )
+        ],
+        "config": {key: config.get(key) for key in RENDER_FINGERPRINT_CONFIG_KEYS},
+        "prescaled_static_layers": bool(config.get("precompose_static_layer") and PIL_AVAILABLE),
+        "waveform_numpy": bool(config.get("waveform_mode") == "numpy" and waveform_numpy.NUMPY_AVAILABLE),
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def render_cache_path(fingerprint, config):
+    return os.path.join(config["render_cache_dir"], fingerprint[:2], f"{fingerprint}.mp4")
+
+
+def _link_or_copy(source_path, target_path):
+    """Hard link (không tốn dung lượng); khác ổ đĩa/không hỗ trợ -> copy."""
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    temp_path = f"{target_path}.partial"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        shutil.copy2(source_path, temp_path)
+    os.replace(temp_path, target_path)
+
+
+def restore_cached_render(fingerprint, output_path, config):
+    """Nếu đã có bản render cùng fingerprint -> link ra output_path. Trả về True nếu dùng được cache."""
+    cached_path = render_cache_path(fingerprint, config)
+    if not os.path.exists(cached_path) or os.path.getsize(cached_path) <= 100:
+        return False
+    try:
+        _link_or_copy(cached_path, output_path)
+    except OSError as e:
+        print(f"CB: Không dùng được bản render trong cache ({e}), render lại.")
+        return False
+    _touch_cache_entry(cached_path)
+    return True
+
+
+def store_render_in_cache(fingerprint, output_path, config):
+    try:
+        _link_or_copy(output_path, render_cache_path(fingerprint, config))
+    except OSError as e:
+        print(f"CB: Không lưu được bản render vào cache: {e}")
+        return
+    prune_render_cache(config)
+
+
+CACHE_EVICT_TARGET_RATIO = 0.9 # Khi vượt giới hạn, xóa bản cũ nhất đến khi còn 90%
+_cache_prune_lock = threading.Lock()
+
+
+def _touch_cache_entry(path):
+    """Cập nhật mtime = lần dùng gần nhất (cho LRU)."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _scan_cache_entries(cache_dir, extensions, depth):
+    """(mtime, size, path) của các file cache (bỏ qua file .partial đang ghi). depth: số cấp thư mục con."""
+    entries = []
+    pattern = os.path.join(cache_dir, *(["*"] * depth), "*")
+    for path in glob.glob(pattern):
+        if not path.endswith(extensions) or ".partial" in os.path.basename(path):
+            continue
+        try:
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            continue # File vừa bị xóa bởi worker khác
+    return entries
+
+
+def prune_file_cache(cache_dir, extensions, max_gb, depth=0, label="cache"):
+    """
+    Giới hạn dung lượng một thư mục cache: vượt max_gb -> xóa file ít dùng nhất (LRU theo mtime)
+    đến khi còn CACHE_EVICT_TARGET_RATIO * max_gb. max_gb <= 0: không giới hạn.
+
+    Returns:
+        int: Số file đã xóa.
+    """
+    if not max_gb or max_gb <= 0 or not os.path.isdir(cache_dir):
+        return 0
+    max_bytes = int(max_gb * 1024 ** 3)
+    with _cache_prune_lock:
+        entries = sorted(_scan_cache_entries(cache_dir, extensions, depth))
+        total_bytes = sum(size for _, size, _ in entries)
+        if total_bytes <= max_bytes:
+            return 0
+        target_bytes = int(max_bytes * CACHE_EVICT_TARGET_RATIO)
+        removed_count = 0
+        for _mtime, size, path in entries:
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= size
+                removed_count += 1
+            except OSError as e:
+                print(f"CB: Không xóa được {path} khỏi {label}: {e}")
+    print(f"-> Đã dọn {label}: xóa {removed_count} file, còn {total_bytes / 1024 ** 3:.1f} GB.")
+    return removed_count
+
+
+def prune_render_cache(config):
+    return prune_file_cache(config["render_cache_dir"], (".mp4",), config.get("render_cache_max_gb", 0),
+                            depth=1, label="cache render")
+
+
+def prune_waveform_cache(config):
+    extensions = tuple(f".{container}" for container, _ in WAVEFORM_TRACK_CODECS.values())
+    return prune_file_cache(config["waveform_cache_dir"], extensions, config.get("waveform_cache_max_gb", 0),
+                            label="cache waveform")
+
+
+def build_render_stats(config, video_seconds, wall_seconds, success):
+    """Thống kê một lần render (ghi vào task.render_stats) để điều chỉnh số job song song."""
+    wall_seconds = max(wall_seconds, 1e-6)
+    return {
+        "success": bool(success),
+        "wall_seconds": round(wall_seconds, 2),
+        "video_seconds": round(video_seconds, 2),
+        "fps": round(video_seconds * config.get("framerate", 30) / wall_seconds, 2),
+        "speed": round(video_seconds / wall_seconds, 3),
+        "ffmpeg_threads": config.get("ffmpeg_threads"),
+        "cpu_affinity": config.get("cpu_affinity"),
+        "render_slot": config.get("render_slot"),
+        "concurrent_jobs": config.get("render_jobs"),
+        "host": platform.node(),
+        "finished_at": datetime.datetime.utcnow(),
+    }
+
+
+# Các trường path của task được dịch cùng lúc (PathTranslator.translate_fields)
+TASK_PATH_FIELDS = ("final_audio_path", "thumbnail_character_path", "thumbnail_text_path")
+
+
+def _timed_task_audio(video_inputs, target_duration, work_dir, config):
+    with _stage(config, "audio_prep"):
+        return prepare_task_audio(video_inputs, target_duration, work_dir, config)
+
+
+def process_render_task(task_doc, config, bg_index=None):
+    """
+    Render video cho một task đã được khóa (video_render_status = 'rendering')
+    và cập nhật status cuối cùng vào DB.
+
+    Args:
+        task_doc (dict): Document task lấy từ db_handler.get_next_pending_task().
+        config (dict): Cấu hình từ load_render_config().
+        bg_index (BackgroundClipIndex, optional): Index video nền giữ sẵn trong bộ nhớ
+            (RenderService). None -> liệt kê thư mục và kiểm tra kho metadata như cũ.
+
+    Returns:
+        bool: True nếu render thành công và cập nhật được status.
+    """
+    doc_id = task_doc["_id"]
+    task_start_time = time.time()
+    final_output_path = None
+    task_success = False
+    error_message = None
+    render_stats = None
+    audio_executor = None
+    audio_work_dir = None
+    # Thời gian từng stage: ghi vào render_stats.stages và collection render_metrics
+    timer = RenderTimer()
+    config = dict(config, render_timer=timer)
+
+    try:
+        # --- Lấy và Dịch/Chuẩn hóa đường dẫn từ document ---
+        print("-> Lấy và chuẩn hóa/dịch đường dẫn từ MongoDB...")
+        with timer.stage("path_translation"):
+            task_paths = get_path_translator(config).translate_fields(task_doc, TASK_PATH_FIELDS)
+            main_audio_task = task_paths["final_audio_path"]
+            overlay_image_task = task_paths["thumbnail_character_path"]
+            text_image_task = task_paths["thumbnail_text_path"]
+
+            # --- Kiểm tra các đường dẫn của task ---
+            task_paths_to_check = {
+                "Audio chính (Task)": (main_audio_task, "file"),
+                "Ảnh Overlay (Task)": (overlay_image_task, "file"),
+                "Ảnh chữ (Task)": (text_image_task, "file"),
+            }
+            validated_task_paths = validate_paths(task_paths_to_check)
+
+        # --- Chuẩn bị inputs và dữ liệu ---
+        current_video_inputs = {
+            "main_audio": validated_task_paths["Audio chính (Task)"],
+            "bg_music": config["bg_music_file"],
+            "overlay_image": validated_task_paths["Ảnh Overlay (Task)"],
+            "text_image": validated_task_paths["Ảnh chữ (Task)"],
+            "overlay_video": config["overlay_video_file"],
+        }
+        with timer.stage("probe_audio"):
+            current_target_duration = get_duration(
+                current_video_inputs["main_audio"]
+            )
+        # Chuẩn bị audio (mix sẵn). Cache render bật -> chỉ chạy sau khi biết không trúng cache (chọn nền
+        # theo seed nên fingerprint tính được trước, và rẻ khi index nền đã nóng); tắt cache -> chạy song song
+        # với bước chọn video nền.
+        audio_work_dir = tempfile.mkdtemp(prefix=f"audio_{doc_id}_", dir=config["temp_dir"])
+        audio_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio_prep")
+        audio_future = None
+        if not config.get("render_cache_enabled", True):
+            audio_future = audio_executor.submit(
+                _timed_task_audio, current_video_inputs, current_target_duration, audio_work_dir, config
+            )
+        render_seed = render_seed_for_task(task_doc)
+        selected_bg_videos = prepare_background_videos(
+            config["video_folder"],
+            current_target_duration,
+            config["cache_file"],
+            config["max_workers"],
+            library_mode=config.get("bg_library_mode", "off"),
+            library_dir=config.get("bg_library_dir"),
+            config=config,
+            seed=render_seed,
+            video_metadata=bg_index.get_metadata() if bg_index is not None else None,
+        )
+
+        # --- Tạo tên file output ---
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_suffix = (
+            task_doc.get("output_suffix") or f"_{timestamp}"
+        )  # Thử đọc suffix từ DB
+        base_filename = os.path.splitext(
+            config["output_filename_pattern"].format(
+                id=str(doc_id), timestamp=timestamp
+            )
+        )[0]
+        final_output_filename = f"{base_filename}{output_suffix}.mp4"
+        final_output_path = os.path.join(
+            config["output_dir"], final_output_filename
+        )
+
+        # --- Cache render: input + seed + config giống hệt lần trước -> dùng lại output ---
+        render_start_time = time.time()
+        fingerprint = None
+        cache_hit = False
+        if config.get("render_cache_enabled", True):
+            with timer.stage("fingerprint"):
+                fingerprint = compute_render_fingerprint(current_video_inputs, selected_bg_videos, render_seed, config)
+            with timer.stage("cache_restore"):
+                cache_hit = restore_cached_render(fingerprint, final_output_path, config)
+            if cache_hit:
+                print(f"-> Dùng lại bản render đã có (fingerprint {fingerprint[:12]}), bỏ qua encode.")
+
+        # *** Gọi hàm tạo video tự động chọn encoder ***
+        if cache_hit:
+            task_success = True
+        else:
+            progress = RenderProgress(
+                doc_id, current_target_duration, config.get("render_progress_interval_seconds", 10)
+            )
+            if audio_future is None:
+                audio_future = audio_executor.submit(
+                    _timed_task_audio, current_video_inputs, current_target_duration, audio_work_dir, config
+                )
+            # Thời gian chờ audio: phần audio_prep không chồng được lên bước chọn video nền
+            with timer.stage("audio_wait"):
+                prepared_audio = audio_future.result()
+            render_inputs = dict(current_video_inputs, **prepared_audio)
+            task_success = generate_cpu_video(
+                render_inputs, selected_bg_videos, final_output_path, config, progress=progress
+            )
+            if task_success and fingerprint:
+                with timer.stage("cache_store"):
+                    store_render_in_cache(fingerprint, final_output_path, config)
+        if task_success and os.path.exists(final_output_path):
+            timer.set("output_size_bytes", os.path.getsize(final_output_path))
+        render_stats = build_render_stats(
+            config, current_target_duration, time.time() - render_start_time, task_success
+        )
+        render_stats.update({"fingerprint": fingerprint, "cache_hit": cache_hit})
+        print(f"-> Render stats: {render_stats['wall_seconds']:.1f}s, {render_stats['fps']:.1f} fps, x{render_stats['speed']:.2f}")
+
+    except Exception as task_err:
+        print(f"!!! Lỗi chuẩn bị/chạy generate_video cho {doc_id}: {task_err}")
+        if not isinstance(
+            task_err,
+            (
+                FileNotFoundError,
+                ValueError,
+                NotADirectoryError,
+                OSError,
+                ConfigError,
+            ),
+        ):
+            traceback.print_exc()
+        task_success = False
+        error_message = f"{type(task_err).__name__}: {str(task_err)[:500]}"
+    finally:
+        if audio_executor is not None:
+            audio_executor.shutdown(wait=True)
+        if audio_work_dir:
+            shutil.rmtree(audio_work_dir, ignore_errors=True)
+
+    if render_stats is None: # Lỗi trước/trong render: vẫn ghi các stage đã chạy
+        render_stats = build_render_stats(config, 0, time.time() - task_start_time, False)
+    render_stats.update(timer.as_document())
+
+    # Cập nhật status DB
+    final_status = "finish" if task_success else "failed"
+    if not db_handler.update_task_status(
+        doc_id,
+        final_status,
+        output_path=final_output_path if task_success else None,
+        error_message=error_message,
+        render_stats=render_stats,
+    ):
+        print(f"!!! CB: Không cập nhật được status cuối cùng cho {doc_id}")
+        task_success = False
+    db_handler.insert_render_metrics(dict(
+        render_stats, task_id=doc_id, output_path=final_output_path if task_success else None,
+        error_message=error_message,
+    ))
+
+    print(f"--- Kết thúc Task {doc_id} ({time.time() - task_start_time:.2f}s) ---")
+    return task_success
+
+
 def main():
     """Hàm chính: Kết nối DB, lấy task, dịch path, gọi tạo video, cập nhật status."""
     script_start_time = time.time()
@@ -1270,36 +2339,8 @@ def main():
     config = None
 
     try:
-        # 1. Tải cấu hình chung từ .env
-        config = load_app_config()
-
-        # 2. Kiểm tra các đường dẫn chung từ config
-        common_paths_to_check = {
-            "Nhạc nền": (config["bg_music_file"], "file"),
-            "Video Overlay": (config["overlay_video_file"], "file"),
-            "Thư mục video nền": (config["video_folder"], "dir"),
-            "Thư mục output": (config["output_dir"], "dir_create"),
-            "Thư mục tạm": (config["temp_dir"], "dir_create"),
-        }
-        # Dịch path chung nếu cần
-        common_paths_translated = {
-            name: (translate_path(path, config), type)
-            for name, (path, type) in common_paths_to_check.items()
-        }
-        validated_common_paths = validate_paths(common_paths_translated)
-        # Cập nhật config với đường dẫn tuyệt đối đã check và dịch
-        config.update(
-            {
-                "bg_music_file": validated_common_paths["Nhạc nền"],
-                "overlay_video_file": validated_common_paths["Video Overlay"],
-                "video_folder": validated_common_paths["Thư mục video nền"],
-                "output_dir": validated_common_paths["Thư mục output"],
-                "temp_dir": validated_common_paths["Thư mục tạm"],
-                "concat_dir": validated_common_paths[
-                    "Thư mục tạm"
-                ],  # Cập nhật concat_dir
-            }
-        )
+        # 1-2. Tải cấu hình chung và kiểm tra các đường dẫn chung
+        config = load_render_config()
 
         # 3. Vòng lặp xử lý các task từ MongoDB
         processed_count, successful_videos, failed_count = 0, 0, 0
@@ -1313,113 +2354,19 @@ def main():
                 print("-> Không tìm thấy task nào đang chờ xử lý.")
                 break
             processed_count += 1
-            doc_id = task_doc["_id"]
-            print(f"--- Bắt đầu Task {processed_count} cho Doc ID: {doc_id} ---")
-            task_start_time = time.time()
-            final_output_path = None
-            task_success = False
-            error_message = None
-
-            try:
-                # --- Lấy và Dịch/Chuẩn hóa đường dẫn từ document ---
-                print("-> Lấy và chuẩn hóa/dịch đường dẫn từ MongoDB...")
-                main_audio_doc = task_doc.get("final_audio_path")
-                overlay_image_doc = task_doc.get("thumbnail_character_path")
-                text_image_doc = task_doc.get("thumbnail_text_path")
-
-                main_audio_task = translate_path(main_audio_doc, config)
-                overlay_image_task = translate_path(overlay_image_doc, config)
-                text_image_task = translate_path(text_image_doc, config)
-
-                # --- Kiểm tra các đường dẫn của task ---
-                task_paths_to_check = {
-                    "Audio chính (Task)": (main_audio_task, "file"),
-                    "Ảnh Overlay (Task)": (overlay_image_task, "file"),
-                    "Ảnh chữ (Task)": (text_image_task, "file"),
-                }
-                validated_task_paths = validate_paths(task_paths_to_check)
-
-                # --- Chuẩn bị inputs và dữ liệu ---
-                current_video_inputs = {
-                    "main_audio": validated_task_paths["Audio chính (Task)"],
-                    "bg_music": config["bg_music_file"],
-                    "overlay_image": validated_task_paths["Ảnh Overlay (Task)"],
-                    "text_image": validated_task_paths["Ảnh chữ (Task)"],
-                    "overlay_video": config["overlay_video_file"],
-                }
-                current_target_duration = get_duration(
-                    current_video_inputs["main_audio"]
-                )
-                selected_bg_videos = prepare_background_videos(
-                    config["video_folder"],
-                    current_target_duration,
-                    config["cache_file"],
-                    config["max_workers"],
-                )
-
-                # --- Tạo tên file output ---
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                output_suffix = (
-                    task_doc.get("output_suffix") or f"_{timestamp}"
-                )  # Thử đọc suffix từ DB
-                base_filename = os.path.splitext(
-                    config["output_filename_pattern"].format(
-                        id=str(doc_id), timestamp=timestamp
-                    )
-                )[0]
-                final_output_filename = f"{base_filename}{output_suffix}.mp4"
-                final_output_path = os.path.join(
-                    config["output_dir"], final_output_filename
-                )
-
-                # *** Gọi hàm tạo video tự động chọn encoder ***
-                task_success = generate_cpu_video(
-                    current_video_inputs, selected_bg_videos, final_output_path, config
-                )
-
-            except Exception as task_err:
-                print(f"!!! Lỗi chuẩn bị/chạy generate_video cho {doc_id}: {task_err}")
-                if not isinstance(
-                    task_err,
-                    (
-                        FileNotFoundError,
-                        ValueError,
-                        NotADirectoryError,
-                        OSError,
-                        ConfigError,
-                    ),
-                ):
-                    traceback.print_exc()
-                task_success = False
-                error_message = f"{type(task_err).__name__}: {str(task_err)[:500]}"
-
-            # Cập nhật status DB
-            final_status = "finish" if task_success else "failed"
-            if db_handler.update_task_status(
-                doc_id,
-                final_status,
-                output_path=final_output_path if task_success else None,
-                error_message=error_message,
-            ):
-                if task_success:
-                    successful_videos += 1
-                else:
-                    failed_count += 1
+            print(f"--- Bắt đầu Task {processed_count} cho Doc ID: {task_doc['_id']} ---")
+            if process_render_task(task_doc, config):
+                successful_videos += 1
             else:
-                print(f"!!! CB: Không cập nhật được status cuối cùng cho {doc_id}")
                 failed_count += 1
 
-            task_end_time = time.time()
-            print(
-                f"--- Kết thúc Task {processed_count} ({task_end_time - task_start_time:.2f}s) ---"
-            )
-
         # Kết thúc vòng lặp
         print("\n" + "=" * 60)
         print(f" HOÀN THÀNH ({processed_count}) TASK")
         print(f" -> Thành công: {successful_videos}")
         print(f" -> Thất bại: {failed_count}")
         print("=" * 60)
+        return successful_videos
 
     except ConfigError as cfg_err:
         print(f"\n!!! Lỗi Cấu Hình !!!\n{cfg_err}")
@@ -1434,9 +2381,279 @@ def main():
         )
 
 
-# --- Chạy hàm main ---
+def create_video_dispatcher():
+    """
+    Dispatcher cho stage video, dùng MongoClient riêng
+    (main() đóng kết nối của db_handler sau mỗi lần chạy).
+    """
+    try:
+        client = MongoClient(db_handler.MONGO_URI, serverSelectionTimeoutMS=5000)
+        collection = client[db_handler.DB_NAME][db_handler.COLLECTION_NAME]
+        return start_dispatcher(collection, stages=[STAGE_VIDEO])
+    except Exception as e:
+        print(f"Cảnh báo: Không khởi tạo được task dispatcher ({e}). Dùng sleep cố định.")
+        return None
+
+
+# ==============================================================================
+# SECTION 7: RENDER SERVICE (TIẾN TRÌNH RENDER CHẠY LIÊN TỤC)
+# ==============================================================================
+
+
+class BackgroundClipIndex:
+    """
+    Metadata video nền giữ trong bộ nhớ cho RenderService.
+    Chỉ làm mới khi mtime của thư mục video nền / thư viện chuẩn hóa thay đổi.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.library_dir = None
+        if config.get("bg_library_mode", "off") != "off":
+            self.library_dir = bg_library.get_library_dir(config["video_folder"], config.get("bg_library_dir"))
+        self._metadata = {}
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _folder_signature(self):
+        signature = []
+        for directory in (self.config["video_folder"], self.library_dir):
+            try:
+                signature.append(os.stat(directory).st_mtime if directory else None)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def refresh(self, force=False):
+        """Quét lại nếu thư mục thay đổi. Trả về True nếu index được làm mới."""
+        signature = self._folder_signature()
+        if not force and signature == self._signature:
+            return False
+        metadata = load_background_metadata(
+            self.config["video_folder"],
+            self.config["cache_file"],
+            self.config["max_workers"],
+            library_mode=self.config.get("bg_library_mode", "off"),
+            library_dir=self.config.get("bg_library_dir"),
+            config=self.config,
+        )
+        with self._lock:
+            self._metadata = metadata
+            self._signature = signature
+        print(f"-> Index video nền: {len(metadata)} clip.")
+        return True
+
+    def get_metadata(self):
+        with self._lock:
+            return self._metadata
+
+    def watch(self, stop_event, interval_seconds):
+        """Vòng lặp (chạy trong luồng riêng) kiểm tra thư mục định kỳ."""
+        while not stop_event.wait(interval_seconds):
+            try:
+                if self.refresh():
+                    print("-> Thư mục video nền thay đổi, đã làm mới index.")
+            except Exception as e:
+                print(f"CB: Lỗi làm mới index video nền: {e}")
+
+
+def _available_cores():
+    """Danh sách core tiến trình được phép dùng (tôn trọng taskset/cgroup nếu có)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def resolve_render_concurrency(config):
+    """Số job render đồng thời: RENDER_CONCURRENT_JOBS hoặc số core / RENDER_JOB_CORES."""
+    if config.get("render_concurrent_jobs", 0) > 0:
+        return config["render_concurrent_jobs"]
+    return max(1, len(_available_cores()) // max(1, config.get("render_job_cores", 8)))
+
+
+def partition_cores(cores, job_count):
+    """Chia đều danh sách core thành job_count nhóm liên tiếp (kiểu taskset -c 0-7, 8-15...)."""
+    per_job = max(1, len(cores) // max(1, job_count))
+    return [cores[(i * per_job) % len(cores):][:per_job] for i in range(job_count)]
+
+
+class RenderAdmission:
+    """
+    Điều kiện nhận job render mới: load average của máy và dung lượng trống ở temp_dir/output_dir.
+    Job đầu tiên (không có job nào đang chạy) bỏ qua kiểm tra load để service luôn tiến triển.
+    """
+
+    def __init__(self, config, job_threads):
+        self.cpu_count = len(_available_cores())
+        self.job_threads = job_threads
+        self.max_load_per_core = config.get("render_max_load_per_core", 1.0)
+        self.min_free_bytes = config.get("render_min_free_gb", 5.0) * 1024 ** 3
+        self.directories = sorted({config["temp_dir"], config["output_dir"]})
+
+    def check(self, active_jobs):
+        """Returns: (True, None) nếu được nhận job, ngược lại (False, lý do)."""
+        for directory in self.directories:
+            try:
+                free_bytes = shutil.disk_usage(directory).free
+            except OSError as e:
+                return False, f"không đọc được dung lượng trống của {directory}: {e}"
+            if free_bytes < self.min_free_bytes:
+                return False, f"{directory} chỉ còn {free_bytes / 1024 ** 3:.1f}GB trống"
+        if active_jobs > 0 and self.max_load_per_core > 0 and hasattr(os, "getloadavg"):
+            load_1m = os.getloadavg()[0]
+            max_load = self.cpu_count * self.max_load_per_core
+            if load_1m + self.job_threads > max_load:
+                return False, f"load {load_1m:.1f} + {self.job_threads} thread > {max_load:.1f}"
+        return True, None
+
+
+class RenderService:
+    """
+    Tiến trình render chạy liên tục: tải cấu hình và index video nền một lần, giữ kết nối DB,
+    claim task vào hàng đợi và render song song tối đa max_jobs task.
+
+    Mỗi task được claim (lease) chỉ khi còn slot trống -> không giữ lease của task chưa render.
+    """
+
+    IDLE_WAIT_SECONDS = 120
+    CLAIM_RETRY_SECONDS = 10
+
+    def __init__(self, config=None, max_jobs=None):
+        self.config = config or load_render_config()
+        self.max_jobs = max_jobs or resolve_render_concurrency(self.config)
+        cores = _available_cores()
+        self.job_threads = max(1, len(cores) // self.max_jobs)
+        self.job_cores = partition_cores(cores, self.max_jobs)
+        self.admission = RenderAdmission(self.config, self.job_threads)
+        self.bg_index = BackgroundClipIndex(self.config)
+        self.dispatcher = None
+        self._tasks = queue.Queue()
+        self._slots = threading.Semaphore(self.max_jobs)
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self._active_jobs = 0
+        self.stats = {"processed": 0, "succeeded": 0, "failed": 0}
+
+    def start(self):
+        print("=" * 60)
+        print(f" RENDER SERVICE: {self.max_jobs} job đồng thời x {self.job_threads} thread ({len(_available_cores())} core)")
+        print("=" * 60)
+        self.bg_index.refresh(force=True)
+        db_handler.connect_db()
+        self.dispatcher = create_video_dispatcher()
+        self._start_thread(self.bg_index.watch, "bg_index_watch", self._stop_event, self.config["bg_index_poll_seconds"])
+        self._start_thread(self._claim_loop, "render_claim")
+        for index in range(self.max_jobs):
+            self._start_thread(self._worker_loop, f"render_job_{index}", index)
+        return self
+
+    def _start_thread(self, target, name, *args):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _wait_for_work(self):
+        if self.dispatcher is not None:
+            self.dispatcher.wait(STAGE_VIDEO, timeout=self.IDLE_WAIT_SECONDS)
+        else:
+            self._stop_event.wait(self.IDLE_WAIT_SECONDS)
+
+    def _claim_loop(self):
+        """Claim task mới mỗi khi có slot trống, đẩy vào hàng đợi cho các worker."""
+        while not self._stop_event.is_set():
+            if not self._slots.acquire(timeout=1):
+                continue
+            with self._stats_lock:
+                active_jobs = self._active_jobs
+            admitted, reason = self.admission.check(active_jobs)
+            if not admitted:
+                self._slots.release()
+                print(f"-> Tạm chưa nhận job mới: {reason}. Thử lại sau {self.config['render_admission_retry_seconds']:.0f}s.")
+                self._stop_event.wait(self.config["render_admission_retry_seconds"])
+                continue
+            try:
+                task_doc = db_handler.get_next_pending_task(
+                    retry_failed_after_seconds=self.config["render_retry_failed_after_seconds"]
+                )
+            except Exception as e:
+                print(f"!!! Lỗi claim task: {e}")
+                task_doc = None
+                self._stop_event.wait(self.CLAIM_RETRY_SECONDS)
+            if task_doc is None:
+                self._slots.release()
+                if not self._stop_event.is_set():
+                    self._wait_for_work()
+                continue
+            with self._stats_lock:
+                self._active_jobs += 1
+            self._tasks.put(task_doc)
+
+    def _job_config(self, slot):
+        """
+        Config riêng của một slot: số thread ffmpeg cố định và (tùy chọn) ghim luồng worker vào
+        nhóm core của slot. Tiến trình ffmpeg con kế thừa affinity của luồng tạo ra nó.
+        """
+        cores = self.job_cores[slot]
+        pinned = None
+        if self.config.get("render_pin_affinity"):
+            if hasattr(os, "sched_setaffinity"):
+                try:
+                    os.sched_setaffinity(0, cores)  # pid 0 = luồng hiện tại
+                    pinned = cores
+                    print(f"-> Slot {slot}: ghim vào core {cores[0]}-{cores[-1]}.")
+                except OSError as e:
+                    print(f"CB: Không ghim được CPU affinity cho slot {slot}: {e}")
+            else:
+                print("CB: RENDER_PIN_AFFINITY chỉ hỗ trợ Linux (os.sched_setaffinity). Bỏ qua.")
+        return dict(self.config, ffmpeg_threads=self.job_threads, cpu_affinity=pinned,
+                    render_slot=slot, render_jobs=self.max_jobs)
+
+    def _worker_loop(self, slot):
+        job_config = self._job_config(slot)
+        while not self._stop_event.is_set():
+            try:
+                task_doc = self._tasks.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                print(f"--- [{threading.current_thread().name}] Bắt đầu Task {task_doc['_id']} ---")
+                success = process_render_task(task_doc, job_config, bg_index=self.bg_index)
+            except Exception as e:
+                print(f"!!! Lỗi không mong muốn khi render {task_doc.get('_id')}: {e}")
+                traceback.print_exc()
+                success = False
+            finally:
+                self._slots.release()
+                self._tasks.task_done()
+                if self.dispatcher is not None:
+                    self.dispatcher.notify(STAGE_VIDEO)  # Slot trống -> claim tiếp ngay
+            with self._stats_lock:
+                self._active_jobs -= 1
+                self.stats["processed"] += 1
+                self.stats["succeeded" if success else "failed"] += 1
+
+    def stop(self, timeout=None):
+        """Ngừng claim task mới; chờ các job đang render xong (tối đa timeout giây)."""
+        self._stop_event.set()
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        for thread in self._threads:
+            thread.join(timeout)
+        db_handler.close_db_connection()
+        print(f"-> Render service dừng. Thống kê: {self.stats}")
+
+    def run_forever(self):
+        self.start()
+        try:
+            while not self._stop_event.wait(1):
+                pass
+        except KeyboardInterrupt:
+            print("\n-> Nhận Ctrl+C, chờ các job đang render hoàn tất...")
+        finally:
+            self.stop()
+
+
+# --- Chạy render service ---
 if __name__ == "__main__":
-    while True:
-        main()
-        print("ngu 120s....")
-        time.sleep(120)
+    RenderService().run_forever()
@@ -36,6 +36,8 @@ try:
         # add_new_quote_or_story không cần import vì được gọi bên trong generate_long_text
     )
     from utils import estimate_num_quotes_stories, count_tokens, split_script_into_chunks
+    from task_dispatcher import start_dispatcher, STAGE_CONTENT
+    from task_lease import claim_with_lease, run_with_lease, lease_filter, lease_lost, CONTENT_LOCKED_STATUSES
 except ImportError as e:
      logging.critical(f"Failed to import necessary modules: {e}. Worker cannot start.", exc_info=True)
      exit(1)
@@ -76,12 +78,23 @@ except Exception as e:
      exit(1)
 
 # --- Main Processing Function ---
-def process_generation_task(generation_doc):
-    """Xử lý một yêu cầu tạo nội dung từ ContentGenerations."""
+def _stop_if_lease_lost(lease, generation_id):
+    """True (và log) nếu lease của task đã mất: worker khác đang xử lý, không được ghi tiếp."""
+    if lease_lost(lease):
+        logging.warning(f"Lease for task {generation_id} was lost. Stopping without further writes.")
+        return True
+    return False
+
+
+def process_generation_task(generation_doc, lease=None):
+    """
+    Xử lý một yêu cầu tạo nội dung từ ContentGenerations.
+    lease (TaskLease, optional): mọi lần ghi status chỉ áp dụng khi còn giữ lease; lease mất -> dừng.
+    """
     generation_id_obj = generation_doc["_id"]; generation_id = str(generation_id_obj)
     task_type = generation_doc.get("task_type", "from_topic"); language = generation_doc.get("language", "Vietnamese")
     topic_id = generation_doc.get("topic_id"); script_name = generation_doc.get("script_name")
-    if not script_name: script_name = str(uuid.uuid4()); content_generations_collection.update_one({"_id": generation_id_obj}, {"$set": {"script_name": script_name}})
+    if not script_name: script_name = str(uuid.uuid4()); content_generations_collection.update_one(lease_filter(generation_id_obj, lease), {"$set": {"script_name": script_name}})
 
     logging.info(f"--- Processing Task Start: {generation_id} (Type: {task_type}) ---"); logging.info(f"Lang: {language}")
 
@@ -95,8 +108,8 @@ def process_generation_task(generation_doc):
                         (task_type == "rewrite_script" and not generation_doc.get("derived_outline"))
         if current_status in ["pending", "processing_lock", "outline_failed"]: next_status = "generating_outline" if needs_outline else "content_generating"
         elif current_status == "content_failed": next_status = "content_generating"
-        elif current_status not in ["generating_outline", "content_generating"]: logging.warning(f"Task {generation_id} unexpected status '{current_status}'. Resetting."); content_generations_coll.update_one({"_id": generation_id_obj}, {"$set": {"status": "pending"}}); return
-        if next_status != current_status: logging.info(f"Update status {generation_id}: '{current_status}' -> '{next_status}'"); content_generations_coll.update_one({"_id": generation_id_obj}, {"$set": {"status": next_status, "updated_at": datetime.datetime.now(datetime.timezone.utc)}})
+        elif current_status not in ["generating_outline", "content_generating"]: logging.warning(f"Task {generation_id} unexpected status '{current_status}'. Resetting."); content_generations_coll.update_one(lease_filter(generation_id_obj, lease), {"$set": {"status": "pending"}}); return
+        if next_status != current_status: logging.info(f"Update status {generation_id}: '{current_status}' -> '{next_status}'"); content_generations_coll.update_one(lease_filter(generation_id_obj, lease), {"$set": {"status": next_status, "updated_at": datetime.datetime.now(datetime.timezone.utc)}})
 
         # --- Config/Estimation ---
         model = generation_doc.get("model", "gpt-4o")
@@ -113,7 +126,7 @@ def process_generation_task(generation_doc):
         if db_target_chars is None: update_est_fields["target_chars"] = target_chars
         if update_est_fields:
              logging.info(f"Task {generation_id}: Saving estimated params: {update_est_fields}")
-             content_generations_coll.update_one({"_id": generation_id_obj}, {"$set": update_est_fields})
+             content_generations_coll.update_one(lease_filter(generation_id_obj, lease), {"$set": update_est_fields})
         # Sử dụng giá trị từ DB nếu có, nếu không dùng giá trị vừa ước lượng
         num_quotes = db_num_quotes if db_num_quotes is not None else num_quotes
         num_stories = db_num_stories if db_num_stories is not None else num_stories
@@ -152,7 +165,7 @@ def process_generation_task(generation_doc):
             logging.debug(f"Updating ContentGenerations Filter: {{'_id': {generation_id_obj}}}, Update: {{'$set': {final_meta_updates_gen}}}") # Thêm log để kiểm tra
             # ---> DÒNG 153 (hoặc gần đó) GÂY LỖI? <---
             content_generations_coll.update_one(
-                {"_id": generation_id_obj}, # Tham số 1: filter (OK)
+                lease_filter(generation_id_obj, lease), # Tham số 1: filter (chỉ khi còn giữ lease)
                 {"$set": final_meta_updates_gen} # Tham số 2: update (OK)
             )
             # ------------------------------------
@@ -166,13 +179,14 @@ def process_generation_task(generation_doc):
             outline_markdown = generation_doc.get("derived_outline")
             if next_status == "generating_outline":
                 outline_markdown = generate_outline_from_script(source_script, language, model); assert outline_markdown, "Fail gen outline from script."
-                content_generations_coll.update_one({"_id": generation_id_obj}, {"$set": {"derived_outline": outline_markdown, "status": "rewriting_script"}})
+                content_generations_coll.update_one(lease_filter(generation_id_obj, lease), {"$set": {"derived_outline": outline_markdown, "status": "rewriting_script"}})
                 next_status = "rewriting_script"
-            else: logging.info("Using existing derived outline."); content_generations_coll.update_one({"_id": generation_id_obj}, {"$set": {"status": "rewriting_script"}})
+            else: logging.info("Using existing derived outline."); content_generations_coll.update_one(lease_filter(generation_id_obj, lease), {"$set": {"status": "rewriting_script"}})
 
             logging.info("Starting full script rewrite...")
             final_script = rewrite_entire_script(source_script, outline_markdown, language, model, target_chars)
             assert final_script, "Failed rewrite (LLM empty)."
+            if _stop_if_lease_lost(lease, generation_id): return
             generation_success = True
             script_chunks_collection.delete_many({"generation_id": generation_id_obj})
             logging.info("Splitting rewritten script...")
@@ -180,15 +194,17 @@ def process_generation_task(generation_doc):
             chunks = split_script_into_chunks(final_script, max_chars_tts, language)
             assert chunks, "Failed to split rewritten script."
             logging.info(f"Saving {len(chunks)} rewritten chunks...")
-            for idx, chunk_txt in enumerate(chunks): save_chunk_to_db(generation_id_obj, script_name, idx, f"Rewrite Pt.{idx+1}", chunk_txt, 1, "rewrite_chunk")
+            for idx, chunk_txt in enumerate(chunks):
+                if _stop_if_lease_lost(lease, generation_id): return
+                save_chunk_to_db(generation_id_obj, script_name, idx, f"Rewrite Pt.{idx+1}", chunk_txt, 1, "rewrite_chunk")
 
         elif task_type == "from_topic":
             outline_markdown = generation_doc.get("outline")
             if next_status == "generating_outline":
                  outline_markdown = generate_outline_markdown(topic_input, language, model, num_quotes, num_stories); assert outline_markdown, "Fail gen outline."
-                 content_generations_coll.update_one({"_id": generation_id_obj}, {"$set": {"outline": outline_markdown, "status": "content_generating"}})
+                 content_generations_coll.update_one(lease_filter(generation_id_obj, lease), {"$set": {"outline": outline_markdown, "status": "content_generating"}})
                  next_status = "content_generating"
-            else: logging.info("Using existing outline."); content_generations_coll.update_one({"_id": generation_id_obj}, {"$set": {"status": "content_generating"}})
+            else: logging.info("Using existing outline."); content_generations_coll.update_one(lease_filter(generation_id_obj, lease), {"$set": {"status": "content_generating"}})
 
             parsed = parse_outline(outline_markdown); assert parsed, "Fail parse outline."
             flat_outline = flatten_outline(parsed); assert flat_outline, "Flattened outline empty."
@@ -196,21 +212,24 @@ def process_generation_task(generation_doc):
 
             logging.info("Starting detailed content generation...")
             chunk_words = 300 # Ước tính từ cho mỗi mục outline
-            generation_success = generate_long_text(flat_outline, topic_input, language, script_name, generation_id_obj, num_quotes, num_stories, min_chars, chunk_words, model)
+            generation_success = generate_long_text(flat_outline, topic_input, language, script_name, generation_id_obj, num_quotes, num_stories, min_chars, chunk_words, model,
+                                                    should_stop=lambda: lease_lost(lease))
 
         else: raise ValueError(f"Unknown task_type: {task_type}")
 
         # --- Cập nhật status cuối ---
+        if _stop_if_lease_lost(lease, generation_id): return
         final_status = "content_ready" if generation_success else "content_failed"
         final_update = {"status": final_status, "updated_at": datetime.datetime.now(datetime.timezone.utc)}
         if not generation_success: final_update["error_details"] = {"stage": f"task_{task_type}", "message": "Process finished with errors.", "timestamp": datetime.datetime.now(datetime.timezone.utc)}
-        content_generations_coll.update_one({"_id": generation_id_obj}, {"$set": final_update})
+        if content_generations_coll.update_one(lease_filter(generation_id_obj, lease), {"$set": final_update}).matched_count == 0:
+            logging.warning(f"Final status for task {generation_id} not written: lease no longer owned by this worker."); return
         log_func = logging.info if generation_success else logging.error
         log_func(f"--- Task {generation_id} ({task_type}) FINISHED with Status: {final_status} ---")
 
     except Exception as e:
         logging.exception(f"CRITICAL error processing task {generation_id}: {e}")
-        try: content_generations_coll.update_one({"_id": generation_id_obj}, {"$set": {"status": "content_failed", "error_details": {"stage": "main_exception", "message": str(e)[:500]}, "updated_at": datetime.datetime.now(datetime.timezone.utc)}})
+        try: content_generations_coll.update_one(lease_filter(generation_id_obj, lease), {"$set": {"status": "content_failed", "error_details": {"stage": "main_exception", "message": str(e)[:500]}, "updated_at": datetime.datetime.now(datetime.timezone.utc)}})
         except Exception as db_err: logging.error(f"Failed update CRITICAL error status {generation_id}: {db_err}")
 
 
@@ -225,48 +244,47 @@ def main():
 
     CHECK_INTERVAL_SECONDS = 15 # Check more frequently
     MAX_CONCURRENT_TASKS = int(os.getenv("MAX_CONCURRENT_TASKS", 2)) # Default to 1 for stability
+    # Task content_failed/outline_failed chỉ được claim lại sau khoảng này (tránh gọi OpenAI liên tục cho task lỗi)
+    RETRY_FAILED_AFTER_SECONDS = float(os.getenv("CONTENT_RETRY_FAILED_AFTER_SECONDS", 300))
     logging.info(f"Checking interval: {CHECK_INTERVAL_SECONDS}s. Max concurrent tasks: {MAX_CONCURRENT_TASKS}")
+    # Dispatcher đánh thức vòng lặp ngay khi có task mới (change stream / polling nhẹ); sleep chỉ còn là timeout dự phòng
+    dispatcher = start_dispatcher(content_generations_collection, stages=[STAGE_CONTENT])
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS) as executor:
         active_tasks = set() # generation_id currently being processed
 
         while True:
             processed_in_cycle = False
-            # Check and unlock potentially stuck tasks first
-            try:
-                one_hour_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
-                stuck_tasks_result = content_generations_collection.update_many(
-                    {"status": "processing_lock", "updated_at": {"$lt": one_hour_ago}},
-                    {"$set": {"status": "pending", "updated_at": datetime.datetime.now(datetime.timezone.utc), "error_details": {"message": "Reset from stuck processing_lock"}}} )
-                if stuck_tasks_result.modified_count > 0:
-                    logging.warning(f"Reset {stuck_tasks_result.modified_count} tasks stuck in 'processing_lock' state.")
-                    # We don't know exactly which tasks were reset without another query,
-                    # so clearing active_tasks might be inaccurate if some finish correctly.
-                    # A safer approach might be needed in production. For now, log it.
-            except Exception as unlock_err:
-                 logging.error(f"Error trying to unlock stuck tasks: {unlock_err}")
-
             try:
                 # Attempt to fetch a new task only if below concurrency limit
                 if len(active_tasks) < MAX_CONCURRENT_TASKS:
                     logging.debug(f"Active: {len(active_tasks)}/{MAX_CONCURRENT_TASKS}. Checking for tasks...")
 
-                    # Find a task to process (prioritize failed, then pending)
-                    task_to_process = content_generations_collection.find_one_and_update(
-                       {"status": {"$in": ["pending", "content_failed", "outline_failed"]}}, # States to pick up
-                       {"$set": {"status": "processing_lock", "updated_at": datetime.datetime.now(datetime.timezone.utc)}},
-                       sort=[("status", 1),("priority", -1), ("created_at", 1)], # Sort: failed first, then high prio, then oldest
-                       return_document=ReturnDocument.AFTER # Use imported constant
+                    # Find a task to process (prioritize failed, then pending).
+                    # Task lỗi chỉ được lấy lại sau RETRY_FAILED_AFTER_SECONDS kể từ lần cập nhật cuối.
+                    # Task đang xử lý có lease hết hạn (worker chết) được cướp lại trong cùng thao tác nguyên tử.
+                    retry_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=RETRY_FAILED_AFTER_SECONDS)
+                    claimed = claim_with_lease(
+                       content_generations_collection,
+                       ready_query={"$or": [ # States to pick up
+                           {"status": "pending"},
+                           {"status": {"$in": ["content_failed", "outline_failed"]}, "updated_at": {"$lt": retry_before}},
+                       ]},
+                       locked_query={"status": {"$in": CONTENT_LOCKED_STATUSES}},
+                       lock_set={"status": "processing_lock", "updated_at": datetime.datetime.now(datetime.timezone.utc)},
+                       stage=STAGE_CONTENT,
+                       sort=[("status", 1),("priority", -1), ("created_at", 1)] # Sort: failed first, then high prio, then oldest
                     )
 
-                    if task_to_process:
+                    if claimed:
+                        task_to_process, lease = claimed
                         gen_id = task_to_process['_id']
                         logging.info(f"Picked up task: {gen_id} (Type: {task_to_process.get('task_type')}, Status: {task_to_process.get('status')})")
                         active_tasks.add(gen_id) # Add to our tracked set
                         processed_in_cycle = True
 
-                        # Submit to thread pool
-                        future = executor.submit(process_generation_task, task_to_process)
+                        # Submit to thread pool (heartbeat gia hạn lease suốt thời gian xử lý)
+                        future = executor.submit(run_with_lease, lease, process_generation_task, task_to_process, lease=lease)
 
                         # Define callback to run when future completes
                         def task_done_callback(task_id):
@@ -281,6 +299,7 @@ def main():
                                     # Always remove from active set when thread finishes
                                     if task_id in active_tasks: active_tasks.remove(task_id)
                                     logging.debug(f"Task {task_id} removed from active set. Current: {len(active_tasks)}")
+                                    dispatcher.notify(STAGE_CONTENT) # Slot trống -> kiểm tra task mới ngay
                             return callback
 
                         future.add_done_callback(task_done_callback(gen_id)) # Pass gen_id to callback correctly
@@ -291,15 +310,16 @@ def main():
                 # --- Sleep logic ---
                 if not processed_in_cycle and len(active_tasks) == 0:
                     # No new tasks picked up AND no tasks running -> Long sleep
-                    logging.info(f"No tasks found or running. Waiting {CHECK_INTERVAL_SECONDS}s...")
-                    time.sleep(CHECK_INTERVAL_SECONDS)
+                    logging.info(f"No tasks found or running. Waiting for dispatcher (max {CHECK_INTERVAL_SECONDS}s)...")
+                    dispatcher.wait(STAGE_CONTENT, timeout=CHECK_INTERVAL_SECONDS)
                 elif len(active_tasks) >= MAX_CONCURRENT_TASKS:
-                    # Max tasks running -> Short sleep, check again soon
-                    logging.debug(f"Max concurrent tasks ({len(active_tasks)}) reached. Waiting {CHECK_INTERVAL_SECONDS / 3:.1f}s...")
-                    time.sleep(CHECK_INTERVAL_SECONDS / 3)
-                else:
-                    # Tasks are running but slots available, OR just processed one -> Very short sleep
-                    time.sleep(3)
+                    # Max tasks running -> chờ đến khi một task xong (callback notify) hoặc hết timeout
+                    logging.debug(f"Max concurrent tasks ({len(active_tasks)}) reached. Waiting for a free slot...")
+                    dispatcher.wait(STAGE_CONTENT, timeout=CHECK_INTERVAL_SECONDS)
+                elif not processed_in_cycle:
+                    # Còn slot nhưng không có task mới -> chờ sự kiện task mới
+                    dispatcher.wait(STAGE_CONTENT, timeout=CHECK_INTERVAL_SECONDS)
+                # Vừa nhận một task và còn slot -> lấy tiếp ngay, không chờ
 
             except pymongo.errors.ConnectionFailure as conn_err:
                  logging.error(f"MongoDB Connection Failure in main loop: {conn_err}. Resetting connection flag and waiting...")
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# path_translator.py
+"""
+Dịch đường dẫn giữa Windows và Linux (ổ mạng / Samba) theo mapping trong .env.
+
+- Mapping được đọc MỘT lần (PATH_MAP_X=..., MAP_LINUX_PREFIX_n + MAP_LINUX_TARGET_n) và biên dịch
+  thành cây tiền tố (trie) theo từng thành phần của path -> tìm prefix dài nhất trong một lần duyệt,
+  không sắp xếp lại / không dựng regex cho mỗi lần gọi.
+- Prefix Windows (ổ đĩa, UNC) so khớp không phân biệt hoa thường; prefix Linux phân biệt hoa thường
+  (giống hệ thống file Linux).
+- PathTranslator.translate được memoize (LRU): cùng một path (vd: nhạc nền, overlay) chỉ dịch một lần.
+- Dùng chung cho final_make (translate_path, path của task) và filter network_to_static_url của app.py.
+"""
+
+import functools
+import ntpath
+import os
+import platform
+import posixpath
+import re
+from typing import Dict, Iterable, Mapping, Optional, Tuple
+
+DEFAULT_CACHE_SIZE = 4096
+
+_WINDOWS_ABSOLUTE_RE = re.compile(r"^[a-zA-Z]:[/\\]")
+
+
+def mappings_from_env(environ: Optional[Mapping[str, str]] = None) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Đọc mapping từ biến môi trường.
+
+    Returns:
+        tuple: (win_to_linux, linux_to_win). Prefix Linux thiếu MAP_LINUX_TARGET_n bị bỏ qua
+        (xem missing_linux_targets để cảnh báo).
+    """
+    environ = os.environ if environ is None else environ
+    win_to_linux: Dict[str, str] = {}
+    linux_to_win: Dict[str, str] = {}
+    linux_prefixes: Dict[str, str] = {}
+    win_targets: Dict[str, str] = {}
+    for key, value in environ.items():
+        value_clean = value.strip().strip("'\"")
+        if not value_clean:
+            continue
+        # Win -> Linux (PATH_MAP_X=...)
+        if key.startswith("PATH_MAP_"):
+            drive_key = key[len("PATH_MAP_"):].upper()
+            linux_target = value_clean.replace("\\", "/").rstrip("/")
+            if len(drive_key) == 1 and drive_key.isalpha() and linux_target:
+                win_to_linux[f"{drive_key}:"] = linux_target
+        # Linux -> Win (MAP_LINUX_PREFIX_n + MAP_LINUX_TARGET_n)
+        elif key.startswith("MAP_LINUX_PREFIX_"):
+            linux_prefixes[key[len("MAP_LINUX_PREFIX_"):]] = value_clean.replace("\\", "/").rstrip("/")
+        elif key.startswith("MAP_LINUX_TARGET_"):
+            win_targets[key[len("MAP_LINUX_TARGET_"):]] = value_clean
+
+    for index, linux_prefix in linux_prefixes.items():
+        win_target = win_targets.get(index)
+        if not linux_prefix or not win_target:
+            continue
+        if len(win_target) == 1 and win_target.isalpha():
+            win_target += ":"
+        elif not win_target.startswith("\\\\"):
+            win_target = win_target.rstrip("\\/")
+        if win_target:
+            linux_to_win[linux_prefix] = win_target
+    return win_to_linux, linux_to_win
+
+
+def missing_linux_targets(environ: Optional[Mapping[str, str]] = None) -> Dict[str, str]:
+    """{index: prefix} của các MAP_LINUX_PREFIX_n không có MAP_LINUX_TARGET_n tương ứng."""
+    environ = os.environ if environ is None else environ
+    return {
+        key[len("MAP_LINUX_PREFIX_"):]: value.strip().strip("'\"")
+        for key, value in environ.items()
+        if key.startswith("MAP_LINUX_PREFIX_") and value.strip().strip("'\"")
+        and not environ.get(f"MAP_LINUX_TARGET_{key[len('MAP_LINUX_PREFIX_'):]}", "").strip().strip("'\"")
+    }
+
+
+class _PrefixTrie:
+    """Trie theo thành phần path ('/'); lookup trả về prefix khớp dài nhất (có ranh giới thư mục)."""
+
+    _TARGET = object()
+
+    def __init__(self, mappings: Mapping[str, str], case_insensitive: bool):
+        self.case_insensitive = case_insensitive
+        self._root: dict = {}
+        for prefix, target in mappings.items():
+            node = self._root
+            for part in self._split(prefix.replace("\\", "/").rstrip("/")):
+                node = node.setdefault(part, {})
+            node[self._TARGET] = target
+
+    def _split(self, path: str):
+        parts = path.split("/")
+        return [part.lower() for part in parts] if self.case_insensitive else parts
+
+    def longest_match(self, path_norm: str):
+        """
+        Returns:
+            tuple: (target, phần còn lại của path) hoặc None nếu không prefix nào khớp.
+        """
+        parts = path_norm.split("/")
+        keys = self._split(path_norm)
+        node = self._root
+        best = None
+        for depth, key in enumerate(keys):
+            node = node.get(key)
+            if node is None:
+                break
+            # Prefix phải được theo sau bởi '/' (khớp 'Z:/a', không khớp 'Z:' hay '/mnt/data2' với '/mnt/data')
+            if self._TARGET in node and depth + 1 < len(parts):
+                best = (node[self._TARGET], depth + 1)
+        if best is None:
+            return None
+        target, consumed = best
+        return target, "/".join(parts[consumed:]).lstrip("/")
+
+
+class PathTranslator:
+    """Bộ dịch path đã biên dịch sẵn; dùng chung được giữa nhiều luồng (trie chỉ đọc, lru_cache thread-safe)."""
+
+    def __init__(self, win_to_linux: Optional[Mapping[str, str]] = None,
+                 linux_to_win: Optional[Mapping[str, str]] = None,
+                 system: Optional[str] = None, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.win_to_linux = dict(win_to_linux or {})
+        self.linux_to_win = dict(linux_to_win or {})
+        self.system = system or platform.system()
+        self._win_trie = _PrefixTrie(self.win_to_linux, case_insensitive=True)
+        self._linux_trie = _PrefixTrie(self.linux_to_win, case_insensitive=False)
+        self.translate = functools.lru_cache(maxsize=cache_size)(self._translate)
+
+    @classmethod
+    def from_env(cls, environ: Optional[Mapping[str, str]] = None, **kwargs) -> "PathTranslator":
+        win_to_linux, linux_to_win = mappings_from_env(environ)
+        return cls(win_to_linux, linux_to_win, **kwargs)
+
+    def _translate(self, path_str):
+        """
+        Dịch path cho HĐH đang chạy: Linux -> dịch path Windows, Windows -> dịch path Linux.
+        Trả về path đã chuẩn hóa '/' nếu không có mapping (hoặc path gốc nếu không phải chuỗi).
+        """
+        if not path_str or not isinstance(path_str, str):
+            return path_str
+        path_norm = path_str.replace("\\", "/")
+        try:
+            if self.system == "Linux":
+                match = self._win_trie.longest_match(path_norm)
+                if match:
+                    linux_prefix, rest_of_path = match
+                    return posixpath.join(linux_prefix, rest_of_path)
+            elif self.system == "Windows":
+                # Đã là path Windows hợp lệ -> chỉ chuẩn hóa lại
+                if _WINDOWS_ABSOLUTE_RE.match(path_norm) or path_norm.startswith("//"):
+                    return ntpath.normpath(path_str)
+                match = self._linux_trie.longest_match(path_norm)
+                if match:
+                    win_prefix, rest_of_path = match
+                    if len(win_prefix) == 2 and win_prefix.endswith(":"):
+                        win_prefix += "\\"
+                    return ntpath.join(win_prefix, rest_of_path)
+        except Exception as e:
+            print(f"Cảnh báo: Lỗi khi dịch đường dẫn '{path_str}': {e}")
+        return path_norm
+
+    def translate_many(self, paths: Mapping[str, str]) -> Dict[str, str]:
+        """Dịch một dict {tên: path} (giữ nguyên key)."""
+        return {name: self.translate(path) for name, path in paths.items()}
+
+    def translate_fields(self, doc: Mapping, fields: Iterable[str]) -> Dict[str, str]:
+        """Dịch các trường path của một document (vd: task MongoDB). Trường thiếu -> None."""
+        return {field: self.translate(doc.get(field)) for field in fields}
+
+    def cache_info(self):
+        return self.translate.cache_info()
+
+
+def get_path_translator(config) -> PathTranslator:
+    """PathTranslator của config (tạo bởi load_render_config); tự dựng và gắn vào config nếu chưa có."""
+    translator = config.get("path_translator")
+    if translator is None:
+        translator = config["path_translator"] = PathTranslator(
+            config.get("win_to_linux_mappings"), config.get("linux_to_win_mappings")
+        )
+    return translator
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+# pipeline_orchestrator.py
+"""
+Orchestrator chạy toàn bộ pipeline trong MỘT tiến trình:
+
+    content -> audio (vi / other) -> [thumbnail: tiến trình ngoài] -> video
+
+Mỗi stage có pool luồng riêng và một luồng điều phối: khi còn slot trống, nó khóa (claim)
+task tiếp theo của stage và giao cho handler của module cũ (main_worker, cronaudio,
+create_audio_other, final_make). Các stage chạy song song trên các generation khác nhau,
+ví dụ audio của A chạy cùng lúc với render video của B.
+
+Stage thumbnail là "cổng" bị động: thumbnail do tiến trình khác tạo (thumbnail_status),
+orchestrator chỉ báo số task đang chờ ở cổng này.
+
+Chạy: python pipeline_orchestrator.py
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# Import các module stage (mỗi module tự kết nối DB khi import)
+try:
+    from db_manager import connect_db, get_content_generations_collection
+    from task_dispatcher import (
+        start_dispatcher, STAGE_CONTENT, STAGE_AUDIO_VI, STAGE_AUDIO_OTHER, STAGE_VIDEO
+    )
+    import main_worker
+    import cronaudio
+    import create_audio_other
+    import final_make
+    import db_handler
+    from task_lease import TaskLease, claim_with_lease, lease_filter, CONTENT_LOCKED_STATUSES, AUDIO_LOCKED_STATUSES
+except ImportError as e:
+    logging.critical(f"CRITICAL: Failed to import pipeline modules: {e}. Orchestrator cannot start.")
+    exit(1)
+
+logger = logging.getLogger("PipelineOrchestrator")
+
+# --- Configuration ---
+ORCH_CONTENT_WORKERS = int(os.getenv("ORCH_CONTENT_WORKERS", os.getenv("MAX_CONCURRENT_TASKS", 2)))
+ORCH_AUDIO_VI_WORKERS = int(os.getenv("ORCH_AUDIO_VI_WORKERS", os.getenv("VI_AUDIO_MAX_CONCURRENT_TASKS", 2)))
+ORCH_AUDIO_OTHER_WORKERS = int(os.getenv("ORCH_AUDIO_OTHER_WORKERS", 1))
+ORCH_VIDEO_WORKERS = int(os.getenv("ORCH_VIDEO_WORKERS", 1))
+ORCH_IDLE_WAIT_SECONDS = float(os.getenv("ORCH_IDLE_WAIT_SECONDS", 60)) # Quét dự phòng khi không có sự kiện
+ORCH_REPORT_INTERVAL_SECONDS = float(os.getenv("ORCH_REPORT_INTERVAL_SECONDS", 300))
+ORCH_THROUGHPUT_WINDOW_SECONDS = 3600 # Throughput tính trên cửa sổ 1 giờ gần nhất
+# Task audio/video lỗi chỉ được claim lại sau khoảng này (tránh retry liên tục một task lỗi mãi)
+ORCH_RETRY_FAILED_AFTER_SECONDS = float(os.getenv("ORCH_RETRY_FAILED_AFTER_SECONDS", 300))
+
+STAGE_THUMBNAIL = "thumbnail"
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+# --- Claim functions: khóa nguyên tử (kèm lease) task tiếp theo của mỗi stage (cùng quy ước status với worker cũ) ---
+# Mỗi hàm trả về (document, TaskLease | None) hoặc None nếu không có task.
+
+ClaimResult = Optional[Tuple[Dict[str, Any], Optional[TaskLease]]]
+
+
+def _claim_content_task() -> ClaimResult:
+    retry_before = _now() - datetime.timedelta(seconds=ORCH_RETRY_FAILED_AFTER_SECONDS)
+    return claim_with_lease(
+        get_content_generations_collection(),
+        ready_query={"$or": [
+            {"status": "pending"},
+            {"status": {"$in": ["content_failed", "outline_failed"]}, "updated_at": {"$lt": retry_before}},
+        ]},
+        locked_query={"status": {"$in": CONTENT_LOCKED_STATUSES}},
+        lock_set={"status": "processing_lock", "updated_at": _now()},
+        stage=STAGE_CONTENT,
+        sort=[("status", 1), ("priority", -1), ("created_at", 1)],
+    )
+
+
+def _claim_audio_task(vietnamese: bool) -> ClaimResult:
+    language_filter = "Vietnamese" if vietnamese else {"$ne": "Vietnamese"}
+    retry_before = _now() - datetime.timedelta(seconds=ORCH_RETRY_FAILED_AFTER_SECONDS)
+    return claim_with_lease(
+        get_content_generations_collection(),
+        ready_query={"language": language_filter, "$or": [
+            {"status": "content_ready"},
+            {"status": "audio_failed", "updated_at": {"$lt": retry_before}},
+        ]},
+        locked_query={"language": language_filter, "status": {"$in": AUDIO_LOCKED_STATUSES}},
+        lock_set={"status": "audio_processing_lock", "updated_at": _now()},
+        stage=STAGE_AUDIO_VI if vietnamese else STAGE_AUDIO_OTHER,
+        sort=[("priority", -1), ("created_at", 1)],
+    )
+
+
+def _claim_video_task() -> ClaimResult:
+    # db_handler tự giữ lease của task video (heartbeat tới khi update_task_status)
+    task_doc = db_handler.get_next_pending_task(retry_failed_after_seconds=ORCH_RETRY_FAILED_AFTER_SECONDS)
+    return (task_doc, None) if task_doc else None
+
+
+class PipelineStage:
+    """Một stage: pool luồng (ThreadPoolExecutor) + luồng điều phối claim task và gọi handler."""
+
+    def __init__(self, name: str, workers: int, claim: Callable[[], ClaimResult],
+                 handler: Callable[..., Any], dispatcher=None, dispatcher_stage: Optional[str] = None,
+                 downstream: Optional[List["PipelineStage"]] = None,
+                 on_error: Optional[Callable[[Dict[str, Any], Exception, Optional[TaskLease]], None]] = None):
+        self.name = name
+        self.workers = max(1, workers)
+        self._claim = claim
+        self._handler = handler
+        self._dispatcher = dispatcher
+        self._dispatcher_stage = dispatcher_stage
+        self.downstream: List["PipelineStage"] = downstream or []
+        self._on_error = on_error
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._slots = threading.Semaphore(self.workers)
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Any, float] = {}
+        self._completed: Deque[Tuple[float, float, bool]] = collections.deque() # (finished_at, duration, success)
+        self._total_succeeded = 0
+        self._total_failed = 0
+        self._threads: List[threading.Thread] = []
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    # --- Vòng đời ---
+
+    def start(self) -> None:
+        self._stop_event.clear()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"orch_{self.name}_task")
+        loop_thread = threading.Thread(target=self._schedule_loop, name=f"orch_{self.name}", daemon=True)
+        loop_thread.start()
+        self._threads.append(loop_thread)
+        if self._dispatcher is not None and self._dispatcher_stage:
+            # Chuyển sự kiện của dispatcher thành sự kiện đánh thức stage
+            relay_thread = threading.Thread(target=self._relay_dispatcher_events, name=f"orch_{self.name}_relay", daemon=True)
+            relay_thread.start()
+            self._threads.append(relay_thread)
+
+    def stop(self, wait: bool = False) -> None:
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+    def wake(self) -> None:
+        self._wake_event.set()
+
+    def _relay_dispatcher_events(self) -> None:
+        while not self._stop_event.is_set():
+            if self._dispatcher.wait(self._dispatcher_stage, timeout=ORCH_IDLE_WAIT_SECONDS):
+                self._wake_event.set()
+
+    # --- Điều phối ---
+
+    def _schedule_loop(self) -> None:
+        logger.info(f"[{self.name}] Stage started with {self.workers} workers.")
+        while not self._stop_event.is_set():
+            # Chờ đến khi có slot trống
+            if not self._slots.acquire(timeout=1.0):
+                continue
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                logger.error(f"[{self.name}] Error claiming task: {e}")
+                claimed = None
+            if claimed is None:
+                self._slots.release()
+                self._wake_event.wait(ORCH_IDLE_WAIT_SECONDS)
+                self._wake_event.clear()
+                continue
+            self._executor.submit(self._run_task, *claimed)
+
+    def _run_task(self, task_doc: Dict[str, Any], lease: Optional[TaskLease] = None) -> None:
+        task_id = task_doc.get("_id")
+        started_at = time.monotonic()
+        with self._lock:
+            self._in_flight[task_id] = started_at
+        success = False
+        if lease is not None:
+            lease.start_heartbeat()
+        try:
+            # Handler nhận lease để chỉ ghi status khi còn là chủ và dừng khi lease mất
+            result = self._handler(task_doc, lease) if lease is not None else self._handler(task_doc)
+            success = result is not False # Handler cũ trả về None/True khi thành công
+        except Exception as e:
+            logger.exception(f"[{self.name}] Handler failed for task {task_id}: {e}")
+            if self._on_error is not None:
+                try:
+                    self._on_error(task_doc, e, lease)
+                except Exception as err_update:
+                    logger.error(f"[{self.name}] Failed to record error for task {task_id}: {err_update}")
+        finally:
+            if lease is not None:
+                lease.release()
+            finished_at = time.monotonic()
+            with self._lock:
+                self._in_flight.pop(task_id, None)
+                self._completed.append((finished_at, finished_at - started_at, success))
+                if success:
+                    self._total_succeeded += 1
+                else:
+                    self._total_failed += 1
+            self._slots.release()
+            self._wake_event.set() # Slot trống -> claim task tiếp theo ngay
+            for next_stage in self.downstream:
+                next_stage.wake() # Task có thể đã sẵn sàng cho stage sau
+            logger.info(f"[{self.name}] Task {task_id} finished in {finished_at - started_at:.1f}s (success={success}).")
+
+    # --- Metrics ---
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            while self._completed and now - self._completed[0][0] > ORCH_THROUGHPUT_WINDOW_SECONDS:
+                self._completed.popleft()
+            durations = [duration for _, duration, _ in self._completed]
+            return {
+                "workers": self.workers,
+                "in_flight": len(self._in_flight),
+                "completed_last_hour": len(durations),
+                "tasks_per_hour": round(len(durations) * 3600 / ORCH_THROUGHPUT_WINDOW_SECONDS, 2),
+                "avg_duration_seconds": round(sum(durations) / len(durations), 1) if durations else None,
+                "total_succeeded": self._total_succeeded,
+                "total_failed": self._total_failed,
+            }
+
+
+class PipelineOrchestrator:
+    """Dựng stage graph, khởi động các stage và báo cáo throughput định kỳ."""
+
+    def __init__(self):
+        connect_db()
+        generations_collection = get_content_generations_collection()
+        if generations_collection is None:
+            raise ConnectionError("ContentGenerations collection unavailable.")
+        self._generations_collection = generations_collection
+        self._stop_event = threading.Event()
+
+        content_dispatcher = start_dispatcher(generations_collection, stages=[STAGE_CONTENT, STAGE_AUDIO_VI, STAGE_AUDIO_OTHER])
+        video_dispatcher = final_make.create_video_dispatcher()
+        self._render_config = final_make.load_render_config() # Raise ConfigError nếu cấu hình render sai
+
+        self.video_stage = PipelineStage(
+            STAGE_VIDEO, ORCH_VIDEO_WORKERS, _claim_video_task,
+            lambda doc: final_make.process_render_task(doc, self._render_config),
+            dispatcher=video_dispatcher, dispatcher_stage=STAGE_VIDEO,
+        )
+        self.audio_vi_stage = PipelineStage(
+            STAGE_AUDIO_VI, ORCH_AUDIO_VI_WORKERS, lambda: _claim_audio_task(vietnamese=True),
+            cronaudio.process_audio_task_single_thread,
+            dispatcher=content_dispatcher, dispatcher_stage=STAGE_AUDIO_VI,
+            downstream=[self.video_stage], on_error=self._mark_audio_failed,
+        )
+        self.audio_other_stage = PipelineStage(
+            STAGE_AUDIO_OTHER, ORCH_AUDIO_OTHER_WORKERS, lambda: _claim_audio_task(vietnamese=False),
+            create_audio_other.process_audio_task_multi_thread,
+            dispatcher=content_dispatcher, dispatcher_stage=STAGE_AUDIO_OTHER,
+            downstream=[self.video_stage], on_error=self._mark_audio_failed,
+        )
+        self.content_stage = PipelineStage(
+            STAGE_CONTENT, ORCH_CONTENT_WORKERS, _claim_content_task,
+            main_worker.process_generation_task,
+            dispatcher=content_dispatcher, dispatcher_stage=STAGE_CONTENT,
+            downstream=[self.audio_vi_stage, self.audio_other_stage],
+        )
+        self.stages = [self.content_stage, self.audio_vi_stage, self.audio_other_stage, self.video_stage]
+
+    def _mark_audio_failed(self, task_doc: Dict[str, Any], error: Exception, lease: Optional[TaskLease] = None) -> None:
+        self._generations_collection.update_one(
+            lease_filter(task_doc["_id"], lease),
+            {"$set": {"status": "audio_failed", "error_details": {"message": f"Worker error: {error}"}, "updated_at": _now()}}
+        )
+
+    def _thumbnail_backlog(self) -> int:
+        """Số generation đã có audio nhưng còn chờ thumbnail (cổng bị động)."""
+        return self._generations_collection.count_documents(
+            {"status": "completed", "thumbnail_status": {"$ne": "generated"}}
+        )
+
+    def report(self) -> Dict[str, Any]:
+        report = {stage.name: stage.stats() for stage in self.stages}
+        try:
+            report[STAGE_THUMBNAIL] = {"waiting": self._thumbnail_backlog()}
+        except Exception as e:
+            report[STAGE_THUMBNAIL] = {"waiting": None, "error": str(e)[:200]}
+        for name, stats in report.items():
+            logger.info(f"[Throughput] {name}: {stats}")
+        return report
+
+    def run_forever(self) -> None:
+        for stage in self.stages:
+            stage.start()
+        logger.info("=== Pipeline orchestrator started ===")
+        next_report_at = time.monotonic() + ORCH_REPORT_INTERVAL_SECONDS
+        try:
+            # Task bị kẹt (worker chết) được thu hồi qua lease hết hạn ngay trong các hàm claim
+            while not self._stop_event.wait(30):
+                if time.monotonic() >= next_report_at:
+                    self.report()
+                    next_report_at = time.monotonic() + ORCH_REPORT_INTERVAL_SECONDS
+        except KeyboardInterrupt:
+            logger.info("Stopping orchestrator, waiting for tasks in progress to finish...")
+        finally:
+            for stage in self.stages:
+                stage.stop()
+            for stage in self.stages:
+                stage.stop(wait=True)
+            self.report()
+
+
+if __name__ == "__main__":
+    PipelineOrchestrator().run_forever()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# render_metrics.py
+"""
+Đo thời gian từng stage của một lần render và báo cáo tổng hợp.
+
+- RenderTimer: đo theo stage (dịch path, probe metadata, chọn nền, ghi concat, encode...), kèm các giá trị
+  như fps, dung lượng output. Dùng chung được giữa nhiều luồng (render theo đoạn, chuẩn bị audio).
+- Kết quả được ghi vào task (render_stats.stages) và collection RENDER_METRICS_COLLECTION (mặc định render_metrics).
+- CLI tổng hợp p50/p95 theo stage trên N lần render gần nhất:
+      python render_metrics.py --last 200
+      python render_metrics.py --last 50 --host render-01 --failed
+"""
+
+import argparse
+import contextlib
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+RENDER_METRICS_COLLECTION = os.getenv("RENDER_METRICS_COLLECTION", "render_metrics")
+
+
+class RenderTimer:
+    """Thời gian (giây) theo stage của một lần render; stage lặp lại (vd: nhiều đoạn) được cộng dồn."""
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.values: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        stage_start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - stage_start)
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self.values[key] = value
+
+    def as_document(self) -> Dict[str, Any]:
+        with self._lock:
+            document = {
+                "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+                "total_seconds": round(time.perf_counter() - self.start_time, 3),
+            }
+            repeated = {name: count for name, count in self.counts.items() if count > 1}
+            if repeated:
+                document["stage_counts"] = repeated
+            document.update(self.values)
+        return document
+
+
+def timed_stage(timer: Optional[RenderTimer], name: str):
+    """Context manager đo stage nếu có timer, ngược lại không làm gì."""
+    return timer.stage(name) if timer is not None else contextlib.nullcontext()
+
+
+# --- Báo cáo ---
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Percentile nội suy tuyến tính (q: 0..100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(metrics: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Tổng hợp p50/p95/trung bình và tỉ trọng thời gian theo stage.
+
+    share = tổng thời gian stage / tổng thời gian wall (total_seconds) của các lần render có total_seconds.
+    Một số stage chạy đồng thời (vd: audio_mix / audio_decode song song với chọn nền), nên tổng share
+    có thể vượt 100% - mỗi share cho biết stage chiếm bao nhiêu phần thời gian wall, không cộng dồn được.
+    """
+    metrics = list(metrics)
+    per_stage: Dict[str, List[float]] = {}
+    stage_wall: Dict[str, float] = {}
+    totals, fps_values, sizes = [], [], []
+    for doc in metrics:
+        has_total = doc.get("total_seconds") is not None
+        for name, seconds in (doc.get("stages") or {}).items():
+            per_stage.setdefault(name, []).append(float(seconds))
+            if has_total:
+                stage_wall[name] = stage_wall.get(name, 0.0) + float(seconds)
+        if has_total: totals.append(float(doc["total_seconds"]))
+        if doc.get("fps") and not doc.get("cache_hit"): fps_values.append(float(doc["fps"]))
+        if doc.get("output_size_bytes"): sizes.append(float(doc["output_size_bytes"]))
+    wall_total = sum(totals) or 1.0
+    stages = {
+        name: {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "mean": sum(values) / len(values),
+            "share": stage_wall.get(name, 0.0) / wall_total,
+        }
+        for name, values in per_stage.items()
+    }
+    return {
+        "renders": len(metrics),
+        "stages": dict(sorted(stages.items(), key=lambda item: -item[1]["share"])),
+        "total": {"p50": percentile(totals, 50), "p95": percentile(totals, 95)},
+        "fps": {"p50": percentile(fps_values, 50), "p95": percentile(fps_values, 95)},
+        "output_size_mb": {"p50": (percentile(sizes, 50) or 0) / 1024 ** 2, "p95": (percentile(sizes, 95) or 0) / 1024 ** 2},
+    }
+
+
+def _fmt(value: Optional[float], suffix: str = "s") -> str:
+    return "-" if value is None else f"{value:.2f}{suffix}"
+
+
+def print_report(summary: Dict[str, Any]) -> None:
+    print(f"=== Render metrics: {summary['renders']} lần render gần nhất ===")
+    print(f"{'Stage':<24}{'N':>6}{'p50':>12}{'p95':>12}{'mean':>12}{'share':>9}")
+    for name, row in summary["stages"].items():
+        print(f"{name:<24}{row['count']:>6}{_fmt(row['p50']):>12}{_fmt(row['p95']):>12}{_fmt(row['mean']):>12}{row['share'] * 100:>8.1f}%")
+    print("-" * 75)
+    print("(share = % thời gian wall; các stage chạy song song có thể làm tổng vượt 100%)")
+    print(f"{'Tổng (wall)':<30}{_fmt(summary['total']['p50']):>12}{_fmt(summary['total']['p95']):>12}")
+    print(f"{'FPS (không tính cache hit)':<30}{_fmt(summary['fps']['p50'], ''):>12}{_fmt(summary['fps']['p95'], ''):>12}")
+    print(f"{'Dung lượng output':<30}{_fmt(summary['output_size_mb']['p50'], 'MB'):>12}{_fmt(summary['output_size_mb']['p95'], 'MB'):>12}")
+
+
+def main():
+    from pymongo import DESCENDING, MongoClient
+
+    parser = argparse.ArgumentParser(description="Aggregate per-stage render timings (p50/p95) from MongoDB.")
+    parser.add_argument("--last", type=int, default=100, help="Số lần render gần nhất cần tổng hợp.")
+    parser.add_argument("--host", default=None, help="Chỉ lấy render của máy này.")
+    parser.add_argument("--failed", action="store_true", help="Gồm cả các lần render thất bại.")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGO_URI"), serverSelectionTimeoutMS=5000)
+    try:
+        collection = client[os.getenv("MONGO_DB_NAME")][RENDER_METRICS_COLLECTION]
+        query: Dict[str, Any] = {} if args.failed else {"success": True}
+        if args.host:
+            query["host"] = args.host
+        metrics = collection.find(query).sort("finished_at", DESCENDING).limit(args.last)
+        print_report(summarize(metrics))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# task_dispatcher.py
+"""
+Đánh thức worker ngay khi task trong ContentGenerations chuyển trạng thái.
+
+- Ưu tiên MongoDB change stream (cần replica set / sharded cluster).
+- Nếu deployment là standalone (không hỗ trợ change stream) -> fallback sang polling nhẹ
+  (find_one chỉ lấy _id) mỗi DISPATCHER_POLL_INTERVAL_SECONDS.
+
+Mỗi stage có một threading.Event; worker gọi `dispatcher.wait(stage, timeout)` thay cho sleep.
+Timeout vẫn giữ vai trò "quét định kỳ" để không bỏ sót task nếu có sự kiện bị lỡ.
+"""
+
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import pymongo.errors
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+TASK_DISPATCHER_ENABLED = os.getenv("TASK_DISPATCHER_ENABLED", "true").lower() in ("true", "1", "yes", "y")
+DISPATCHER_POLL_INTERVAL_SECONDS = float(os.getenv("DISPATCHER_POLL_INTERVAL_SECONDS", 5))
+DISPATCHER_RECONNECT_WAIT_SECONDS = 5
+
+# --- Stages ---
+STAGE_CONTENT = "content"
+STAGE_AUDIO_VI = "audio_vi"
+STAGE_AUDIO_OTHER = "audio_other"
+STAGE_VIDEO = "video"
+
+# Chỉ các trạng thái "mới sẵn sàng" mới đánh thức worker. Task *_failed vẫn được worker retry
+# ở lần quét định kỳ (timeout của wait) -> tránh vòng lặp retry liên tục khi một task lỗi mãi.
+_CONTENT_READY_STATUSES = ("pending",)
+_AUDIO_READY_STATUSES = ("content_ready",)
+_VIDEO_NOT_READY_STATUSES = ("rendering", "finish", "skipped", "failed")
+
+# Điều kiện (trên document) để một stage có việc làm -> dùng cho sự kiện change stream
+STAGE_MATCHERS: Dict[str, Callable[[Dict[str, Any]], bool]] = {
+    STAGE_CONTENT: lambda doc: doc.get("status") in _CONTENT_READY_STATUSES,
+    STAGE_AUDIO_VI: lambda doc: doc.get("status") in _AUDIO_READY_STATUSES and doc.get("language") == "Vietnamese",
+    STAGE_AUDIO_OTHER: lambda doc: doc.get("status") in _AUDIO_READY_STATUSES and doc.get("language") != "Vietnamese",
+    STAGE_VIDEO: lambda doc: doc.get("thumbnail_status") == "generated" and doc.get("video_render_status") not in _VIDEO_NOT_READY_STATUSES,
+}
+
+# Query tương đương -> dùng cho chế độ polling
+STAGE_QUERIES: Dict[str, Dict[str, Any]] = {
+    STAGE_CONTENT: {"status": {"$in": list(_CONTENT_READY_STATUSES)}},
+    STAGE_AUDIO_VI: {"status": {"$in": list(_AUDIO_READY_STATUSES)}, "language": "Vietnamese"},
+    STAGE_AUDIO_OTHER: {"status": {"$in": list(_AUDIO_READY_STATUSES)}, "language": {"$ne": "Vietnamese"}},
+    STAGE_VIDEO: {"thumbnail_status": "generated", "video_render_status": {"$nin": list(_VIDEO_NOT_READY_STATUSES)}},
+}
+
+# Chỉ quan tâm các thay đổi có thể làm task chuyển stage
+_CHANGE_STREAM_PIPELINE = [
+    {"$match": {"$or": [
+        {"operationType": {"$in": ["insert", "replace"]}},
+        {"updateDescription.updatedFields.status": {"$exists": True}},
+        {"updateDescription.updatedFields.thumbnail_status": {"$exists": True}},
+        {"updateDescription.updatedFields.video_render_status": {"$exists": True}},
+    ]}}
+]
+
+
+class TaskDispatcher:
+    """Theo dõi một collection và đánh thức các stage đang chờ khi có task phù hợp."""
+
+    def __init__(self, collection, stages: Optional[Iterable[str]] = None,
+                 poll_interval_seconds: float = DISPATCHER_POLL_INTERVAL_SECONDS):
+        self._collection = collection
+        self._stages = list(stages) if stages else list(STAGE_MATCHERS)
+        self._events: Dict[str, threading.Event] = {stage: threading.Event() for stage in self._stages}
+        self._poll_interval_seconds = max(0.5, poll_interval_seconds)
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._resume_token = None
+        self.mode = "disabled" # "change_stream" | "polling" | "disabled"
+
+    # --- Vòng đời ---
+
+    def start(self) -> "TaskDispatcher":
+        if not TASK_DISPATCHER_ENABLED:
+            logger.info("Task dispatcher disabled (TASK_DISPATCHER_ENABLED=false). Workers fall back to timed waits.")
+            return self
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="task_dispatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        for event in self._events.values():
+            event.set() # Đánh thức worker đang chờ để chúng thoát
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    # --- API cho worker ---
+
+    def notify(self, stage: str) -> None:
+        """Đánh thức stage thủ công (vd: worker vừa giải phóng một slot)."""
+        event = self._events.get(stage)
+        if event is not None:
+            event.set()
+
+    def wait(self, stage: str, timeout: Optional[float] = None) -> bool:
+        """
+        Chờ đến khi stage có việc (hoặc hết timeout).
+
+        Returns:
+            True nếu được đánh thức bởi sự kiện, False nếu hết timeout.
+        """
+        event = self._events.get(stage)
+        if event is None:
+            raise ValueError(f"Dispatcher is not tracking stage '{stage}'.")
+        triggered = event.wait(timeout)
+        event.clear() # Xóa trước khi worker quét DB -> sự kiện tới trong lúc quét không bị mất
+        return triggered
+
+    # --- Nội bộ ---
+
+    def _dispatch(self, doc: Dict[str, Any]) -> None:
+        for stage in self._stages:
+            if STAGE_MATCHERS[stage](doc):
+                logger.debug(f"[Dispatcher] Task {doc.get('_id')} ready for stage '{stage}'.")
+                self._events[stage].set()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self._watch_change_stream()
+            except pymongo.errors.OperationFailure as e:
+                if self._resume_token is not None:
+                    # Resume token hết hạn (oplog đã xoay vòng) -> mở stream mới thay vì bỏ change stream
+                    logger.warning(f"[Dispatcher] Cannot resume change stream ({e.code}). Restarting without resume token.")
+                    self._resume_token = None
+                    continue
+                # Standalone server không hỗ trợ change stream -> chuyển hẳn sang polling
+                logger.warning(f"[Dispatcher] Change streams unavailable ({e.code}: {str(e)[:120]}). Falling back to polling every {self._poll_interval_seconds}s.")
+                self._poll_loop()
+                return
+            except pymongo.errors.PyMongoError as e:
+                logger.error(f"[Dispatcher] Change stream error: {e}. Reconnecting in {DISPATCHER_RECONNECT_WAIT_SECONDS}s...")
+                self._stop_event.wait(DISPATCHER_RECONNECT_WAIT_SECONDS)
+            except Exception:
+                logger.exception("[Dispatcher] Unexpected error in change stream loop.")
+                self._stop_event.wait(DISPATCHER_RECONNECT_WAIT_SECONDS)
+
+    def _watch_change_stream(self) -> None:
+        with self._collection.watch(_CHANGE_STREAM_PIPELINE, full_document="updateLookup",
+                                    resume_after=self._resume_token, max_await_time_ms=1000) as stream:
+            if self.mode != "change_stream":
+                logger.info(f"[Dispatcher] Watching change stream on '{self._collection.name}' for stages {self._stages}.")
+            self.mode = "change_stream"
+            # Sau khi (re)connect, đánh thức mọi stage một lần để quét các task đến trong lúc mất kết nối
+            for event in self._events.values():
+                event.set()
+            while not self._stop_event.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    continue
+                self._resume_token = stream.resume_token
+                full_doc = change.get("fullDocument")
+                if full_doc:
+                    self._dispatch(full_doc)
+
+    def _poll_loop(self) -> None:
+        self.mode = "polling"
+        while not self._stop_event.is_set():
+            for stage in self._stages:
+                try:
+                    if self._collection.find_one(STAGE_QUERIES[stage], {"_id": 1}) is not None:
+                        self._events[stage].set()
+                except pymongo.errors.PyMongoError as e:
+                    logger.error(f"[Dispatcher] Polling error for stage '{stage}': {e}")
+            self._stop_event.wait(self._poll_interval_seconds)
+
+
+def start_dispatcher(collection, stages: Optional[Iterable[str]] = None) -> TaskDispatcher:
+    """Tạo và khởi động dispatcher cho các stage của worker hiện tại."""
+    return TaskDispatcher(collection, stages=stages).start()
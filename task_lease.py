@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# task_lease.py
+"""
+Khóa task bằng lease (có hạn) + heartbeat, dùng chung cho mọi worker.
+
+Khi claim một task, worker ghi vào document:
+    lease_owner       : id của worker (host:pid:uuid)
+    lease_expires_at  : thời điểm lease hết hạn
+    lease_stage       : stage đang giữ lease (content / audio / video)
+
+Luồng heartbeat gia hạn lease mỗi LEASE_TTL_SECONDS / 3 khi công việc còn chạy. Nếu worker
+chết, lease hết hạn sau tối đa LEASE_TTL_SECONDS và worker khác "cướp" (steal) task bằng
+đúng một find_one_and_update nguyên tử -> không có task nào bị hai worker cùng xử lý.
+
+Task bị khóa theo kiểu cũ (không có lease_expires_at) vẫn được thu hồi sau LEASE_LEGACY_TIMEOUT_SECONDS.
+"""
+
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pymongo.errors
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", 120))
+LEASE_HEARTBEAT_SECONDS = float(os.getenv("LEASE_HEARTBEAT_SECONDS", LEASE_TTL_SECONDS / 3))
+LEASE_LEGACY_TIMEOUT_SECONDS = float(os.getenv("LEASE_LEGACY_TIMEOUT_SECONDS", 3600))
+
+# Id duy nhất của tiến trình worker hiện tại
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+LEASE_FIELDS = ("lease_owner", "lease_expires_at", "lease_stage")
+
+# Các trạng thái "đang xử lý" theo stage -> được cướp lại khi lease hết hạn
+CONTENT_LOCKED_STATUSES = ["processing_lock", "generating_outline", "content_generating"]
+AUDIO_LOCKED_STATUSES = ["audio_processing_lock", "audio_generating"]
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def stealable_query(locked_query: Dict[str, Any], legacy_time_field: str = "updated_at") -> Dict[str, Any]:
+    """
+    Query cho các task đang ở trạng thái khóa nhưng lease đã hết hạn
+    (hoặc bị khóa kiểu cũ, không có lease, quá LEASE_LEGACY_TIMEOUT_SECONDS).
+    """
+    now = _now()
+    legacy_before = now - datetime.timedelta(seconds=LEASE_LEGACY_TIMEOUT_SECONDS)
+    return {"$and": [locked_query, {"$or": [
+        {"lease_expires_at": {"$lt": now}},
+        {"lease_expires_at": None, legacy_time_field: {"$lt": legacy_before}},
+    ]}]}
+
+
+class TaskLease:
+    """Lease của một task. Dùng làm context manager: heartbeat khi vào, release khi ra."""
+
+    def __init__(self, collection, doc_id: Any, stage: str, owner: str = WORKER_ID,
+                 ttl_seconds: float = LEASE_TTL_SECONDS, heartbeat_seconds: float = LEASE_HEARTBEAT_SECONDS):
+        self.collection = collection
+        self.doc_id = doc_id
+        self.stage = stage
+        self.owner = owner
+        self.ttl_seconds = ttl_seconds
+        self.heartbeat_seconds = max(1.0, min(heartbeat_seconds, ttl_seconds / 2))
+        self.lost = False
+        self._last_renewed = time.monotonic() # Lease vừa được ghi lúc claim
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "TaskLease":
+        return self.start_heartbeat()
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+    def _owner_filter(self) -> Dict[str, Any]:
+        return {"_id": self.doc_id, "lease_owner": self.owner}
+
+    def owned_filter(self, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Filter cho các lần ghi của handler: chỉ khớp khi worker này vẫn còn giữ lease."""
+        query = self._owner_filter()
+        if extra:
+            query.update(extra)
+        return query
+
+    def renew(self) -> bool:
+        """
+        Gia hạn lease. Trả về False (và đánh dấu lost) nếu lease đã bị worker khác lấy, hoặc nếu
+        không gia hạn được quá ttl_seconds (lease đã hết hạn trong DB, worker khác có thể đã cướp).
+        """
+        now = time.monotonic()
+        try:
+            result = self.collection.update_one(
+                self._owner_filter(),
+                {"$set": {"lease_expires_at": _now() + datetime.timedelta(seconds=self.ttl_seconds)}}
+            )
+        except pymongo.errors.PyMongoError as e:
+            if now - self._last_renewed >= self.ttl_seconds:
+                self.lost = True
+                logger.error(f"[Lease:{self.stage}] Lease for {self.doc_id} expired: no successful heartbeat "
+                             f"for {now - self._last_renewed:.0f}s ({e}).")
+                return False
+            # Lỗi tạm thời: thử lại ở nhịp sau (lease còn hạn tới ttl)
+            logger.warning(f"[Lease:{self.stage}] Heartbeat failed for {self.doc_id}: {e}")
+            return True
+        if result.matched_count == 0:
+            self.lost = True
+            logger.error(f"[Lease:{self.stage}] Lease for {self.doc_id} was lost (expired and taken over).")
+            return False
+        self._last_renewed = now
+        return True
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stop_event.wait(self.heartbeat_seconds):
+            if not self.renew():
+                return
+
+    def start_heartbeat(self) -> "TaskLease":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._heartbeat_loop, name=f"lease_{self.stage}_{self.doc_id}", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop_heartbeat(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+
+    def release(self, extra_set: Optional[Dict[str, Any]] = None) -> bool:
+        """Dừng heartbeat và xóa lease (chỉ khi còn là chủ). extra_set được ghi cùng lúc."""
+        self.stop_heartbeat()
+        update: Dict[str, Any] = {"$unset": {field: "" for field in LEASE_FIELDS}}
+        if extra_set:
+            update["$set"] = extra_set
+        try:
+            result = self.collection.update_one(self._owner_filter(), update)
+            if result.matched_count == 0:
+                logger.warning(f"[Lease:{self.stage}] Release skipped for {self.doc_id}: lease no longer owned by {self.owner}.")
+                return False
+            return True
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"[Lease:{self.stage}] Failed to release lease for {self.doc_id}: {e}")
+            return False
+
+
+def lease_filter(doc_id: Any, lease: Optional[TaskLease] = None,
+                 extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Filter ghi status của một task: thêm lease_owner khi handler chạy dưới lease."""
+    if lease is not None:
+        return lease.owned_filter(dict({"_id": doc_id}, **(extra or {})))
+    return dict({"_id": doc_id}, **(extra or {}))
+
+
+def lease_lost(lease: Optional[TaskLease]) -> bool:
+    """True nếu handler đang chạy dưới lease đã mất -> phải dừng, không ghi gì thêm."""
+    return lease is not None and lease.lost
+
+
+def claim_with_lease(collection, ready_query: Dict[str, Any], locked_query: Dict[str, Any],
+                     lock_set: Dict[str, Any], stage: str, sort: Optional[List[Tuple[str, int]]] = None,
+                     legacy_time_field: str = "updated_at", owner: str = WORKER_ID,
+                     ttl_seconds: float = LEASE_TTL_SECONDS) -> Optional[Tuple[Dict[str, Any], TaskLease]]:
+    """
+    Claim nguyên tử một task: task sẵn sàng (ready_query) HOẶC task đang khóa có lease hết hạn.
+
+    Args:
+        collection: Collection chứa task.
+        ready_query: Điều kiện task sẵn sàng xử lý.
+        locked_query: Điều kiện task đang bị khóa/xử lý ở stage này (để cướp khi lease hết hạn).
+        lock_set: Các trường $set khi khóa (vd: {"status": "audio_processing_lock"}).
+        stage: Tên stage (ghi vào lease_stage, dùng cho log).
+        sort: Thứ tự ưu tiên như find_one_and_update.
+        legacy_time_field: Trường thời gian dùng cho task khóa kiểu cũ (không có lease).
+
+    Returns:
+        (document sau khi khóa, TaskLease chưa bật heartbeat) hoặc None nếu không có task.
+    """
+    now = _now()
+    update_set = dict(lock_set)
+    update_set.update({
+        "lease_owner": owner,
+        "lease_expires_at": now + datetime.timedelta(seconds=ttl_seconds),
+        "lease_stage": stage,
+    })
+    doc = collection.find_one_and_update(
+        {"$or": [ready_query, stealable_query(locked_query, legacy_time_field)]},
+        {"$set": update_set},
+        sort=sort,
+        return_document=ReturnDocument.BEFORE
+    )
+    if doc is None:
+        return None
+    if doc.get("lease_owner") and doc.get("lease_owner") != owner:
+        logger.warning(f"[Lease:{stage}] Took over task {doc['_id']} from expired lease of {doc.get('lease_owner')}.")
+    doc.update(update_set)
+    return doc, TaskLease(collection, doc["_id"], stage, owner=owner, ttl_seconds=ttl_seconds)
+
+
+def run_with_lease(lease: TaskLease, func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Chạy func trong khi giữ lease (heartbeat), luôn release khi xong."""
+    with lease:
+        return func(*args, **kwargs)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+# tts_async.py
+"""
+Engine TTS bất đồng bộ (asyncio) cho các worker audio.
+
+Thay vì một ThreadPoolExecutor các lời gọi blocking, một event loop giữ hàng trăm request
+sub-chunk cùng lúc (giới hạn bởi TTS_ASYNC_MAX_IN_FLIGHT và limiter của từng provider).
+Kết quả trả về theo đúng thứ tự chunk đầu vào; cập nhật DB của các chunk được gom lại
+và ghi bằng bulk_write.
+
+Worker bật engine này bằng biến môi trường AUDIO_TTS_ENGINE=async.
+"""
+
+import asyncio
+import importlib.util
+import logging
+import os
+import shutil
+import tempfile
+import urllib.parse
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, cast
+
+import openai
+import pymongo
+import pymongo.errors
+from openai import AsyncOpenAI
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+try:
+    import httpx
+except ImportError:
+    logging.warning("httpx is not installed (pip install httpx). Async Pollinations TTS unavailable.")
+    httpx = None
+
+from tts_rate_limiter import OUTCOME_ERROR, OUTCOME_THROTTLED, parse_retry_after
+from tts_utils import (
+    API_TIMEOUT_SECONDS,
+    LOCAL_AUDIO_BASE_PATH,
+    MIN_AUDIO_FILE_SIZE_BYTES,
+    POLLINATIONS_API_URL_BASE,
+    POLLINATIONS_RETRY_ATTEMPTS,
+    POLLINATIONS_RETRY_WAIT_SECONDS,
+    POLLINATIONS_URL_CHAR_LIMIT,
+    TTS_API_CHAR_LIMIT,
+    ConfigurationError,
+    OpenAIVoice,
+    PollinationsError,
+    TTSProviderError,
+    _build_chunk_audio_path,
+    _classify_tts_exception,
+    _normalize_tts_text,
+    _split_text_for_tts,
+    _tts_cache_fetch,
+    _tts_cache_key,
+    _tts_cache_store,
+    concatenate_audio,
+    get_provider_rate_limiter,
+    get_script_chunks_collection,
+    tts_api_key_other,
+    tts_base_url_other,
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+AUDIO_TTS_ENGINE = os.getenv("AUDIO_TTS_ENGINE", "threads").lower() # "threads" | "async"
+TTS_ASYNC_MAX_IN_FLIGHT = int(os.getenv("TTS_ASYNC_MAX_IN_FLIGHT", 256)) # Tổng số request sub-chunk đang chạy
+TTS_ASYNC_DB_BATCH_SIZE = int(os.getenv("TTS_ASYNC_DB_BATCH_SIZE", 50)) # Số update chunk mỗi lần bulk_write
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None # httpx chỉ bật HTTP/2 khi có gói h2
+
+RETRYABLE_EXCEPTIONS_ASYNC: Tuple[type, ...] = (
+    PollinationsError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+) + ((httpx.TransportError, httpx.HTTPStatusError) if httpx is not None else ())
+
+
+def _classify_async_exception(exc: BaseException) -> Tuple[str, Optional[float]]:
+    """Như _classify_tts_exception, thêm các lỗi của httpx."""
+    if httpx is not None:
+        if isinstance(exc, httpx.HTTPStatusError):
+            status_code = exc.response.status_code
+            if status_code == 429 or status_code >= 500:
+                return OUTCOME_THROTTLED, parse_retry_after(exc.response.headers.get("Retry-After"))
+            return OUTCOME_ERROR, None
+        if isinstance(exc, httpx.TimeoutException):
+            return OUTCOME_THROTTLED, None
+    return _classify_tts_exception(exc)
+
+
+class _ChunkUpdateBatcher:
+    """Gom các update trạng thái chunk và ghi bằng một bulk_write (chạy trong thread riêng)."""
+
+    def __init__(self, collection, batch_size: int):
+        self._collection = collection
+        self._batch_size = max(1, batch_size)
+        self._pending: List[pymongo.UpdateOne] = []
+
+    async def add(self, chunk_id: Any, update_data: Dict[str, Any]) -> None:
+        self._pending.append(pymongo.UpdateOne({"_id": chunk_id}, {"$set": update_data}))
+        if len(self._pending) >= self._batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        operations, self._pending = self._pending, []
+        if not operations or self._collection is None:
+            return
+        try:
+            result = await asyncio.to_thread(self._collection.bulk_write, operations, ordered=False)
+            logger.debug(f"[AsyncTTS] Bulk-updated {result.modified_count}/{len(operations)} chunk docs.")
+        except pymongo.errors.PyMongoError as db_err:
+            logger.error(f"[AsyncTTS] Failed to bulk-update {len(operations)} chunk docs: {db_err}", exc_info=True)
+
+
+class AsyncTTSEngine:
+    """Giữ client HTTP/OpenAI bất đồng bộ và semaphore tổng cho một lần chạy synthesize_chunks."""
+
+    def __init__(self, max_in_flight: int = TTS_ASYNC_MAX_IN_FLIGHT):
+        self._semaphore = asyncio.Semaphore(max(1, max_in_flight))
+        self._max_in_flight = max(1, max_in_flight)
+        self._http_client = None
+        self._openai_client: Optional[AsyncOpenAI] = None
+
+    async def __aenter__(self) -> "AsyncTTSEngine":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._http_client is not None:
+            await self._http_client.aclose()
+        if self._openai_client is not None:
+            await self._openai_client.close()
+
+    def _get_http_client(self):
+        if httpx is None:
+            raise ConfigurationError("httpx is not installed (pip install httpx).")
+        if self._http_client is None:
+            self._http_client = httpx.AsyncClient(
+                timeout=API_TIMEOUT_SECONDS,
+                limits=httpx.Limits(max_connections=self._max_in_flight, max_keepalive_connections=min(self._max_in_flight, 64)),
+                http2=HTTP2_AVAILABLE,
+            )
+        return self._http_client
+
+    def _get_openai_client(self) -> AsyncOpenAI:
+        if not tts_api_key_other:
+            raise ConfigurationError("OpenAI/Local TTS client is not initialized (check TTS_API_KEY).")
+        if self._openai_client is None:
+            self._openai_client = AsyncOpenAI(api_key=tts_api_key_other, base_url=tts_base_url_other)
+        return self._openai_client
+
+    # --- Provider callers ---
+
+    async def _call_pollinations(self, text: str, voice_name: str, output_filename: Path) -> None:
+        processed_text = _normalize_tts_text(text, "pollinations")
+        api_url = f"{POLLINATIONS_API_URL_BASE}{urllib.parse.quote(processed_text)}"
+        params = {"model": "openai-audio", "voice": voice_name}
+        if len(api_url) > POLLINATIONS_URL_CHAR_LIMIT:
+            logger.warning(f"[AsyncTTS:Pollinations] Request URL ({len(api_url)} chars) might exceed limit ({POLLINATIONS_URL_CHAR_LIMIT}).")
+
+        client = self._get_http_client()
+        async with get_provider_rate_limiter("pollinations").async_slot(_classify_async_exception):
+            async with client.stream("GET", api_url, params=params) as response:
+                response.raise_for_status()
+                content_type = response.headers.get("Content-Type", "")
+                if "audio/mpeg" not in content_type:
+                    error_details = (await response.aread())[:500].decode("utf-8", errors="replace")
+                    raise PollinationsError(f"Expected 'audio/mpeg', got '{content_type}'. Response: {error_details}")
+                audio_bytes = await response.aread()
+
+        if len(audio_bytes) <= MIN_AUDIO_FILE_SIZE_BYTES:
+            raise PollinationsError(f"Saved audio file empty or too small ({len(audio_bytes)} bytes).")
+        await asyncio.to_thread(output_filename.write_bytes, audio_bytes)
+
+    async def _call_openai(self, text: str, voice_name: str, speed: float, output_filename: Path) -> None:
+        client = self._get_openai_client()
+        async with get_provider_rate_limiter("openai").async_slot(_classify_async_exception):
+            async with client.audio.speech.with_streaming_response.create(
+                model='tts-1',
+                voice=cast(OpenAIVoice, voice_name),
+                input=text,
+                speed=speed,
+                response_format='mp3'
+            ) as response:
+                await response.stream_to_file(str(output_filename))
+
+        file_size = output_filename.stat().st_size if output_filename.exists() else 0
+        if file_size <= MIN_AUDIO_FILE_SIZE_BYTES:
+            output_filename.unlink(missing_ok=True)
+            raise TTSProviderError(f"Saved audio file empty or too small ({file_size} bytes).")
+
+    # --- Synthesis ---
+
+    async def _synthesize_text(self, provider: str, text: str, voice_name: str, speed: float, output_filename: Path) -> None:
+        """Tạo audio cho một đoạn text <= TTS_API_CHAR_LIMIT (dùng TTS cache, có retry)."""
+        cache_key = _tts_cache_key(provider, voice_name, speed, text)
+        # Cache: link/copy + utime (và có thể quét/dọn thư mục dưới lock) -> chạy ngoài event loop
+        if await asyncio.to_thread(_tts_cache_fetch, cache_key, output_filename):
+            return
+
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(POLLINATIONS_RETRY_ATTEMPTS),
+            wait=wait_random_exponential(multiplier=1, max=POLLINATIONS_RETRY_WAIT_SECONDS * 4),
+            retry=retry_if_exception_type(RETRYABLE_EXCEPTIONS_ASYNC),
+            reraise=True,
+        ):
+            with attempt:
+                async with self._semaphore:
+                    if provider == "pollinations":
+                        await self._call_pollinations(text, voice_name, output_filename)
+                    elif provider in ["openai", "local_tts"]:
+                        await self._call_openai(text, voice_name, speed, output_filename)
+                    else:
+                        raise ConfigurationError(f"Unsupported TTS provider specified: '{provider}'")
+
+        await asyncio.to_thread(_tts_cache_store, cache_key, output_filename)
+
+    async def synthesize_chunk(self, chunk_doc: Dict[str, Any], script_name: str,
+                               voice_settings: Dict[str, Any]) -> Tuple[str, bool, Optional[str], Optional[str]]:
+        """
+        Tạo audio cho một chunk (chia nhỏ + ghép nếu dài). Không cập nhật DB.
+
+        Returns:
+            (chunk_id_str, success, local_audio_path hoặc None, error_message hoặc None)
+        """
+        chunk_id_str = str(chunk_doc["_id"])
+        text_content = (chunk_doc.get("text_content") or "").strip()
+        section_index = chunk_doc.get("section_index", "unknown")
+        if not text_content:
+            logger.warning(f"Chunk {chunk_id_str} (Index: {section_index}) has no text content. Skipping TTS.")
+            return chunk_id_str, False, None, "No text content"
+
+        provider = voice_settings.get("provider", "openai").lower()
+        voice_name = voice_settings.get("voice_name")
+        speed = float(voice_settings.get("speaking_rate", 1.0))
+        if not voice_name:
+            return chunk_id_str, False, None, f"Missing 'voice_name' in voice settings for chunk {chunk_id_str}."
+
+        script_folder_path = LOCAL_AUDIO_BASE_PATH / script_name
+        script_folder_path.mkdir(parents=True, exist_ok=True)
+        audio_file_path_local = _build_chunk_audio_path(script_folder_path, script_name, section_index, voice_settings)
+        temp_dir_obj: Optional[Path] = None
+
+        try:
+            if len(text_content) <= TTS_API_CHAR_LIMIT:
+                await self._synthesize_text(provider, text_content, voice_name, speed, audio_file_path_local)
+            else:
+                chunk_cache_key = _tts_cache_key(provider, voice_name, speed, text_content)
+                if not await asyncio.to_thread(_tts_cache_fetch, chunk_cache_key, audio_file_path_local):
+                    sub_texts = await asyncio.to_thread(_split_text_for_tts, text_content, voice_settings)
+                    if not sub_texts:
+                        raise ValueError(f"Failed to split long text content for chunk {chunk_id_str}.")
+
+                    temp_dir_obj = Path(tempfile.mkdtemp(prefix=f"tts_async_{chunk_doc.get('generation_id')}_chunk{section_index}_"))
+                    sub_files = [temp_dir_obj / f"sub_{section_index}_{sub_idx}.mp3" for sub_idx in range(len(sub_texts))]
+                    sub_tasks = [asyncio.create_task(self._synthesize_text(provider, sub_text, voice_name, speed, sub_file))
+                                 for sub_text, sub_file in zip(sub_texts, sub_files)]
+                    try:
+                        await asyncio.gather(*sub_tasks)
+                    except BaseException:
+                        # Một sub-chunk lỗi -> hủy phần còn lại (sub-chunk đã xong vẫn nằm trong TTS cache)
+                        for sub_task in sub_tasks:
+                            sub_task.cancel()
+                        await asyncio.gather(*sub_tasks, return_exceptions=True)
+                        raise
+
+                    if not await asyncio.to_thread(concatenate_audio, sub_files, audio_file_path_local):
+                        raise TTSProviderError("Audio concatenation function reported failure.")
+                    await asyncio.to_thread(_tts_cache_store, chunk_cache_key, audio_file_path_local)
+
+            logger.info(f"Successfully generated audio for chunk {chunk_id_str} at {audio_file_path_local}")
+            return chunk_id_str, True, str(audio_file_path_local), None
+
+        except Exception as e:
+            error_message = f"Async TTS failed ({type(e).__name__}): {str(e)[:200]}"
+            logger.error(f"Failed to generate audio for chunk {chunk_id_str} (Idx:{section_index}): {error_message}")
+            if audio_file_path_local.exists():
+                try:
+                    audio_file_path_local.unlink()
+                except OSError as e_del:
+                    logger.warning(f"Could not remove failed output file {audio_file_path_local}: {e_del}")
+            return chunk_id_str, False, None, error_message
+
+        finally:
+            if temp_dir_obj and temp_dir_obj.is_dir():
+                shutil.rmtree(temp_dir_obj, ignore_errors=True)
+
+
+async def synthesize_chunks(chunks: List[Dict[str, Any]], voice_settings: Dict[str, Any], script_name: str,
+                            max_in_flight: Optional[int] = None,
+                            should_stop: Optional[Callable[[], bool]] = None) -> List[Tuple[str, bool, Optional[str]]]:
+    """
+    Tạo audio cho nhiều chunk cùng lúc trên một event loop.
+
+    Args:
+        chunks: Các document ScriptChunks (cần _id, text_content, section_index, generation_id).
+        voice_settings: Dict provider/voice_name/speaking_rate (như create_audio_for_chunk).
+        script_name: Tên kịch bản (thư mục lưu audio).
+        max_in_flight: Số request sub-chunk tối đa đang chạy (mặc định TTS_ASYNC_MAX_IN_FLIGHT).
+        should_stop: Kiểm tra trước mỗi chunk (vd: lease đã mất); True -> bỏ qua chunk, không ghi DB.
+
+    Returns:
+        List (chunk_id_str, success, local_audio_path hoặc None) theo đúng thứ tự `chunks`.
+    """
+    batcher = _ChunkUpdateBatcher(get_script_chunks_collection(), TTS_ASYNC_DB_BATCH_SIZE)
+
+    async with AsyncTTSEngine(max_in_flight or TTS_ASYNC_MAX_IN_FLIGHT) as engine:
+        async def _run_chunk(chunk_doc: Dict[str, Any]) -> Tuple[str, bool, Optional[str]]:
+            if should_stop is not None and should_stop():
+                return str(chunk_doc["_id"]), False, None
+            chunk_id_str, success, audio_path, error_message = await engine.synthesize_chunk(chunk_doc, script_name, voice_settings)
+            if success:
+                update_data = {"audio_file_path": audio_path, "audio_created": True, "audio_error": None}
+            else:
+                update_data = {"audio_created": False, "audio_error": str(error_message or "Unknown error during audio generation.")[:500]}
+            await batcher.add(chunk_doc["_id"], update_data)
+            return chunk_id_str, success, audio_path
+
+        try:
+            results = await asyncio.gather(*(_run_chunk(chunk_doc) for chunk_doc in chunks))
+        finally:
+            await batcher.flush() # Ghi nốt các update còn lại (kể cả khi bị hủy giữa chừng)
+
+    return list(results)
+
+
+def run_synthesize_chunks(chunks: List[Dict[str, Any]], voice_settings: Dict[str, Any],
+                          script_name: str, should_stop: Optional[Callable[[], bool]] = None
+                          ) -> List[Tuple[str, bool, Optional[str]]]:
+    """Wrapper đồng bộ cho các worker: chạy synthesize_chunks trên một event loop mới."""
+    return asyncio.run(synthesize_chunks(chunks, voice_settings, script_name, should_stop=should_stop))
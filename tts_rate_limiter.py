@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+# tts_rate_limiter.py
+"""
+Bộ giới hạn request dùng chung cho các provider TTS.
+
+Mỗi provider có một AdaptiveRateLimiter gồm:
+- Token bucket: giới hạn số request/giây (cho phép burst ngắn).
+- Giới hạn đồng thời AIMD: tăng dần (+increase_step) sau mỗi `success_window` lần
+  thành công liên tiếp, giảm theo cấp số nhân (x decrease_factor) khi gặp 429/5xx.
+- Cooldown: khi provider trả Retry-After (hoặc bị throttle), mọi caller chờ hết
+  thời gian này trước khi gửi request tiếp theo.
+
+Cấu hình theo provider nằm trong voice_config.json, khóa "__RATE_LIMITS__".
+"""
+
+import asyncio
+import datetime
+import email.utils
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Kết quả của một request, dùng để điều chỉnh limiter
+OUTCOME_SUCCESS = "success"
+OUTCOME_THROTTLED = "throttled" # 429 / 5xx / timeout -> provider quá tải
+OUTCOME_ERROR = "error"         # Lỗi khác (không phải do quá tải)
+
+# Classifier: exception -> (outcome, retry_after_seconds)
+ExceptionClassifier = Callable[[BaseException], Tuple[str, Optional[float]]]
+
+DEFAULT_LIMITS: Dict[str, Any] = {
+    "requests_per_second": 2.0,
+    "burst": 4,
+    "min_concurrency": 1,
+    "initial_concurrency": 2,
+    "max_concurrency": 4,
+    "increase_step": 1,
+    "success_window": 5,
+    "decrease_factor": 0.5,
+    "default_cooldown_seconds": 5.0,
+}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Đọc header Retry-After (số giây hoặc HTTP-date) -> số giây cần chờ."""
+    if not value:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+        return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _resolve_waiter(waiter: "asyncio.Future[None]") -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AdaptiveRateLimiter:
+    """Token bucket + giới hạn đồng thời AIMD cho một provider. Thread-safe."""
+
+    def __init__(self, name: str, requests_per_second: float, burst: int, min_concurrency: int,
+                 initial_concurrency: int, max_concurrency: int, increase_step: int,
+                 success_window: int, decrease_factor: float, default_cooldown_seconds: float):
+        self.name = name
+        self.requests_per_second = float(requests_per_second)
+        self.burst = max(1, int(burst))
+        self.min_concurrency = max(1, int(min_concurrency))
+        self.max_concurrency = max(self.min_concurrency, int(max_concurrency))
+        self.increase_step = max(1, int(increase_step))
+        self.success_window = max(1, int(success_window))
+        self.decrease_factor = min(max(float(decrease_factor), 0.1), 1.0)
+        self.default_cooldown_seconds = max(0.0, float(default_cooldown_seconds))
+
+        self._cond = threading.Condition()
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._concurrency_limit = float(min(max(int(initial_concurrency), self.min_concurrency), self.max_concurrency))
+        self._in_flight = 0
+        self._waiting = 0
+        self._async_waiters: Set[Tuple[asyncio.AbstractEventLoop, "asyncio.Future[None]"]] = set()
+        self._cooldown_until = 0.0
+        self._consecutive_successes = 0
+        self._success_count = 0
+        self._throttled_count = 0
+        self._error_count = 0
+
+    # --- Nội bộ (gọi khi đang giữ self._cond) ---
+
+    def _refill_locked(self, now: float) -> None:
+        if self.requests_per_second <= 0:
+            self._tokens = float(self.burst) # <= 0: không giới hạn tốc độ
+        else:
+            elapsed = now - self._last_refill
+            self._tokens = min(float(self.burst), self._tokens + elapsed * self.requests_per_second)
+        self._last_refill = now
+
+    def _try_acquire_locked(self) -> Optional[float]:
+        """
+        Thử lấy một slot.
+
+        Returns:
+            0.0 nếu lấy được; số giây cần chờ nếu bị giới hạn bởi cooldown/token;
+            None nếu đã đủ số request đồng thời (chờ có slot được trả).
+        """
+        now = time.monotonic()
+        if now < self._cooldown_until:
+            return self._cooldown_until - now
+        if self._in_flight >= int(self._concurrency_limit):
+            return None
+        self._refill_locked(now)
+        if self._tokens < 1.0:
+            return (1.0 - self._tokens) / self.requests_per_second
+        self._tokens -= 1.0
+        self._in_flight += 1
+        return 0.0
+
+    def _wake_async_waiters_locked(self) -> None:
+        """Đánh thức các coroutine đang chờ slot (mỗi coroutine có thể ở một event loop/luồng khác)."""
+        waiters, self._async_waiters = self._async_waiters, set()
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve_waiter, waiter)
+            except RuntimeError:
+                pass # Event loop đã đóng
+
+    # --- API đồng bộ ---
+
+    def acquire(self, timeout: Optional[float] = None) -> None:
+        """Chờ đến khi được phép gửi request. Raise TimeoutError nếu quá timeout."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    wait_seconds = self._try_acquire_locked()
+                    if wait_seconds == 0.0:
+                        return
+                    wait_for = 1.0 if wait_seconds is None else min(wait_seconds, 1.0)
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError(f"Timed out waiting for '{self.name}' rate limiter.")
+                        wait_for = min(wait_for, remaining)
+                    self._cond.wait(wait_for)
+            finally:
+                self._waiting -= 1
+
+    def release(self, outcome: str = OUTCOME_SUCCESS, retry_after: Optional[float] = None) -> None:
+        """Trả slot và điều chỉnh giới hạn theo kết quả request."""
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            if outcome == OUTCOME_SUCCESS:
+                self._success_count += 1
+                self._consecutive_successes += 1
+                if self._consecutive_successes >= self.success_window:
+                    self._consecutive_successes = 0
+                    new_limit = min(float(self.max_concurrency), self._concurrency_limit + self.increase_step)
+                    if int(new_limit) != int(self._concurrency_limit):
+                        logger.info(f"[RateLimit:{self.name}] Concurrency {int(self._concurrency_limit)} -> {int(new_limit)}")
+                    self._concurrency_limit = new_limit
+            elif outcome == OUTCOME_THROTTLED:
+                self._throttled_count += 1
+                self._consecutive_successes = 0
+                self._concurrency_limit = max(float(self.min_concurrency), self._concurrency_limit * self.decrease_factor)
+                cooldown = retry_after if retry_after is not None else self.default_cooldown_seconds
+                self._cooldown_until = max(self._cooldown_until, time.monotonic() + cooldown)
+                self._tokens = 0.0
+                logger.warning(f"[RateLimit:{self.name}] Throttled. Concurrency -> {int(self._concurrency_limit)}, cooling down {cooldown:.1f}s")
+            else:
+                self._error_count += 1
+                self._consecutive_successes = 0
+            self._cond.notify_all()
+            self._wake_async_waiters_locked()
+
+    @contextmanager
+    def slot(self, classify: Optional[ExceptionClassifier] = None):
+        """
+        Context manager: acquire khi vào, release khi ra.
+        Exception đi qua được phân loại bằng `classify` để quyết định back off.
+        """
+        self.acquire()
+        outcome, retry_after = OUTCOME_SUCCESS, None
+        try:
+            yield self
+        except BaseException as exc:
+            outcome, retry_after = classify(exc) if classify else (OUTCOME_ERROR, None)
+            raise
+        finally:
+            self.release(outcome, retry_after)
+
+    # --- API bất đồng bộ (dùng chung trạng thái với API đồng bộ) ---
+
+    async def acquire_async(self) -> None:
+        """
+        Phiên bản asyncio của acquire(): không block event loop.
+        Bị giới hạn bởi token/cooldown -> ngủ đúng đến lúc có token; đủ số request đồng thời -> chờ
+        release() đánh thức (timeout 1s phòng trường hợp lỡ tín hiệu), không poll liên tục.
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            self._waiting += 1
+        try:
+            while True:
+                waiter = None
+                with self._cond:
+                    wait_seconds = self._try_acquire_locked()
+                    if wait_seconds is None:
+                        waiter = loop.create_future()
+                        self._async_waiters.add((loop, waiter))
+                if wait_seconds == 0.0:
+                    return
+                if waiter is None:
+                    await asyncio.sleep(wait_seconds)
+                    continue
+                try:
+                    await asyncio.wait_for(waiter, timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self._cond:
+                        self._async_waiters.discard((loop, waiter))
+        finally:
+            with self._cond:
+                self._waiting -= 1
+
+    @asynccontextmanager
+    async def async_slot(self, classify: Optional[ExceptionClassifier] = None):
+        await self.acquire_async()
+        outcome, retry_after = OUTCOME_SUCCESS, None
+        try:
+            yield self
+        except BaseException as exc:
+            outcome, retry_after = classify(exc) if classify else (OUTCOME_ERROR, None)
+            raise
+        finally:
+            self.release(outcome, retry_after)
+
+    # --- Metrics ---
+
+    @property
+    def concurrency_limit(self) -> int:
+        with self._cond:
+            return int(self._concurrency_limit)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            now = time.monotonic()
+            self._refill_locked(now)
+            return {
+                "provider": self.name,
+                "concurrency_limit": int(self._concurrency_limit),
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self._in_flight,
+                "queue_depth": self._waiting,
+                "tokens_available": round(self._tokens, 2),
+                "requests_per_second": self.requests_per_second,
+                "cooldown_remaining_seconds": round(max(0.0, self._cooldown_until - now), 2),
+                "success_count": self._success_count,
+                "throttled_count": self._throttled_count,
+                "error_count": self._error_count,
+            }
+
+
+# --- Registry theo provider ---
+
+_limiters: Dict[str, AdaptiveRateLimiter] = {}
+_limit_settings: Dict[str, Dict[str, Any]] = {}
+_registry_lock = threading.Lock()
+
+
+def configure_rate_limits(limits_config: Optional[Dict[str, Dict[str, Any]]],
+                          defaults: Optional[Dict[str, Any]] = None,
+                          overrides: Optional[Dict[str, Any]] = None) -> None:
+    """
+    Nạp cấu hình limiter (vd: VOICE_CONFIG["__RATE_LIMITS__"]).
+
+    Args:
+        limits_config: {provider: {tham số}}; khóa "__DEFAULT__" áp dụng cho mọi provider.
+        defaults: Giá trị mặc định bổ sung (ưu tiên thấp hơn limits_config).
+        overrides: Giá trị ép cho mọi provider (ưu tiên cao hơn limits_config, vd: từ biến môi trường).
+    """
+    with _registry_lock:
+        _limit_settings.clear()
+        _limit_settings["__BASE__"] = {**DEFAULT_LIMITS, **(defaults or {})}
+        _limit_settings["__OVERRIDES__"] = dict(overrides or {})
+        for provider, settings in (limits_config or {}).items():
+            if isinstance(settings, dict):
+                _limit_settings[provider.lower()] = dict(settings)
+        _limiters.clear() # Limiter sẽ được tạo lại với cấu hình mới
+
+
+def get_rate_limiter(provider: str) -> AdaptiveRateLimiter:
+    """Trả về limiter dùng chung (trong tiến trình) của provider."""
+    provider = (provider or "unknown").lower()
+    with _registry_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            settings = {**_limit_settings.get("__BASE__", DEFAULT_LIMITS),
+                        **_limit_settings.get("__default__", {}),
+                        **_limit_settings.get(provider, {}),
+                        **_limit_settings.get("__OVERRIDES__", {})}
+            limiter = AdaptiveRateLimiter(provider, **{k: settings[k] for k in DEFAULT_LIMITS})
+            _limiters[provider] = limiter
+            logger.info(f"[RateLimit:{provider}] Created limiter: rps={limiter.requests_per_second}, "
+                        f"concurrency={limiter.concurrency_limit}/{limiter.max_concurrency}")
+        return limiter
+
+
+def get_rate_limiter_metrics() -> Dict[str, Dict[str, Any]]:
+    """Snapshot metrics của tất cả limiter đã tạo (giới hạn hiện tại, in-flight, hàng đợi...)."""
+    with _registry_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.metrics() for limiter in limiters}
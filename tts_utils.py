@@ -1,10 +1,14 @@
 # tts_utils.py
 import datetime
+import hashlib
 import json
 import logging
 import os
 import shutil
+import subprocess
 import tempfile
+import threading
+import concurrent.futures
 # import time # Có thể bỏ nếu không dùng sleep hoặc logic thời gian khác
 import urllib.parse
 from pathlib import Path
@@ -14,12 +18,13 @@ import openai # Import module để dùng exception types
 import pymongo # Import để dùng sort direction và errors
 import pymongo.errors
 import requests
+import requests.adapters
 import tenacity # Import tenacity đầy đủ
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
 from openai import OpenAI
 # Import cụ thể các thành phần tenacity cần dùng
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, wait_fixed, wait_random_exponential, retry_if_exception_type
 from typing import Dict, Optional, Tuple, List, Any, Literal, cast
 
 # Gần phần Constants
@@ -30,8 +35,12 @@ try:
     from db_manager import get_script_chunks_collection
     # Cần hàm chia chunk từ utils
     from utils import split_script_into_chunks
+    from tts_rate_limiter import (
+        configure_rate_limits, get_rate_limiter, get_rate_limiter_metrics, parse_retry_after,
+        OUTCOME_ERROR, OUTCOME_THROTTLED
+    )
 except ImportError as e:
-    logging.critical(f"tts_utils: Failed critical imports (db_manager, utils): {e}. Exiting.")
+    logging.critical(f"tts_utils: Failed critical imports (db_manager, utils, tts_rate_limiter): {e}. Exiting.")
     exit(1) # Thoát nếu import cốt lõi thất bại
 
 # --- Pydub / FFmpeg Setup ---
@@ -69,7 +78,7 @@ LOCAL_AUDIO_BASE_PATH_STR = os.getenv("LOCAL_AUDIO_OUTPUT_PATH", "/mnt/NewVolume
 LOCAL_AUDIO_BASE_PATH = Path(LOCAL_AUDIO_BASE_PATH_STR)
 TTS_API_CHAR_LIMIT = int(os.getenv("TTS_CHUNK_CHAR_LIMIT", 500)) # Giới hạn ký tự cho TTS API
 MIN_AUDIO_FILE_SIZE_BYTES = 100 # File audio hợp lệ phải lớn hơn ngưỡng này
-POLLINATIONS_API_URL_BASE = "https://text.pollinations.ai/"
+POLLINATIONS_API_URL_BASE = os.getenv("POLLINATIONS_API_URL_BASE", "https://text.pollinations.ai/")
 POLLINATIONS_URL_CHAR_LIMIT = 4000 # Giới hạn URL của Pollinations (ước tính)
 # Hằng số cho retry chung
 RETRY_ATTEMPTS = 3 # Số lần retry cho hàm chính
@@ -79,6 +88,31 @@ POLLINATIONS_RETRY_ATTEMPTS = 3
 POLLINATIONS_RETRY_WAIT_SECONDS = 3
 # Timeout chung cho các request API
 API_TIMEOUT_SECONDS = 120
+# Ghép audio: mặc định nối trực tiếp các frame MP3 (stream copy) thay vì decode/encode lại
+AUDIO_CONCAT_STREAM_COPY = os.getenv("AUDIO_CONCAT_STREAM_COPY", "true").lower() in ("true", "1", "yes", "y")
+AUDIO_CONCAT_TIMEOUT_SECONDS = int(os.getenv("AUDIO_CONCAT_TIMEOUT_SECONDS", 1800))
+# Binary ffmpeg/ffprobe dùng cho stream copy (ưu tiên FFMPEG_PATH/FFPROBE_PATH nếu có)
+_ffmpeg_env_path = os.getenv("FFMPEG_PATH")
+FFMPEG_BINARY = _ffmpeg_env_path if _ffmpeg_env_path and Path(_ffmpeg_env_path).is_file() else "ffmpeg"
+FFPROBE_BINARY = os.getenv("FFPROBE_PATH") or (
+    str(Path(FFMPEG_BINARY).with_name("ffprobe" + Path(FFMPEG_BINARY).suffix))
+    if FFMPEG_BINARY != "ffmpeg" else "ffprobe"
+)
+
+# Cache audio TTS theo nội dung: key = hash(provider, voice, speed, text đã chuẩn hóa)
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE_ENABLED", "true").lower() in ("true", "1", "yes", "y")
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", str(LOCAL_AUDIO_BASE_PATH / ".tts_cache")))
+TTS_CACHE_MAX_BYTES = int(float(os.getenv("TTS_CACHE_MAX_GB", 20)) * 1024 ** 3)
+TTS_CACHE_EVICT_TARGET_RATIO = 0.9 # Khi vượt giới hạn, xóa file cũ nhất đến khi còn 90%
+# Số sub-chunk của một chunk dài được tạo song song
+TTS_SUBCHUNK_MAX_WORKERS = int(os.getenv("TTS_SUBCHUNK_MAX_WORKERS", 4))
+# Trần số request đồng thời tới MỖI provider trong cả tiến trình (gộp pool chunk và pool sub-chunk).
+# Thứ tự ưu tiên: biến môi trường TTS_PROVIDER_MAX_CONCURRENCY (nếu đặt, áp dụng cho mọi provider)
+# > max_concurrency theo provider / "__DEFAULT__" trong voice_config.json -> "__RATE_LIMITS__" > 4
+TTS_PROVIDER_MAX_CONCURRENCY_ENV = os.getenv("TTS_PROVIDER_MAX_CONCURRENCY")
+TTS_PROVIDER_MAX_CONCURRENCY = int(TTS_PROVIDER_MAX_CONCURRENCY_ENV or 4)
+# Số kết nối keep-alive tối đa giữ trong pool của HTTP session dùng chung (mỗi host)
+TTS_HTTP_POOL_SIZE = int(os.getenv("TTS_HTTP_POOL_SIZE", max(TTS_PROVIDER_MAX_CONCURRENCY, TTS_SUBCHUNK_MAX_WORKERS) * 2))
 
 # --- Đảm bảo thư mục audio tồn tại ---
 try:
@@ -107,6 +141,25 @@ if tts_api_key_other:
 else:
     logging.warning("TTS_API_KEY (for OpenAI/Local TTS) not set. These providers will be unavailable.")
 
+# --- HTTP Session (Pollinations) ---
+# Session dùng chung cho mọi luồng TTS: tái sử dụng kết nối keep-alive thay vì bắt tay TCP+TLS
+# cho mỗi request. Adapter không tự retry (tenacity + limiter đã lo phần này).
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+
+def _get_http_session() -> requests.Session:
+    """Trả về requests.Session dùng chung (tạo lần đầu khi cần), pool cỡ TTS_HTTP_POOL_SIZE."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(1, TTS_HTTP_POOL_SIZE), max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+            logging.info(f"Initialized shared TTS HTTP session (pool_maxsize={TTS_HTTP_POOL_SIZE})")
+        return _http_session
+
 # --- Custom Exceptions ---
 class TTSProviderError(Exception):
     """Lỗi chung liên quan đến provider TTS."""
@@ -122,6 +175,13 @@ class ConfigurationError(Exception):
 
 # --- Helper Functions ---
 
+def _normalize_tts_text(text: str, provider: str) -> str:
+    """Chuẩn hóa text trước khi gửi cho provider TTS (cũng là text dùng làm key cache)."""
+    processed_text = text.strip()
+    if provider == "pollinations":
+        processed_text = processed_text.replace("chết", "chít") # Ví dụ thay thế từ
+    return processed_text
+
 def load_voice_config(config_path: Path = VOICE_CONFIG_FILE) -> Dict[str, Any]:
     """Tải cấu hình giọng đọc từ file JSON."""
     try:
@@ -177,7 +237,7 @@ def get_voice_settings(language: str, voice_config: Dict[str, Any]) -> Dict[str,
 
     # 1. Thử khớp chính xác (không phân biệt hoa thường)
     for key, value in voice_config.items():
-        if key != "__DEFAULT__" and key.lower() == lang_lower:
+        if not key.startswith("__") and key.lower() == lang_lower:
             settings = value.copy() # Lấy bản copy để tránh thay đổi config gốc
             logging.info(f"Found exact match for language '{language}' in config.")
             break
@@ -185,7 +245,7 @@ def get_voice_settings(language: str, voice_config: Dict[str, Any]) -> Dict[str,
     # 2. Nếu không khớp chính xác, thử khớp một phần
     if settings is None:
         for key, value in voice_config.items():
-            if key != "__DEFAULT__" and lang_lower in key.lower():
+            if not key.startswith("__") and lang_lower in key.lower():
                 settings = value.copy()
                 logging.warning(f"Used partial match config key '{key}' for requested language '{language}'.")
                 break
@@ -204,18 +264,48 @@ def get_voice_settings(language: str, voice_config: Dict[str, Any]) -> Dict[str,
     logging.info(f"Final settings for '{language}': Provider='{settings['provider']}', Voice='{settings['voice_name']}', Rate={settings['speaking_rate']:.2f}")
     return settings
 
+# --- Provider Rate Limiting ---
+
+# Mỗi provider dùng chung một limiter (token bucket + AIMD) trong cả tiến trình
+configure_rate_limits(VOICE_CONFIG.get("__RATE_LIMITS__", {}),
+                      defaults={"max_concurrency": TTS_PROVIDER_MAX_CONCURRENCY},
+                      overrides={"max_concurrency": TTS_PROVIDER_MAX_CONCURRENCY} if TTS_PROVIDER_MAX_CONCURRENCY_ENV else None)
+
+def get_provider_rate_limiter(provider: str):
+    """Limiter của provider ('local_tts' dùng chung client/limiter với 'openai')."""
+    provider = (provider or "").lower()
+    return get_rate_limiter("openai" if provider == "local_tts" else provider)
+
+def _classify_tts_exception(exc: BaseException) -> Tuple[str, Optional[float]]:
+    """Phân loại lỗi TTS cho limiter: 429/5xx/timeout -> throttled (kèm Retry-After nếu có)."""
+    status_code: Optional[int] = None
+    retry_after: Optional[float] = None
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        status_code = exc.response.status_code
+        retry_after = parse_retry_after(exc.response.headers.get("Retry-After"))
+    elif isinstance(exc, openai.APIStatusError):
+        status_code = exc.status_code
+        retry_after = parse_retry_after(exc.response.headers.get("retry-after"))
+    elif isinstance(exc, (requests.exceptions.Timeout, openai.APITimeoutError)):
+        return OUTCOME_THROTTLED, None
+
+    if status_code is not None and (status_code == 429 or status_code >= 500):
+        return OUTCOME_THROTTLED, retry_after
+    return OUTCOME_ERROR, None
+
 # --- Provider-Specific TTS Callers ---
 
 @retry(
     stop=stop_after_attempt(POLLINATIONS_RETRY_ATTEMPTS),
-    wait=wait_fixed(POLLINATIONS_RETRY_WAIT_SECONDS),
+    # Limiter đã chờ Retry-After/cooldown khi bị throttle -> ở đây chỉ cần backoff ngắn có jitter
+    wait=wait_random_exponential(multiplier=1, max=POLLINATIONS_RETRY_WAIT_SECONDS * 4),
     retry=retry_if_exception_type((requests.exceptions.RequestException, PollinationsError)), # Retry lỗi mạng và lỗi logic của Pollinations
     reraise=True, # Quan trọng: Ném lại lỗi cuối cùng để tầng gọi ngoài biết
      before_sleep=lambda retry_state: logger.warning(
         (
             f"Retrying create_audio_for_chunk (Attempt #{retry_state.attempt_number}) "
             f"due to {type(retry_state.outcome.exception()).__name__ if retry_state.outcome and retry_state.outcome.exception() else 'UnknownOutcome'}. " # <<< SỬA Ở ĐÂY
-            f"Waiting {RETRY_WAIT_SECONDS}s..."
+            f"Waiting {retry_state.next_action.sleep if retry_state.next_action else 0:.1f}s..."
         )
     )
 )
@@ -237,7 +327,7 @@ def _call_pollinations_tts(text: str, voice_name: str, output_filename: Path) ->
         TTSProviderError: Cho các lỗi không mong muốn khác trong quá trình gọi.
     """
     
-    processed_text = text.replace("chết", "chít") # Ví dụ thay thế từ
+    processed_text = _normalize_tts_text(text, "pollinations")
     logger.debug(f"[Pollinations] Calling API for voice '{processed_text}' -> {output_filename} (Attempt info managed by tenacity)")
     logger.debug(f"[Pollinations] Calling API for vprocessed_text '{processed_text}' -> {output_filename} (Attempt info managed by tenacity)")
 
@@ -249,7 +339,9 @@ def _call_pollinations_tts(text: str, voice_name: str, output_filename: Path) ->
         logger.warning(f"[Pollinations] Request URL ({len(api_url)} chars) might exceed limit ({POLLINATIONS_URL_CHAR_LIMIT}).")
 
     try:
-        with requests.get(api_url, params=params, timeout=API_TIMEOUT_SECONDS, stream=True) as response:
+        # Giữ slot của limiter cho từng lần gọi (không giữ trong lúc tenacity chờ retry)
+        with get_rate_limiter("pollinations").slot(_classify_tts_exception), \
+             _get_http_session().get(api_url, params=params, timeout=API_TIMEOUT_SECONDS, stream=True) as response:
             response.raise_for_status() # Vẫn check HTTP errors -> raise RequestException (HTTPError)
             content_type = response.headers.get('Content-Type', '')
 
@@ -318,7 +410,7 @@ def _call_openai_tts(text: str, voice_name: str, speed: float, output_filename:
 
     try:
         # Sử dụng streaming response để ghi trực tiếp vào file
-        with client_tts_other.audio.speech.with_streaming_response.create(
+        with get_rate_limiter("openai").slot(_classify_tts_exception), client_tts_other.audio.speech.with_streaming_response.create(
             model='tts-1', # Hoặc model khác nếu server local hỗ trợ
             voice=cast(OpenAIVoice, voice_name),
             input=text,
@@ -354,6 +446,161 @@ def _call_openai_tts(text: str, voice_name: str, speed: float, output_filename:
         raise TTSProviderError(f"Unexpected error during OpenAI/Local TTS call: {e}") from e
 
 
+# --- TTS Audio Cache (content-addressed) ---
+
+_tts_cache_lock = threading.Lock()
+_tts_cache_size_bytes: Optional[int] = None # None = chưa quét thư mục cache
+
+
+def _tts_cache_key(provider: str, voice_name: str, speed: float, text: str) -> str:
+    """Key cache = sha256 của (provider, voice, speed, text đã chuẩn hóa)."""
+    normalized_text = " ".join(_normalize_tts_text(text, provider).split())
+    payload = json.dumps([provider, voice_name, round(float(speed), 3), normalized_text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _tts_cache_path(cache_key: str) -> Path:
+    # Chia thư mục con theo 2 ký tự đầu để tránh một thư mục chứa quá nhiều file
+    return TTS_CACHE_DIR / cache_key[:2] / f"{cache_key}.mp3"
+
+
+def _link_or_copy(src: Path, dest: Path) -> None:
+    """Hard-link src sang dest (thay thế dest nếu có), copy nếu khác filesystem."""
+    tmp_dest = dest.with_name(f".{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        try:
+            os.link(src, tmp_dest)
+        except OSError:
+            shutil.copy2(src, tmp_dest)
+        os.replace(tmp_dest, dest)
+    finally:
+        if tmp_dest.exists():
+            try: tmp_dest.unlink()
+            except OSError: pass
+
+
+def _tts_cache_fetch(cache_key: str, dest: Path) -> bool:
+    """Đưa audio đã cache vào dest. Trả về True nếu cache hit."""
+    if not TTS_CACHE_ENABLED:
+        return False
+    cached_path = _tts_cache_path(cache_key)
+    try:
+        if not cached_path.is_file() or cached_path.stat().st_size <= MIN_AUDIO_FILE_SIZE_BYTES:
+            return False
+        os.utime(cached_path) # Cập nhật mtime = lần dùng gần nhất (cho LRU)
+        _link_or_copy(cached_path, dest)
+        logger.debug(f"[TTS cache] Hit {cache_key[:12]} -> {dest}")
+        return True
+    except OSError as e_fetch:
+        logger.warning(f"[TTS cache] Could not reuse cached audio {cached_path}: {e_fetch}")
+        return False
+
+
+def _tts_cache_store(cache_key: str, src: Path) -> None:
+    """Lưu file audio vừa tạo vào cache. Lỗi cache chỉ ghi log, không làm hỏng chunk."""
+    if not TTS_CACHE_ENABLED:
+        return
+    cached_path = _tts_cache_path(cache_key)
+    try:
+        cached_path.parent.mkdir(parents=True, exist_ok=True)
+        _link_or_copy(src, cached_path)
+        os.utime(cached_path)
+        _tts_cache_account(cached_path.stat().st_size)
+    except OSError as e_store:
+        logger.warning(f"[TTS cache] Could not store {src} in cache: {e_store}")
+
+
+def _scan_tts_cache() -> List[Tuple[float, int, Path]]:
+    """Liệt kê (mtime, size, path) của các file trong cache."""
+    entries = []
+    for cached_file in TTS_CACHE_DIR.glob("*/*.mp3"):
+        try:
+            stat = cached_file.stat()
+            entries.append((stat.st_mtime, stat.st_size, cached_file))
+        except OSError:
+            continue # File vừa bị xóa bởi tiến trình khác
+    return entries
+
+
+def _tts_cache_account(added_bytes: int) -> None:
+    """Cộng dồn kích thước cache, xóa file ít dùng nhất (LRU theo mtime) khi vượt giới hạn."""
+    global _tts_cache_size_bytes
+    with _tts_cache_lock:
+        if _tts_cache_size_bytes is None:
+            _tts_cache_size_bytes = sum(size for _, size, _ in _scan_tts_cache())
+        else:
+            _tts_cache_size_bytes += added_bytes
+        if _tts_cache_size_bytes <= TTS_CACHE_MAX_BYTES:
+            return
+
+        # Quét lại để có số liệu chính xác (nhiều worker có thể dùng chung cache)
+        entries = sorted(_scan_tts_cache())
+        total_bytes = sum(size for _, size, _ in entries)
+        target_bytes = int(TTS_CACHE_MAX_BYTES * TTS_CACHE_EVICT_TARGET_RATIO)
+        removed_count = 0
+        for _mtime, size, cached_file in entries:
+            if total_bytes <= target_bytes:
+                break
+            try:
+                cached_file.unlink()
+                total_bytes -= size
+                removed_count += 1
+            except OSError as e_del:
+                logger.warning(f"[TTS cache] Could not evict {cached_file}: {e_del}")
+        _tts_cache_size_bytes = total_bytes
+        logger.info(f"[TTS cache] Evicted {removed_count} files. Cache size now {total_bytes / 1024 ** 2:.1f} MB.")
+
+
+def _synthesize_to_file(provider: str, text: str, voice_name: str, speed: float, output_filename: Path) -> bool:
+    """
+    Tạo audio cho một đoạn text (đã nằm trong giới hạn ký tự của API) vào output_filename.
+    Dùng lại audio trong cache nếu đã từng tạo cùng (provider, voice, speed, text).
+
+    Raises:
+        ConfigurationError: Nếu provider không được hỗ trợ.
+        Các exception của _call_pollinations_tts / _call_openai_tts.
+    """
+    cache_key = _tts_cache_key(provider, voice_name, speed, text)
+    if _tts_cache_fetch(cache_key, output_filename):
+        return True
+
+    if provider == "pollinations":
+        # Hàm này có retry riêng
+        _call_pollinations_tts(text, voice_name, output_filename)
+    elif provider in ["openai", "local_tts"]:
+        # Hàm này không có retry riêng, lỗi sẽ được retry bởi decorator chính
+        _call_openai_tts(text, voice_name, speed, output_filename)
+    # --- Thêm các provider khác ở đây ---
+    # elif provider == "google":
+    #    _call_google_tts(...)
+    else:
+        # Provider không hỗ trợ -> Lỗi cấu hình, không retry
+        raise ConfigurationError(f"Unsupported TTS provider specified: '{provider}'")
+
+    _tts_cache_store(cache_key, output_filename)
+    return True
+
+
+def _build_chunk_audio_path(script_folder_path: Path, script_name: str, section_index: Any,
+                            voice_settings: Dict[str, Any]) -> Path:
+    """Đường dẫn file audio đích của một chunk (tên có timestamp và mã ngôn ngữ)."""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    lang_code_suffix = voice_settings.get("language_code", "unk") # Thêm mã ngôn ngữ vào tên file
+    # Đảm bảo tên file hợp lệ trên các HĐH
+    safe_script_name = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in script_name)
+    audio_file_name = f"{safe_script_name}_section_{section_index}_{timestamp}_{lang_code_suffix}.mp3"
+    return script_folder_path / audio_file_name
+
+
+def _split_text_for_tts(text_content: str, voice_settings: Dict[str, Any]) -> List[str]:
+    """Chia text dài thành các sub-chunk <= TTS_API_CHAR_LIMIT (bỏ các đoạn rỗng)."""
+    lang_code_for_split = voice_settings.get("language_code", "en-US")
+    # Tìm tên ngôn ngữ tương ứng với language_code từ VOICE_CONFIG để dùng cho NLTK
+    lang_name_for_split = next((k for k, v in VOICE_CONFIG.items() if not k.startswith("__") and v.get("language_code") == lang_code_for_split), 'english').lower()
+    sub_chunks_text = split_script_into_chunks(text_content, TTS_API_CHAR_LIMIT, language=lang_name_for_split) or []
+    return [t.strip() for t in sub_chunks_text if t.strip()]
+
+
 # --- Core Audio Generation Function ---
 
 # Các Exceptions cần retry cho hàm chính:
@@ -407,7 +654,7 @@ def create_audio_for_chunk(chunk_doc_id_str: str, script_name: str, voice_settin
         FileNotFoundError: Nếu chunk không tồn tại trong DB ban đầu.
         ConfigurationError: Nếu thiếu cấu hình cần thiết (vd: TTS client).
         ValueError: Nếu đầu vào không hợp lệ (vd: thiếu voice_name, ID sai định dạng).
-        RuntimeError: Nếu Pydub không được load và cần ghép file.
+        RuntimeError: Nếu cần decode khi ghép file nhưng Pydub không được load.
         Exception: Các lỗi không mong muốn khác không được retry.
     """
     script_chunks_coll = get_script_chunks_collection()
@@ -461,12 +708,7 @@ def create_audio_for_chunk(chunk_doc_id_str: str, script_name: str, voice_settin
         # Lỗi OS có thể retry hoặc không tùy cấu hình RETRYABLE_EXCEPTIONS_MAIN
         raise # Ném lại lỗi
 
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    lang_code_suffix = voice_settings.get("language_code", "unk") # Thêm mã ngôn ngữ vào tên file
-    # Đảm bảo tên file hợp lệ trên các HĐH
-    safe_script_name = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in script_name)
-    audio_file_name = f"{safe_script_name}_section_{section_index}_{timestamp}_{lang_code_suffix}.mp3"
-    audio_file_path_local = script_folder_path / audio_file_name
+    audio_file_path_local = _build_chunk_audio_path(script_folder_path, script_name, section_index, voice_settings)
 
     provider = voice_settings.get("provider", "openai").lower()
     voice_name = voice_settings.get("voice_name")
@@ -483,65 +725,58 @@ def create_audio_for_chunk(chunk_doc_id_str: str, script_name: str, voice_settin
     final_error_message = None
 
     try:
-        # --- Logic chính: Chia nhỏ hoặc xử lý trực tiếp ---
-        if len(text_content) > TTS_API_CHAR_LIMIT:
+        # --- Logic chính: Dùng cache, chia nhỏ hoặc xử lý trực tiếp ---
+        chunk_cache_key = _tts_cache_key(provider, voice_name, speed, text_content)
+        if len(text_content) > TTS_API_CHAR_LIMIT and _tts_cache_fetch(chunk_cache_key, audio_file_path_local):
+            # Chunk dài đã từng được tạo (vd: sau reset_generation) -> không gọi API
+            logging.info(f"Chunk {chunk_doc_id_str} audio reused from TTS cache.")
+            final_success = True
+
+        elif len(text_content) > TTS_API_CHAR_LIMIT:
             # --- Xử lý Chunk dài (Chia nhỏ -> TTS từng phần -> Ghép) ---
-            if not AudioSegment: # Kiểm tra Pydub trước khi bắt đầu ghép nối
-                 raise RuntimeError("Pydub library not loaded. Cannot process long chunk requiring concatenation.")
-
             logging.warning(f"Chunk {chunk_doc_id_str} text ({len(text_content)} chars) > limit ({TTS_API_CHAR_LIMIT}). Splitting...")
 
-            lang_code_for_split = voice_settings.get("language_code", "en-US")
-            # Tìm tên ngôn ngữ tương ứng với language_code từ VOICE_CONFIG để dùng cho NLTK
-            lang_name_for_split = next((k for k, v in VOICE_CONFIG.items() if k != "__DEFAULT__" and v.get("language_code") == lang_code_for_split), 'english').lower()
-
-            sub_chunks_text = split_script_into_chunks(text_content, TTS_API_CHAR_LIMIT, language=lang_name_for_split)
-            if not sub_chunks_text:
+            sub_texts = _split_text_for_tts(text_content, voice_settings)
+            if not sub_texts:
                  # Lỗi không chia được chunk -> Lỗi logic, không retry
                 raise ValueError(f"Failed to split long text content for chunk {chunk_doc_id_str}.")
 
-            logging.info(f"Split into {len(sub_chunks_text)} sub-chunks. Generating audio for each...")
+            logging.info(f"Split into {len(sub_texts)} sub-chunks. Generating audio for each...")
             # Tạo thư mục tạm duy nhất cho generation ID và chunk index
             temp_dir = tempfile.mkdtemp(prefix=f"tts_{generation_id_str_for_path}_chunk{section_index}_")
             temp_dir_obj = Path(temp_dir)
-            temp_audio_files: List[Path] = []
+            # Đặt tên file theo vị trí để giữ đúng thứ tự khi ghép, dù các sub-chunk xong không theo thứ tự
+            temp_audio_files: List[Path] = [temp_dir_obj / f"sub_{section_index}_{sub_idx}.mp3" for sub_idx in range(len(sub_texts))]
             all_sub_chunks_ok = True
 
-            for sub_idx, sub_text in enumerate(sub_chunks_text):
-                sub_text = sub_text.strip()
-                print(sub_text)
-                if not sub_text: continue
-
-                temp_filename = temp_dir_obj / f"sub_{section_index}_{sub_idx}.mp3"
-                logging.debug(f"Generating sub-chunk {sub_idx+1}/{len(sub_chunks_text)} (Prov:{provider}) -> {temp_filename}")
-
-                try:
-                    # Gọi hàm helper tương ứng
-                    if provider == "pollinations":
-                        # Hàm này có retry riêng
-                        _call_pollinations_tts(sub_text, voice_name, temp_filename)
-                    elif provider in ["openai", "local_tts"]:
-                        # Hàm này không có retry riêng, lỗi sẽ được retry bởi decorator chính
-                        _call_openai_tts(sub_text, voice_name, speed, temp_filename)
-                    # --- Thêm các provider khác ở đây ---
-                    # elif provider == "google":
-                    #    _call_google_tts(...)
-                    else:
-                        # Provider không hỗ trợ -> Lỗi cấu hình, không retry
-                        raise ConfigurationError(f"Unsupported TTS provider specified: '{provider}'")
-
-                    # Nếu không có exception tức là thành công
-                    temp_audio_files.append(temp_filename)
-                    logging.debug(f"Sub-chunk {sub_idx+1} generated successfully.")
-
-                except Exception as sub_e:
-                    # Bắt lỗi từ các hàm _call_... sau khi chúng đã retry (nếu có)
-                    all_sub_chunks_ok = False
-                    # Giữ lại lỗi đầu tiên gặp phải
-                    if not final_error_message:
-                        final_error_message = f"Failed generating sub-chunk {sub_idx+1} ({type(sub_e).__name__}): {str(sub_e)[:200]}"
-                    logging.error(f"Error on sub-chunk {sub_idx+1}: {final_error_message}", exc_info=False) # Không cần traceback đầy đủ ở đây
-                    break # Dừng xử lý các sub-chunk còn lại nếu có lỗi
+            # Tạo song song các sub-chunk. Số request thực sự gửi tới provider vẫn bị giới hạn
+            # bởi limiter dùng chung của provider (xem tts_rate_limiter).
+            max_sub_workers = max(1, min(TTS_SUBCHUNK_MAX_WORKERS, len(sub_texts)))
+            logging.debug(f"Generating {len(sub_texts)} sub-chunks with {max_sub_workers} workers (Prov:{provider})")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_sub_workers,
+                                                       thread_name_prefix=f"tts_sub_{section_index}") as sub_executor:
+                future_to_sub_idx = {
+                    sub_executor.submit(_synthesize_to_file, provider, sub_text, voice_name, speed, temp_audio_files[sub_idx]): sub_idx
+                    for sub_idx, sub_text in enumerate(sub_texts)
+                }
+                for future in concurrent.futures.as_completed(future_to_sub_idx):
+                    sub_idx = future_to_sub_idx[future]
+                    if future.cancelled():
+                        continue
+                    try:
+                        # Nếu không có exception tức là thành công
+                        future.result()
+                        logging.debug(f"Sub-chunk {sub_idx+1}/{len(sub_texts)} generated successfully.")
+                    except Exception as sub_e:
+                        # Bắt lỗi từ các hàm _call_... sau khi chúng đã retry (nếu có)
+                        all_sub_chunks_ok = False
+                        # Giữ lại lỗi đầu tiên gặp phải
+                        if not final_error_message:
+                            final_error_message = f"Failed generating sub-chunk {sub_idx+1} ({type(sub_e).__name__}): {str(sub_e)[:200]}"
+                        logging.error(f"Error on sub-chunk {sub_idx+1}: {final_error_message}", exc_info=False) # Không cần traceback đầy đủ ở đây
+                        # Hủy các sub-chunk chưa bắt đầu; sub-chunk đã xong vẫn nằm trong TTS cache cho lần retry
+                        for pending_future in future_to_sub_idx:
+                            pending_future.cancel()
 
             # --- Kết thúc vòng lặp sub-chunk ---
             if all_sub_chunks_ok and temp_audio_files:
@@ -550,6 +785,7 @@ def create_audio_for_chunk(chunk_doc_id_str: str, script_name: str, voice_settin
                     # Gọi hàm ghép file
                     if concatenate_audio(temp_audio_files, audio_file_path_local):
                         final_success = True
+                        _tts_cache_store(chunk_cache_key, audio_file_path_local)
                         logging.info(f"Successfully concatenated sub-chunks to {audio_file_path_local}")
                     else:
                         # Lỗi logic trong hàm ghép file
@@ -570,17 +806,8 @@ def create_audio_for_chunk(chunk_doc_id_str: str, script_name: str, voice_settin
             logging.debug(f"Chunk {chunk_doc_id_str} text length OK. Calling TTS directly...")
             logging.debug(f"Text {text_content} text length OK. Calling TTS directly...")
             try:
-                if provider == "pollinations":
-                    print(text_content)
-                    final_success = _call_pollinations_tts(text_content, voice_name, audio_file_path_local)
-                elif provider in ["openai", "local_tts"]:
-                    final_success = _call_openai_tts(text_content, voice_name, speed, audio_file_path_local)
-                # --- Thêm các provider khác ---
-                # elif provider == "google":
-                #    final_success = _call_google_tts(...)
-                else:
-                     # Provider không hỗ trợ -> Lỗi cấu hình, không retry
-                    raise ConfigurationError(f"Unsupported TTS provider specified: '{provider}'")
+                # Lấy từ cache hoặc gọi provider tương ứng
+                final_success = _synthesize_to_file(provider, text_content, voice_name, speed, audio_file_path_local)
 
                 if not final_success and not final_error_message:
                      # Trường hợp hàm helper trả về False (không nên xảy ra nếu dùng exception)
@@ -677,56 +904,102 @@ def create_audio_for_chunk(chunk_doc_id_str: str, script_name: str, voice_settin
 
 # --- Audio Concatenation ---
 
-def concatenate_audio(audio_file_paths: List[Path], output_file_path: Path) -> bool:
+def _probe_audio_stream(path: Path) -> Optional[Tuple[str, int, int]]:
     """
-    Nối các file audio MP3 từ danh sách đường dẫn Path object.
+    Lấy thông số luồng audio đầu tiên của file bằng ffprobe.
+
+    Returns:
+        Tuple (codec_name, sample_rate, channels) hoặc None nếu probe lỗi.
+    """
+    cmd = [
+        FFPROBE_BINARY, "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "stream=codec_name,sample_rate,channels",
+        "-of", "json", str(path)
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8',
+                                errors='replace', timeout=30, check=True)
+        streams = json.loads(result.stdout or "{}").get("streams") or []
+    except (subprocess.SubprocessError, OSError, json.JSONDecodeError) as e_probe:
+        logging.warning(f"ffprobe failed for {path}: {e_probe}")
+        return None
+    if not streams:
+        logging.warning(f"ffprobe found no audio stream in {path}")
+        return None
+    stream = streams[0]
+    try:
+        return (stream.get("codec_name", ""), int(stream.get("sample_rate") or 0), int(stream.get("channels") or 0))
+    except (TypeError, ValueError):
+        return None
 
-    Args:
-        audio_file_paths: List các đối tượng Path trỏ đến file audio nguồn.
-        output_file_path: Đối tượng Path cho file audio đích.
+
+def _concatenate_audio_stream_copy(audio_file_paths: List[Path], output_file_path: Path) -> bool:
+    """
+    Nối các file MP3 cùng codec/sample rate/channels bằng concat demuxer của ffmpeg
+    với `-c copy`: chỉ nối các frame MP3, không decode ra PCM và không encode lại.
 
     Returns:
-        True nếu ghép nối thành công, False nếu thất bại.
+        True nếu ffmpeg tạo được file output hợp lệ, False nếu thất bại.
+    """
+    output_file_path.parent.mkdir(parents=True, exist_ok=True)
+    list_fd, list_path_str = tempfile.mkstemp(prefix="concat_", suffix=".txt", dir=str(output_file_path.parent))
+    # Ghi ra file tạm rồi mới đổi tên để không để lại file hỏng nếu ffmpeg lỗi giữa chừng
+    tmp_output_path = output_file_path.with_name(f".{output_file_path.stem}.partial.mp3")
+    try:
+        with os.fdopen(list_fd, 'w', encoding='utf-8') as f:
+            for p in audio_file_paths:
+                safe_path = str(p.resolve()).replace('\\', '/').replace("'", "'\\''")
+                f.write(f"file '{safe_path}'\n")
+
+        cmd = [
+            FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "concat", "-safe", "0", "-i", list_path_str,
+            "-map", "0:a", "-c", "copy", "-map_metadata", "-1",
+            "-f", "mp3", str(tmp_output_path)
+        ]
+        logging.debug(f"Stream-copy concat command: {subprocess.list2cmdline(cmd)}")
+        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace',
+                                timeout=AUDIO_CONCAT_TIMEOUT_SECONDS, check=False)
+        if result.returncode != 0:
+            logging.warning(f"ffmpeg stream-copy concat failed (exit {result.returncode}): {result.stderr.strip()[-500:]}")
+            return False
+        if not tmp_output_path.is_file() or tmp_output_path.stat().st_size <= MIN_AUDIO_FILE_SIZE_BYTES:
+            logging.warning(f"ffmpeg stream-copy concat produced an empty/small file: {tmp_output_path}")
+            return False
+
+        os.replace(tmp_output_path, output_file_path)
+        return True
+    except (subprocess.SubprocessError, OSError) as e_concat:
+        logging.warning(f"Stream-copy concat error for {output_file_path}: {e_concat}")
+        return False
+    finally:
+        for leftover in (Path(list_path_str), tmp_output_path):
+            try:
+                if leftover.exists():
+                    leftover.unlink()
+            except OSError as e_del:
+                logging.warning(f"Could not remove temporary file {leftover}: {e_del}")
 
-    Raises:
-        RuntimeError: Nếu Pydub không khả dụng.
-        Exception: Các lỗi không mong muốn khác trong quá trình xử lý file.
+
+def _concatenate_audio_decode(audio_file_paths: List[Path], output_file_path: Path) -> bool:
+    """
+    Nối audio bằng Pydub (decode toàn bộ ra PCM rồi encode lại bằng libmp3lame).
+    Chỉ dùng khi các file khác codec/sample rate/số kênh hoặc stream copy thất bại.
     """
     if not AudioSegment:
         # Lỗi này nên được raise thay vì chỉ log và trả về False
         raise RuntimeError("Pydub library not loaded or failed to initialize. Cannot concatenate audio.")
-    if not audio_file_paths:
-        logging.warning("No audio file paths provided for concatenation.")
-        return False
 
     combined = AudioSegment.empty()
     loaded_count = 0
-    logging.info(f"Attempting to combine {len(audio_file_paths)} audio segments into {output_file_path}...")
-
-    valid_paths: List[Path] = []
-    for p in audio_file_paths:
-        try:
-            # Kiểm tra file tồn tại và có kích thước hợp lệ
-            if p.is_file() and p.stat().st_size > MIN_AUDIO_FILE_SIZE_BYTES:
-                valid_paths.append(p)
-            else:
-                size_info = f"Size: {p.stat().st_size}" if p.exists() else "Does not exist"
-                logging.warning(f"Skipping invalid/empty/small file: {p} ({size_info})")
-        except Exception as e_stat:
-             logging.warning(f"Error checking file {p}: {e_stat}. Skipping.")
-
-    if not valid_paths:
-        logging.error("No valid audio segments found to combine after checking.")
-        return False # Không có gì để ghép
-
     error_occurred_loading = False
-    for i, path in enumerate(valid_paths):
+    for i, path in enumerate(audio_file_paths):
         try:
             # Chỉ định format để chắc chắn
             sound = AudioSegment.from_file(str(path), format="mp3")
             combined += sound
             loaded_count += 1
-            logging.debug(f"Appended segment {i+1}/{len(valid_paths)}: {path.name} ({len(sound)/1000.0:.2f}s)")
+            logging.debug(f"Appended segment {i+1}/{len(audio_file_paths)}: {path.name} ({len(sound)/1000.0:.2f}s)")
         except Exception as e_load:
             # Ghi log lỗi chi tiết và đánh dấu có lỗi xảy ra
             logging.error(f"Error loading audio segment from {path}: {e_load}. Skipping this segment.", exc_info=True)
@@ -756,6 +1029,69 @@ def concatenate_audio(audio_file_paths: List[Path], output_file_path: Path) -> b
         return False
 
 
+def concatenate_audio(audio_file_paths: List[Path], output_file_path: Path,
+                      stream_copy: bool = AUDIO_CONCAT_STREAM_COPY) -> bool:
+    """
+    Nối các file audio MP3 từ danh sách đường dẫn Path object.
+
+    Mặc định nối trực tiếp các frame MP3 (ffmpeg concat demuxer + stream copy), không
+    giữ PCM trong RAM và không encode lại. Chỉ decode bằng Pydub khi các file khác
+    codec/sample rate/số kênh, khi probe lỗi, hoặc khi stream copy thất bại.
+
+    Args:
+        audio_file_paths: List các đối tượng Path trỏ đến file audio nguồn.
+        output_file_path: Đối tượng Path cho file audio đích.
+        stream_copy: False để luôn dùng đường decode/encode lại bằng Pydub.
+
+    Returns:
+        True nếu ghép nối thành công, False nếu thất bại.
+
+    Raises:
+        RuntimeError: Nếu cần decode nhưng Pydub không khả dụng, hoặc export thất bại.
+    """
+    if not audio_file_paths:
+        logging.warning("No audio file paths provided for concatenation.")
+        return False
+
+    logging.info(f"Attempting to combine {len(audio_file_paths)} audio segments into {output_file_path}...")
+
+    valid_paths: List[Path] = []
+    for p in audio_file_paths:
+        try:
+            # Kiểm tra file tồn tại và có kích thước hợp lệ
+            if p.is_file() and p.stat().st_size > MIN_AUDIO_FILE_SIZE_BYTES:
+                valid_paths.append(p)
+            else:
+                size_info = f"Size: {p.stat().st_size}" if p.exists() else "Does not exist"
+                logging.warning(f"Skipping invalid/empty/small file: {p} ({size_info})")
+        except Exception as e_stat:
+             logging.warning(f"Error checking file {p}: {e_stat}. Skipping.")
+
+    if not valid_paths:
+        logging.error("No valid audio segments found to combine after checking.")
+        return False # Không có gì để ghép
+
+    if stream_copy:
+        # Probe song song, kết quả giữ đúng thứ tự file
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(valid_paths))) as executor:
+            stream_params = list(executor.map(_probe_audio_stream, valid_paths))
+
+        distinct_params = set(stream_params)
+        if None in distinct_params:
+            logging.warning("Could not probe every segment. Falling back to decode/re-encode concatenation.")
+        elif len(distinct_params) > 1:
+            logging.warning(f"Segments differ in codec/sample rate/channels {sorted(distinct_params)}. Falling back to decode/re-encode concatenation.")
+        elif stream_params[0][0] != "mp3":
+            logging.warning(f"Segments use codec '{stream_params[0][0]}', not mp3. Falling back to decode/re-encode concatenation.")
+        elif _concatenate_audio_stream_copy(valid_paths, output_file_path):
+            logging.info(f"Stream-copied {len(valid_paths)} MP3 segments into: {output_file_path}")
+            return True
+        else:
+            logging.warning("Stream-copy concatenation failed. Falling back to decode/re-encode concatenation.")
+
+    return _concatenate_audio_decode(valid_paths, output_file_path)
+
+
 # --- Combine from DB Function ---
 
 def combine_audio_from_db(generation_id_str: str, script_name: str) -> Optional[str]:
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Kho metadata video nền dùng SQLite (WAL), thay cho video_metadata_cache.json.
+
+- Khóa theo đường dẫn tuyệt đối; lưu size, mtime, duration, độ phân giải, codec, fps.
+- Upsert từng dòng (không ghi lại toàn bộ file như cache JSON).
+- Lưu mtime của thư mục: nếu thư mục không đổi (không thêm/xóa/đổi tên file) thì bỏ qua stat từng file.
+- WAL + busy_timeout: nhiều worker render (luồng hoặc tiến trình) đọc/ghi đồng thời an toàn.
+  Mỗi luồng dùng một connection riêng.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS video_metadata (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    duration REAL,
+    width INTEGER,
+    height INTEGER,
+    codec TEXT,
+    fps REAL,
+    probed_at REAL
+);
+CREATE TABLE IF NOT EXISTS directory_state (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    scanned_at REAL
+);
+CREATE TABLE IF NOT EXISTS store_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+METADATA_FIELDS = ("size", "mtime", "duration", "width", "height", "codec", "fps")
+_SQLITE_MAX_VARIABLES = 900 # Dưới giới hạn 999 biến của SQLite cũ
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class VideoMetadataStore:
+    """Kho metadata video; một instance dùng chung được cho nhiều luồng."""
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    # --- Metadata file ---
+
+    def get_many(self, paths):
+        """Trả về {path: dict metadata} cho các path đã có trong kho."""
+        results = {}
+        paths = list(paths)
+        conn = self._connection()
+        for i in range(0, len(paths), _SQLITE_MAX_VARIABLES):
+            batch = paths[i:i + _SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(batch))
+            for row in conn.execute(f"SELECT * FROM video_metadata WHERE path IN ({placeholders})", batch):
+                results[row["path"]] = dict(row)
+        return results
+
+    def upsert_many(self, records):
+        """Thêm/cập nhật metadata. records: {path: {size, mtime, duration, ...}}."""
+        if not records:
+            return
+        now = time.time()
+        rows = [
+            (path,) + tuple(data.get(field) for field in METADATA_FIELDS) + (now,)
+            for path, data in records.items()
+        ]
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT INTO video_metadata (path, size, mtime, duration, width, height, codec, fps, probed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET size=excluded.size, mtime=excluded.mtime, duration=excluded.duration, "
+                "width=excluded.width, height=excluded.height, codec=excluded.codec, fps=excluded.fps, "
+                "probed_at=excluded.probed_at",
+                rows
+            )
+
+    def delete_many(self, paths):
+        paths = list(paths)
+        if not paths:
+            return
+        with self._connection() as conn:
+            conn.executemany("DELETE FROM video_metadata WHERE path = ?", [(p,) for p in paths])
+
+    # --- Trạng thái thư mục (shortcut bỏ qua stat) ---
+
+    def get_directory_mtime(self, directory):
+        row = self._connection().execute(
+            "SELECT mtime FROM directory_state WHERE path = ?", (os.path.abspath(directory),)
+        ).fetchone()
+        return row["mtime"] if row else None
+
+    def set_directory_mtime(self, directory, mtime):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO directory_state (path, mtime, scanned_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET mtime=excluded.mtime, scanned_at=excluded.scanned_at",
+                (os.path.abspath(directory), mtime, time.time())
+            )
+
+    def invalidate_directory(self, directory):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM directory_state WHERE path = ?", (os.path.abspath(directory),))
+
+    # --- Chuyển đổi từ cache JSON cũ ---
+
+    def migrate_from_json(self, json_path):
+        """
+        Nhập một lần dữ liệu từ video_metadata_cache.json (duration + mtime).
+        Đánh dấu trong store_meta để không nhập lại ở các lần chạy sau.
+
+        Returns:
+            int: Số bản ghi đã nhập.
+        """
+        if not json_path or not os.path.exists(json_path):
+            return 0
+        marker = f"json_migrated:{os.path.abspath(json_path)}"
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM store_meta WHERE key = ?", (marker,)).fetchone():
+            return 0
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except Exception:
+            legacy = {}
+        records = {
+            os.path.abspath(path): {"mtime": data.get("mtime"), "duration": data.get("duration")}
+            for path, data in legacy.items()
+            if isinstance(data, dict) and isinstance(data.get("duration"), (int, float)) and data["duration"] > 0
+        }
+        existing = self.get_many(records)
+        self.upsert_many({path: data for path, data in records.items() if path not in existing})
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES (?, ?)", (marker, str(time.time())))
+        return len(records) - len(existing)
+
+
+def get_metadata_store(db_path):
+    """Instance dùng chung theo đường dẫn DB (trong một tiến trình)."""
+    db_path = os.path.abspath(db_path)
+    with _stores_lock:
+        store = _stores.get(db_path)
+        if store is None:
+            store = _stores[db_path] = VideoMetadataStore(db_path)
+        return store
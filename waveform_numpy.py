@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+# waveform_numpy.py
+"""
+Engine vẽ waveform (cột tần số) bằng NumPy, chọn bằng WAVEFORM_MODE=numpy.
+
+Thay cho filter showfreqs (đơn luồng, chạy trong filter graph của ffmpeg):
+- Đọc PCM của audio chính (WAV đã giải mã sẵn) qua numpy.memmap, không nạp cả file vào RAM.
+- Mỗi frame video lấy một cửa sổ win_size mẫu quanh thời điểm của frame; các cửa sổ được lấy theo lô
+  từ sliding_window_view (strided, không copy) và biến đổi bằng np.fft.rfft một lần cho cả lô.
+- Phổ được gộp thành WAVEFORM_BAR_COUNT cột (thang tần số log/lin), vẽ thẳng vào buffer RGBA
+  rồi pipe sang ffmpeg dạng rawvideo để encode thành track có alpha (qtrle...).
+- Chia khoảng frame cho nhiều tiến trình worker, mỗi worker encode một đoạn, sau đó nối bằng stream copy.
+
+NumPy là tùy chọn: nếu chưa cài, NUMPY_AVAILABLE = False và final_make quay về showfreqs.
+"""
+
+import concurrent.futures
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BAR_COUNT = 64
+BATCH_FRAMES = 128 # Số frame tính FFT + vẽ mỗi lô
+MIN_FREQUENCY_HZ = 20.0
+LOG_FLOOR_DB = -60.0 # ascale=log: mức này trở xuống coi là 0
+BAR_GAP_RATIO = 0.2 # Tỉ lệ khoảng trống giữa các cột
+
+_COLOR_NAMES = {
+    "white": (255, 255, 255), "black": (0, 0, 0), "red": (255, 0, 0), "lime": (0, 255, 0),
+    "green": (0, 128, 0), "blue": (0, 0, 255), "yellow": (255, 255, 0), "cyan": (0, 255, 255),
+    "magenta": (255, 0, 255), "orange": (255, 165, 0), "gray": (128, 128, 128), "grey": (128, 128, 128),
+}
+
+
+def parse_color(value: str) -> Tuple[int, int, int, int]:
+    """Màu kiểu ffmpeg ('white', '#RRGGBB', '0xRRGGBB[AA]', 'white@0.5') -> (r, g, b, a)."""
+    value = (value or "white").strip().split("|")[0] # showfreqs cho phép 'c1|c2' theo kênh
+    alpha = 255
+    if "@" in value:
+        value, alpha_str = value.split("@", 1)
+        try: alpha = int(round(max(0.0, min(1.0, float(alpha_str))) * 255))
+        except ValueError: pass
+    hex_value = value[1:] if value.startswith("#") else value[2:] if value.lower().startswith("0x") else None
+    if hex_value and len(hex_value) in (6, 8):
+        try:
+            rgb = tuple(int(hex_value[i:i + 2], 16) for i in (0, 2, 4))
+            if len(hex_value) == 8: alpha = int(hex_value[6:8], 16)
+            return rgb + (alpha,)
+        except ValueError:
+            pass
+    return _COLOR_NAMES.get(value.lower(), (255, 255, 255)) + (alpha,)
+
+
+def params_from_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Tham số engine lấy từ config của final_make (các khóa waveform_*)."""
+    return {
+        "width": int(config["waveform_w"]),
+        "height": int(config["waveform_h"]),
+        "fps": float(config.get("framerate", 30)),
+        "win_size": int(config.get("waveform_win_size", 2048)),
+        "win_func": config.get("waveform_win_func", "hann"),
+        "ascale": config.get("waveform_ascale", "log"),
+        "fscale": config.get("waveform_fscale", "log"),
+        "color": parse_color(config.get("waveform_color", "white")),
+        "bar_count": int(config.get("waveform_bar_count", DEFAULT_BAR_COUNT)),
+    }
+
+
+# --- Đọc PCM ---
+
+def read_wav_layout(path: str) -> Dict[str, int]:
+    """
+    Đọc header WAV (RIFF hoặc RF64) PCM 16-bit.
+
+    Returns:
+        dict: sample_rate, channels, data_offset, frame_count.
+    """
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        riff_id, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff_id not in (b"RIFF", b"RF64") or wave_id != b"WAVE":
+            raise ValueError(f"{path} is not a WAV file.")
+        layout: Dict[str, int] = {}
+        rf64_data_size = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{path}: missing data chunk.")
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"ds64":
+                _, rf64_data_size = struct.unpack("<QQ", f.read(16))
+                f.seek(chunk_size - 16, os.SEEK_CUR)
+            elif chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                audio_format, channels, sample_rate = struct.unpack("<HHI", fmt[:8])
+                bits = struct.unpack("<H", fmt[14:16])[0]
+                if audio_format not in (1, 0xFFFE) or bits != 16:
+                    raise ValueError(f"{path}: only 16-bit PCM is supported (format={audio_format}, bits={bits}).")
+                layout.update(sample_rate=sample_rate, channels=channels)
+            elif chunk_id == b"data":
+                if "channels" not in layout:
+                    raise ValueError(f"{path}: data chunk before fmt chunk.")
+                data_offset = f.tell()
+                data_size = rf64_data_size if chunk_size == 0xFFFFFFFF and rf64_data_size else chunk_size
+                data_size = min(data_size, file_size - data_offset) # Header ghi dở (pipe) -> lấy theo kích thước file
+                layout.update(data_offset=data_offset, frame_count=data_size // (2 * layout["channels"]))
+                return layout
+            else:
+                f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def open_pcm(path: str):
+    """Trả về (memmap int16 shape (frames, channels), sample_rate)."""
+    layout = read_wav_layout(path)
+    samples = np.memmap(path, dtype="<i2", mode="r", offset=layout["data_offset"],
+                        shape=(layout["frame_count"], layout["channels"]))
+    return samples, layout["sample_rate"]
+
+
+# --- Phổ & cột ---
+
+def _window(win_func: str, win_size: int):
+    windows = {"hann": np.hanning, "hanning": np.hanning, "hamming": np.hamming,
+               "blackman": np.blackman, "bartlett": np.bartlett}
+    if win_func in windows:
+        return windows[win_func](win_size).astype(np.float32)
+    return np.ones(win_size, dtype=np.float32) # rect và các cửa sổ showfreqs khác chưa hỗ trợ
+
+
+def _band_edges(sample_rate: int, win_size: int, bar_count: int, fscale: str):
+    """Chỉ số bin rfft biên của từng cột (bar_count + 1 phần tử, tăng dần, mỗi cột >= 1 bin)."""
+    bin_count = win_size // 2 + 1
+    nyquist = sample_rate / 2
+    if fscale == "log":
+        freqs = np.geomspace(MIN_FREQUENCY_HZ, nyquist, bar_count + 1)
+    else:
+        freqs = np.linspace(0.0, nyquist, bar_count + 1)
+    edges = np.clip(np.round(freqs / nyquist * (bin_count - 1)).astype(np.int64), 0, bin_count - 1)
+    for i in range(1, len(edges)): # Bảo đảm mỗi cột có ít nhất 1 bin
+        edges[i] = max(edges[i], edges[i - 1] + 1)
+    return np.minimum(edges, bin_count)
+
+
+def compute_bar_levels(samples, sample_rate: int, frame_start: int, frame_count: int,
+                       params: Dict[str, Any], window=None, edges=None):
+    """
+    Mức (0..1) của từng cột cho frame_count frame bắt đầu từ frame_start.
+
+    Returns:
+        ndarray float32 shape (frame_count, bar_count).
+    """
+    win_size = params["win_size"]
+    window = _window(params["win_func"], win_size) if window is None else window
+    edges = _band_edges(sample_rate, win_size, params["bar_count"], params["fscale"]) if edges is None else edges
+    total_samples = samples.shape[0]
+
+    centers = np.round(np.arange(frame_start, frame_start + frame_count) * sample_rate / params["fps"]).astype(np.int64)
+    seg_start = int(centers[0]) - win_size // 2
+    seg_end = int(centers[-1]) - win_size // 2 + win_size
+    # Đoạn mono liên tục bao mọi cửa sổ của lô (đệm 0 ở đầu/cuối file)
+    segment = np.zeros(seg_end - seg_start, dtype=np.float32)
+    src_start, src_end = max(seg_start, 0), min(seg_end, total_samples)
+    if src_end > src_start:
+        segment[src_start - seg_start:src_end - seg_start] = samples[src_start:src_end].mean(axis=1, dtype=np.float32) / 32768.0
+
+    windows = sliding_window_view(segment, win_size)[centers - win_size // 2 - seg_start] # (frames, win_size)
+    spectrum = np.abs(np.fft.rfft(windows * window, axis=1)) / (window.sum() / 2)
+    widths = np.diff(edges).astype(np.float32)
+    bands = np.add.reduceat(spectrum, edges[:-1], axis=1)[:, :len(widths)] / widths
+
+    ascale = params["ascale"]
+    if ascale == "log":
+        levels = (20 * np.log10(np.maximum(bands, 1e-9)) - LOG_FLOOR_DB) / -LOG_FLOOR_DB
+    elif ascale == "sqrt":
+        levels = np.sqrt(bands)
+    elif ascale == "cbrt":
+        levels = np.cbrt(bands)
+    else:
+        levels = bands
+    return np.clip(levels, 0.0, 1.0).astype(np.float32)
+
+
+def rasterize_bars(levels, width: int, height: int, color: Tuple[int, int, int, int]):
+    """Vẽ cột (từ đáy lên) vào buffer RGBA uint8 shape (frames, height, width, 4), nền trong suốt."""
+    bar_count = levels.shape[1]
+    column_pos = np.arange(width) * bar_count / width
+    column_bar = np.minimum(column_pos.astype(np.int64), bar_count - 1)
+    is_gap = (column_pos - column_bar) >= (1.0 - BAR_GAP_RATIO)
+    heights = np.round(levels[:, column_bar] * height).astype(np.int32) # (frames, width)
+    heights[:, is_gap] = 0
+    rows = np.arange(height, dtype=np.int32)[None, :, None]
+    mask = rows >= (height - heights)[:, None, :] # (frames, height, width)
+    frames = np.zeros(mask.shape + (4,), dtype=np.uint8)
+    frames[mask] = color
+    return frames
+
+
+# --- Encode ---
+
+def _ffmpeg_rawvideo_cmd(params: Dict[str, Any], output_path: str, output_args: List[str]) -> List[str]:
+    return [
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{params['width']}x{params['height']}",
+        "-r", str(params["fps"]), "-i", "pipe:0",
+        *output_args, output_path,
+    ]
+
+
+def render_frames(pcm_path: str, output_path: str, frame_start: int, frame_count: int,
+                  params: Dict[str, Any], output_args: List[str]) -> Tuple[bool, str]:
+    """
+    Render frame [frame_start, frame_start + frame_count) ra output_path (chạy được trong tiến trình worker).
+
+    Returns:
+        tuple: (thành công, stderr của ffmpeg).
+    """
+    samples, sample_rate = open_pcm(pcm_path)
+    window = _window(params["win_func"], params["win_size"])
+    edges = _band_edges(sample_rate, params["win_size"], params["bar_count"], params["fscale"])
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(_ffmpeg_rawvideo_cmd(params, output_path, output_args),
+                                   stdin=subprocess.PIPE, stderr=stderr_file)
+        try:
+            for batch_start in range(frame_start, frame_start + frame_count, BATCH_FRAMES):
+                batch_count = min(BATCH_FRAMES, frame_start + frame_count - batch_start)
+                levels = compute_bar_levels(samples, sample_rate, batch_start, batch_count, params, window, edges)
+                process.stdin.write(rasterize_bars(levels, params["width"], params["height"], params["color"]).tobytes())
+            process.stdin.close()
+        except BrokenPipeError:
+            pass # ffmpeg thoát sớm -> lỗi nằm trong stderr
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        returncode = process.wait()
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode("utf-8", errors="replace")
+    ok = returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 100
+    return ok, stderr
+
+
+def render_waveform_track(pcm_path: str, output_path: str, params: Dict[str, Any], output_args: List[str],
+                          workers: Optional[int] = None, duration: Optional[float] = None) -> bool:
+    """
+    Render track waveform của cả file PCM. Nhiều worker -> mỗi tiến trình một đoạn frame, rồi nối (stream copy).
+
+    Args:
+        output_args: Tham số encode ffmpeg cho track (vd: ["-c:v", "qtrle", "-pix_fmt", "argb"]).
+        workers: Số tiến trình (mặc định min(4, số CPU)); worker render nên truyền theo số core của job.
+        duration: Thời lượng track (mặc định = thời lượng PCM).
+
+    Returns:
+        bool: True nếu thành công.
+    """
+    if not NUMPY_AVAILABLE:
+        raise RuntimeError("numpy is not installed.")
+    layout = read_wav_layout(pcm_path)
+    if duration is None:
+        duration = layout["frame_count"] / layout["sample_rate"]
+    total_frames = max(1, int(math.ceil(duration * params["fps"])))
+    workers = max(1, min(workers or min(4, os.cpu_count() or 1), total_frames // BATCH_FRAMES or 1))
+    logger.info(f"[WaveformNumpy] Rendering {total_frames} frames ({params['width']}x{params['height']}, "
+                f"{params['bar_count']} bars) with {workers} worker(s).")
+
+    if workers == 1:
+        ok, stderr = render_frames(pcm_path, output_path, 0, total_frames, params, output_args)
+        if not ok:
+            logger.error(f"[WaveformNumpy] ffmpeg failed:\n{stderr}")
+        return ok
+
+    work_dir = tempfile.mkdtemp(prefix="waveform_numpy_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        extension = os.path.splitext(output_path)[1]
+        frames_per_worker = int(math.ceil(total_frames / workers))
+        parts = []
+        for index in range(workers):
+            start = index * frames_per_worker
+            count = min(frames_per_worker, total_frames - start)
+            if count > 0:
+                parts.append((os.path.join(work_dir, f"part_{index:03d}{extension}"), start, count))
+        # spawn: tiến trình gọi thường đã có nhiều luồng (pymongo, heartbeat, dispatcher) -> fork có thể
+        # kế thừa lock đang bị giữ và treo
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(render_frames, pcm_path, part_path, start, count, params, output_args)
+                       for part_path, start, count in parts]
+            results = [future.result() for future in futures]
+        failed = [stderr for ok, stderr in results if not ok]
+        if failed:
+            logger.error(f"[WaveformNumpy] {len(failed)} part(s) failed:\n{failed[0]}")
+            return False
+
+        list_path = os.path.join(work_dir, "parts.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            for part_path, _, _ in parts:
+                f.write(f"file '{part_path.replace(chr(92), '/')}'\n")
+        result = subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path],
+            capture_output=True, text=True, encoding="utf-8", errors="replace", check=False
+        )
+        if result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) <= 100:
+            logger.error(f"[WaveformNumpy] Concat failed:\n{result.stderr}")
+            return False
+        return True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Render a bar-graph waveform track from a 16-bit PCM WAV with NumPy.")
+    parser.add_argument("wav", help="File WAV PCM 16-bit.")
+    parser.add_argument("output", help="File track output (vd: waveform.mov).")
+    parser.add_argument("--size", default="960x120", help="Kích thước WxH.")
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--bars", type=int, default=DEFAULT_BAR_COUNT)
+    parser.add_argument("--color", default="white")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    cli_params = params_from_config({
+        "waveform_w": width, "waveform_h": height, "framerate": args.fps,
+        "waveform_color": args.color, "waveform_bar_count": args.bars,
+    })
+    success = render_waveform_track(args.wav, args.output, cli_params, ["-c:v", "qtrle", "-pix_fmt", "argb"], workers=args.workers)
+    raise SystemExit(0 if success else 1)